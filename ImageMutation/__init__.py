@@ -0,0 +1,26 @@
+"""
+Image effects - pixel sorting, mountains, shifting and reshaping - usable as a library, or from the command line through
+the imagemutation command (see cli.py). Modules are imported the first time they are used, eg.
+
+    import ImageMutation
+
+    args = ImageMutation.sort_pixels.parse_args(["--mode", "0"])
+    pixels = ImageMutation.sort_pixels.process_pixels(args, pixels)
+
+so importing the package itself does not load numpy or PIL.
+"""
+
+_MODULES = {"batch_runner", "batch_sort", "benchmark", "cli", "frames", "image_utilities", "interval_index",
+            "mountains", "pipeline", "preview", "profiling", "reshape_image", "result_cache", "service", "shift_pixels",
+            "sort_keys", "sort_pixels", "strips"}
+
+
+def __getattr__(name):
+    if name in _MODULES:
+        import importlib
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | _MODULES)
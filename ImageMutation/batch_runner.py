@@ -0,0 +1,119 @@
+"""
+Runs an effect over many files, optionally across several processes. Each file is decoded, processed and encoded
+entirely inside a worker, so only file names are sent between processes.
+
+Scripts provide a process_file(args, file_name) function which handles a single file and returns the name of the file
+it wrote, and call run_files from main().
+"""
+
+
+def add_batch_arguments(parser):
+    """ Adds the --jobs and --max_in_flight arguments to parser. """
+    parser.add_argument("--jobs", "-j", dest="jobs", default=1, type=int,
+                        help="Number of processes to run. Defaults to 1, which processes files in this process.")
+    parser.add_argument("--max_in_flight", dest="max_in_flight", default=None, type=int,
+                        help="Maximum number of files which are submitted to workers at once. Bounds the number of "
+                             "images in memory. Defaults to twice the number of jobs.")
+
+
+def run_batch(process_file, files, jobs=1, max_in_flight=None):
+    """ Applies process_file to each file, yielding results as soon as they are available. A failure on one file does
+    not stop the batch.
+
+    :param process_file:    A picklable function taking a file name, and returning the name of the file it wrote.
+    :param files:           An iterable of file names. It is consumed lazily.
+    :param jobs:            Number of worker processes. If 1, files are processed in this process, in order.
+    :param max_in_flight:   Maximum number of files submitted to the workers at any time. Defaults to 2 * jobs.
+    :return:                Yields (file_name, output_name, error) for each file, in the order in which they finish.
+                            error is None if the file was processed successfully, and output_name is None otherwise.
+    """
+    if jobs <= 1:
+        for file_name in files:
+            try:
+                yield file_name, process_file(file_name), None
+            except Exception as e:
+                yield file_name, None, e
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    if max_in_flight is None:
+        max_in_flight = 2 * jobs
+    max_in_flight = max(max_in_flight, 1)
+
+    files = iter(files)
+    in_flight = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            for file_name in files:
+                in_flight[executor.submit(process_file, file_name)] = file_name
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                return
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_name = in_flight.pop(future)
+                error = future.exception()
+                yield file_name, None if error else future.result(), error
+
+
+def run_ordered(fn, items, jobs=1, max_in_flight=None):
+    """ Applies fn to each item, yielding the results in the same order as items. Items are only read once there is
+    room for them: at most max_in_flight items are submitted to the workers, and no more are submitted until the
+    oldest result has been consumed. A slow consumer therefore holds back the producer, and memory use does not grow
+    with the number of items.
+
+    :param fn:              A picklable function taking an item, and returning its result.
+    :param items:           An iterable of picklable items. It is consumed lazily.
+    :param jobs:            Number of worker processes. If 1, items are processed in this process.
+    :param max_in_flight:   Maximum number of items submitted to the workers at any time. Defaults to 2 * jobs.
+    :return:                Yields the result of fn for each item, in order. Exceptions raised by fn are re-raised.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    if max_in_flight is None:
+        max_in_flight = 2 * jobs
+    max_in_flight = max(max_in_flight, 1)
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def run_files(process_file, files, jobs=1, max_in_flight=None, profile=None, profile_memory=False):
+    """ Runs run_batch to completion, reporting each failure as it happens. If profile is given, the profile of each
+    file is recorded to it (see profiling.py), including its peak memory if profile_memory is True.
+
+    :return:    The names of the files which could not be processed.
+    """
+    import sys
+
+    if profile is not None:
+        from functools import partial
+        from .profiling import profile_file, reset_output
+
+        reset_output(profile)
+        process_file = partial(profile_file, process_file, profile, memory=profile_memory)
+
+    failures = []
+    for file_name, _, error in run_batch(process_file, files, jobs, max_in_flight):
+        if error is not None:
+            print(f"{file_name}: {type(error).__name__}: {error}", file=sys.stderr)
+            failures.append(file_name)
+
+    if failures:
+        print(f"Failed to process {len(failures)} file(s).", file=sys.stderr)
+    return failures
@@ -0,0 +1,182 @@
+import numpy as np
+from .image_utilities import pixel_records, contiguous_channels, transpose_pixels
+from .interval_index import IntervalIndex
+from .sort_keys import resolve_key
+from .profiling import stage, count
+
+"""
+Whole-image interval sorting. Rather than walking each row in Python, every interval in a pass (all columns, or all
+rows) is found at once, and all of the pixels are permuted with a single segmented sort and gather.
+
+Intervals are described by (comparator, value) conditions, rather than functions, so that they can be evaluated over the
+entire image at once - see interval_index.py.
+"""
+
+# Intervals of uint8 weights which are at least this long on average are sorted with a counting sort (see
+# counting_sort_order). Shorter intervals are faster to sort all at once with a comparison sort.
+COUNTING_SORT_LENGTH = 8
+
+
+def counting_sort_order(weights, segment_ids):
+    """ Returns the order which stably sorts uint8 weights within each segment, where segments are contiguous.
+
+    Segments are taken 256 at a time, and the weights of each group are sorted on a 16 bit key made of the segment's
+    position in the group and the weight. numpy sorts 16 bit keys with a stable radix sort - two passes of a 256 bucket
+    counting sort - so the cost is linear in the number of weights, however long the segments are.
+
+    :param weights:     A one dimensional uint8 array of weights.
+    :param segment_ids: The segment of each weight. Must be non-decreasing.
+    :return:            The indices of weights, such that weights[order] is sorted within each segment, and segment_ids
+                        is unchanged by the same permutation.
+    """
+    first = int(segment_ids[0]) if len(segment_ids) else 0
+    offsets = segment_ids - first
+    keys = (offsets & 255).astype(np.uint16) << 8 | weights
+    bounds = np.searchsorted(offsets, np.arange(0, int(offsets[-1]) + 257 if len(offsets) else 1, 256))
+
+    order = np.empty(len(weights), dtype=np.intp)
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        if high > low:
+            order[low:high] = np.argsort(keys[low:high], kind="stable")
+            order[low:high] += low
+    return order
+
+
+def sort_segments(lines, compressed_lines, starts, ends, stable=True, counting_length=COUNTING_SORT_LENGTH):
+    """ Sorts each [start, end) interval of lines and compressed_lines in place, based on compressed_lines.
+
+    :param lines:               A lines x length x channels array of pixels.
+    :param compressed_lines:    A lines x length array of pixel weights.
+    :param starts:              The start of each interval, as a position in the flattened compressed_lines.
+    :param ends:                The exclusive end of each interval. Intervals may not overlap.
+    :param stable:              If False, pixels of equal weight may be reordered. The counting sort is always stable.
+    :param counting_length:     uint8 weights are sorted with counting_sort_order if the intervals are at least this
+                                long on average. None never uses it.
+    :return:                    Nothing. lines and compressed_lines are modified in place.
+    """
+    if len(starts) == 0:
+        return
+
+    size = compressed_lines.size
+    weights = compressed_lines.reshape(size)
+
+    # An interval may end where the next one starts, so starts and ends are added separately.
+    boundaries = np.zeros(size + 1, dtype=np.int8)
+    boundaries[starts] = 1
+    segment_ids = np.cumsum(boundaries[:-1], dtype=np.intp)
+    boundaries[ends] -= 1
+    inside = np.flatnonzero(np.cumsum(boundaries[:-1], dtype=np.int8))
+    segment_ids = segment_ids[inside]
+
+    if weights.dtype == np.uint8 and counting_length is not None and len(inside) >= counting_length * len(starts):
+        source = inside[counting_sort_order(weights[inside], segment_ids)]
+    elif np.issubdtype(weights.dtype, np.integer) and weights.dtype.itemsize <= 2:
+        # Small integer weights can be packed alongside the segment id into a single key, which sorts faster.
+        info = np.iinfo(weights.dtype)
+        keys = segment_ids * (int(info.max) - int(info.min) + 1) + (weights[inside].astype(np.intp) - int(info.min))
+        source = inside[np.argsort(keys, kind="stable" if stable else "quicksort")]
+    else:
+        source = inside[np.lexsort((weights[inside], segment_ids))]
+    with contiguous_channels(lines) as lines:
+        pixels = pixel_records(lines.reshape(size, -1))
+        pixels[inside] = np.take(pixels, source)
+    weights[inside] = np.take(weights, source)
+
+
+def sort_lines(lines, compressed_lines, stable=True):
+    """ Sorts each line of lines (a lines x length x channels array) in place, based on compressed_lines. If stable is
+    False, pixels of equal weight may be reordered. """
+    count, length = compressed_lines.shape
+    sorted_indices = np.argsort(compressed_lines, axis=1, kind="stable" if stable else "quicksort")
+    source = (sorted_indices + np.arange(0, count * length, length)[:, np.newaxis]).reshape(-1)
+    with contiguous_channels(lines) as lines:
+        pixels = pixel_records(lines.reshape(count * length, -1))
+        pixels[:] = np.take(pixels, source)
+    weights = compressed_lines.reshape(count * length)
+    weights[:] = np.take(weights, source)
+
+
+def sort_selected(lines, compressed_lines, start, end, interval_index, columns, selected, stable=True):
+    """ Sorts every interval in the selected lines, which have been copied into lines and compressed_lines. """
+    count("lines visited", len(selected))
+    if start is None:
+        count("intervals sorted", len(selected))
+        with stage("segment sort"):
+            sort_lines(lines, compressed_lines, stable)
+    else:
+        with stage("interval search"):
+            starts, ends = interval_index.bounds(start, end, columns, selected)
+        count("intervals sorted", len(starts))
+        with stage("segment sort"):
+            sort_segments(lines, compressed_lines, starts, ends, stable)
+    interval_index.invalidate(start, end)
+
+
+def _sort_strip(image, compressed_image, selected, start, end, columns, stable):
+    """ Sorts the selected columns (or rows) of a strip of an image. """
+    sort_intervals_batched(image, compressed_image, start, end, lambda size: selected, columns, not columns,
+                           stable=stable)
+
+
+def sort_intervals_batched(image, compressed_image, start, end, iterator=range, sort_cols=True, sort_rows=True,
+                           interval_index=None, strip_runner=None, stable=True):
+    """ Produces the same output as sort_pixels.sort_intervals, but sorts every selected column (and then every
+    selected row) at once.
+
+    SIDE EFFECTS: Will modify the input image - provide a copy to sort on if this is unwanted.
+
+    :param image:               The image to modify.
+    :param compressed_image:    The array with the same number of rows and columns as image, where each element is
+                                the weight of the pixel compared to its neighbours (higher pixels will be sorted to the
+                                end). May instead be the name of a key in sort_keys.KEYS, which is computed from image.
+    :param start:               The (comparator, value) pair which starts an interval, or None to sort entire rows.
+    :param end:                 The (comparator, value) pair which ends an interval.
+    :param iterator:            An iterable which yields a number from 0 to rows - 1, and yields each number at most
+                                once.
+    :param sort_cols:           Will sort cols if set to True.
+    :param sort_rows:           Will sort rows if set to True.
+    :param interval_index:      An IntervalIndex over compressed_image, which may be shared between calls on the same
+                                image. One is built if not provided. Not used if strip_runner is provided.
+    :param strip_runner:        A StripRunner to split the columns and rows between. If workers are processes, image
+                                and compressed_image must be the arrays given by strip_runner.apply.
+    :param stable:              If False, pixels of equal weight may be sorted in any order, which can be faster. The
+                                output may then differ between numpy versions.
+    :return:                    Nothing. Image is modified in place - user is expected to provide a copy.
+    """
+
+    rows, cols, _ = image.shape
+    compressed_image = resolve_key(image, compressed_image)
+    if strip_runner is not None:
+        if sort_cols:
+            strip_runner.run(_sort_strip, [image, compressed_image], True, iterator(cols), start, end, True, stable)
+        if sort_rows:
+            strip_runner.run(_sort_strip, [image, compressed_image], False, iterator(rows), start, end, False, stable)
+        return
+
+    if interval_index is None:
+        interval_index = IntervalIndex(compressed_image)
+
+    if sort_cols:
+        # Columns are sorted as the rows of a transposed copy, so they are read and written sequentially.
+        selected = np.fromiter(iterator(cols), dtype=np.intp)
+        every_col = np.array_equal(selected, np.arange(cols))
+        lines = transpose_pixels(image if every_col else image[:, selected])
+        compressed_lines = transpose_pixels(compressed_image if every_col else compressed_image[:, selected])
+        sort_selected(lines, compressed_lines, start, end, interval_index, True, selected, stable)
+        if every_col:
+            transpose_pixels(lines, image)
+            transpose_pixels(compressed_lines, compressed_image)
+        else:
+            image[:, selected] = transpose_pixels(lines)
+            compressed_image[:, selected] = transpose_pixels(compressed_lines)
+    if sort_rows:
+        selected = np.fromiter(iterator(rows), dtype=np.intp)
+        if np.array_equal(selected, np.arange(rows)) and image.flags.c_contiguous and \
+                compressed_image.flags.c_contiguous:
+            sort_selected(image, compressed_image, start, end, interval_index, False, selected, stable)
+            return
+        lines = image[selected]
+        compressed_lines = compressed_image[selected]
+        sort_selected(lines, compressed_lines, start, end, interval_index, False, selected, stable)
+        image[selected] = lines
+        compressed_image[selected] = compressed_lines
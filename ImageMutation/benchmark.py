@@ -0,0 +1,548 @@
+import numpy as np
+from .image_utilities import brightness, load_pixels
+
+"""
+Times the optimized engines against the reference (per-row) implementations, and checks that they produce identical
+output. The stream effect compares --stream against the in memory engines instead. Run from the root of the repository
+(or pass the path of the golden file from wherever it is run), eg.
+
+    imagemutation benchmark --sizes 256 1024 --repeat 3
+    imagemutation benchmark --golden ImageMutation/benchmark_golden.json --skip_reference
+
+Results can be written to JSON with --json. The hashes of the reference outputs can be saved with --golden and
+--update_golden. Later runs given --golden check every output against them, and exit with an error on any mismatch. With
+--skip_reference, only the optimized engines are run and checked against the golden hashes. This makes large sizes (eg.
+--suite, which goes up to 8192x8192) practical.
+
+With --parity, each effect is instead timed along the columns of each image against along the rows of its transpose.
+Sorts and mountains process columns as the rows of transposed copies, so the difference is mostly the time spent
+transposing. Shift does not transpose its columns, and moves them through a scratch buffer instead. Columns are not at
+parity with rows: they take from about 1.2x (sorting black intervals) to about 2x (sorting whole lines, and shifting) as
+long.
+"""
+
+# Side lengths of the synthetic images benchmarked with --suite, from 256x256 up to 8K.
+SUITE_SIZES = [256, 512, 1024, 2048, 4096, 8192]
+
+
+def parse_args(argv=None, prog=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--files", "-f", dest="files", default=[], nargs="*",
+                        help="File(s) to benchmark on, in addition to the synthetic images. Can be any format "
+                             "supported by PIL. ")
+    parser.add_argument("--sizes", dest="sizes", default=[256, 1024], type=int, nargs="*",
+                        help="Side lengths of the synthetic (square) images to benchmark on.")
+    parser.add_argument("--suite", action="store_true",
+                        help=f"Benchmarks every size in {SUITE_SIZES}, rather than --sizes.")
+    parser.add_argument("--repeat", "-r", dest="repeat", default=1, type=int,
+                        help="Number of times to run each benchmark. The fastest run is reported.")
+    parser.add_argument("--effects", "-e", dest="effects", default=["sort", "mountains", "shift", "reshape"], nargs="+",
+                        choices=sorted(CASES),
+                        help="Effects to benchmark.")
+    parser.add_argument("--channels", "-c", dest="channels", default=3, type=int, choices=[1, 2, 3, 4],
+                        help="Number of channels of the synthetic images: 1 (L), 2 (LA), 3 (RGB) or 4 (RGBA).")
+    parser.add_argument("--memory", action="store_true",
+                        help="Also reports the peak memory allocated by each implementation, measured with "
+                             "tracemalloc.")
+    parser.add_argument("--json", dest="json", default=None,
+                        help="File to write the results to, as JSON.")
+    parser.add_argument("--golden", dest="golden", default=None,
+                        help="JSON file of the hashes of the reference outputs, to check every output against.")
+    parser.add_argument("--update_golden", action="store_true",
+                        help="Adds the hashes of the reference outputs of this run to --golden, rather than checking "
+                             "against them.")
+    parser.add_argument("--skip_reference", action="store_true",
+                        help="Only runs the optimized implementations, which are checked against --golden.")
+    parser.add_argument("--parity", action="store_true",
+                        help="Rather than comparing engines, compares the time each effect takes along the columns of "
+                             "an image with the time it takes along the rows of its transpose.")
+
+    args = parser.parse_args(argv)
+    if args.update_golden and (args.golden is None or args.skip_reference):
+        parser.error("argument --update_golden requires --golden, and can not be used with --skip_reference.")
+    return args
+
+
+def synthetic_image(size, seed=0):
+    """ Produces a size x size x 3 image mixing a gradient, noise, and runs of black and white pixels. """
+    rng = np.random.RandomState(seed)
+    gradient = np.linspace(0, 255, size).astype(np.int16)
+    image = np.empty((size, size, 3), dtype=np.uint8)
+    block = max(1, 2 ** 20 // size)
+    for first in range(0, size, block):
+        noise = rng.randint(-40, 40, (min(block, size - first), size, 3), dtype=np.int16)
+        image[first:first + block] = np.clip(gradient[np.newaxis, :, np.newaxis] + noise, 0, 255)
+    runs = rng.randint(0, 3, (size, size // 8), dtype=np.uint8).repeat(8, axis=1)
+    image[:, :runs.shape[1]][runs == 0] = rng.randint(0, 60, 3, dtype=np.uint8)
+    image[:, :runs.shape[1]][runs == 2] = rng.randint(150, 255, 3, dtype=np.uint8)
+    return image
+
+
+def edge_case_image(size, seed=0):
+    """ Produces a size x size x 3 image of short runs of black, white and grey pixels, where many rows and columns
+    start on black or white pixels, and many runs are a single pixel long. These hit the quirks of sort_row: a match at
+    the first position searched is treated as "not found". """
+    rng = np.random.RandomState(seed)
+    levels = np.array([0, 30, 60, 61, 100, 149, 150, 200, 255], dtype=np.uint8)
+    image = levels[rng.randint(0, len(levels), (size, size))]
+    image = np.repeat(image[:, :, np.newaxis], 3, axis=2)
+    image[:, :, 1] = image[:, :, 1] // rng.randint(1, 4, (size, size)).astype(np.uint8)
+    return image
+
+
+def with_channels(image, channels):
+    """ Converts an RGB image to one with the given number of channels. Grey levels are the brightness of the image, and
+    alpha is a gradient across its columns. """
+    if channels == 3:
+        return image
+    grey = brightness(image)[:, :, np.newaxis]
+    alpha = np.broadcast_to(np.linspace(0, 255, image.shape[1]).astype(np.uint8)[np.newaxis, :, np.newaxis],
+                            grey.shape)
+    return np.ascontiguousarray(np.concatenate({1: [grey], 2: [grey, alpha], 4: [image, alpha]}[channels], axis=2))
+
+
+def time_call(fn, image, repeat):
+    """ Runs fn on a fresh copy of image and its brightness repeat times, and returns the fastest time and the output
+    image. The output is the copy of image, which fn modifies in place, unless fn returns a new image. """
+    import time
+
+    best = float("inf")
+    for _ in range(repeat):
+        pixels = np.copy(image)
+        compressed = brightness(pixels)
+        start = time.perf_counter()
+        output = fn(pixels, compressed)
+        best = min(best, time.perf_counter() - start)
+    return best, pixels if output is None else output
+
+
+def output_hash(output):
+    """ Returns a hash of the shape, type and pixels of an output image. """
+    import hashlib
+
+    digest = hashlib.sha256(f"{output.shape} {output.dtype}".encode())
+    digest.update(np.ascontiguousarray(output).data)
+    return digest.hexdigest()
+
+
+def peak_memory(fn, image):
+    """ Runs fn on a fresh copy of image and its brightness, and returns the peak memory (in bytes) allocated while it
+    ran. """
+    import tracemalloc
+
+    pixels = np.copy(image)
+    compressed = brightness(pixels)
+    tracemalloc.start()
+    try:
+        fn(pixels, compressed)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def sort_cases():
+    """ Yields the name, reference function and optimized function of each sort_pixels benchmark. """
+    from . import sort_pixels
+    from .batch_sort import sort_intervals_batched
+    from .interval_index import IntervalIndex
+
+    def custom_start(x_start, row):
+        point = np.argmax(row[x_start:] >= 100)
+        if point == 0:
+            return -1
+        return point + x_start
+
+    def custom_end(x_start, row):
+        point = np.argmax(row[x_start:] < 200)
+        if point == 0:
+            return -1
+        return point + x_start
+
+    def chain(fn, intervals):
+        """ Runs fn over each (start, end) pair in turn, sharing one IntervalIndex, as mode 3 does. """
+        def run(pixels, compressed, sort_cols, sort_rows):
+            interval_index = IntervalIndex(compressed)
+            for start, end in intervals:
+                fn(pixels, compressed, start, end, range, sort_cols, sort_rows, interval_index)
+        return run
+
+    def reference_chain(fns):
+        def run(pixels, compressed, sort_cols, sort_rows):
+            for start_fn, end_fn in fns:
+                sort_pixels.sort_intervals(pixels, compressed, start_fn, end_fn, range, sort_cols, sort_rows)
+        return run
+
+    black = sort_pixels.get_black_index, sort_pixels.get_non_black_index
+    white = sort_pixels.get_white_index, sort_pixels.get_non_white_index
+    cases = [
+        ("black", [black], [sort_pixels.BLACK_INTERVAL]),
+        ("white", [white], [sort_pixels.WHITE_INTERVAL]),
+        ("black+white", [black, white], [sort_pixels.BLACK_INTERVAL, sort_pixels.WHITE_INTERVAL]),
+        ("brightness", [(lambda x, y: x, lambda x, y: len(y))], [(None, None)]),
+        ("custom", [(custom_start, custom_end)], [((">=", 100), ("<", 200))]),
+    ]
+    engines = [("batched", sort_intervals_batched), ("indexed", sort_pixels.sort_intervals_indexed)]
+    for name, fns, intervals in cases:
+        reference = reference_chain(fns)
+        for engine_name, engine in engines:
+            if engine_name == "indexed" and intervals[0][0] is None:
+                continue
+            optimized = chain(engine, intervals)
+            for sort_cols, sort_rows, direction in [(True, True, "both"), (False, True, "rows"),
+                                                    (True, False, "cols")]:
+                yield (f"sort {name} {direction} [{engine_name}]",
+                       lambda p, c, f=reference, sc=sort_cols, sr=sort_rows: f(p, c, sc, sr),
+                       lambda p, c, f=optimized, sc=sort_cols, sr=sort_rows: f(p, c, sc, sr))
+
+
+def mountain_cases():
+    """ Yields the name, reference function and optimized function of each mountains benchmark. """
+    from .mountains import apply_mountain_effect
+
+    for darkness in [False, True]:
+        for direction in ["up", "down", "left", "right"]:
+            def reference(p, c, d=direction, dark=darkness):
+                apply_mountain_effect(p, 255 - c if dark else c, d, engine="per_row")
+
+            def optimized(p, c, d=direction, dark=darkness):
+                apply_mountain_effect(p, 255 - c if dark else c, d)
+
+            yield f"mountains {direction}{' dark' if darkness else ''}", reference, optimized
+
+
+def shift_cases():
+    """ Yields the name, reference function and optimized function of each shift_pixels benchmark. """
+    from .shift_pixels import shift_rows_and_cols
+    from .image_utilities import ranges
+
+    def checkerboard(engine, size=200):
+        def run(p, c):
+            rows, cols, _ = p.shape
+            shift_rows_and_cols(p, ranges(size, rows), ranges(size, cols), 2 * size, size, engine=engine)
+        return run
+
+    def random_shifts(engine):
+        def run(p, c):
+            rows, cols, _ = p.shape
+            rng = np.random.RandomState(0)
+            shift_rows_and_cols(p, range(rows), range(cols), rng.randint(-cols, cols, rows),
+                                rng.randint(-rows, rows, cols), engine=engine)
+        return run
+
+    yield "shift checkerboard", checkerboard("per_row"), checkerboard("batched")
+    yield "shift per-row amounts", random_shifts("per_row"), random_shifts("batched")
+
+
+def stream_cases(strip_bytes=2 ** 22):
+    """ Yields the name, in memory function and streamed function of each --stream benchmark. The streamed functions
+    read and write the image through .npy files, with strips of about strip_bytes bytes. """
+    import os
+    import tempfile
+    from functools import partial
+    from .image_utilities import stream_passes, ranges
+    from .sort_pixels import BLACK_INTERVAL, _sort_strip
+    from .batch_sort import sort_intervals_batched
+    from .mountains import apply_mountain_effect, _mountain_stream_strip
+    from .shift_pixels import shift_rows_and_cols, _shift_stream_strip
+
+    def streamed(passes):
+        def run(p, c):
+            with tempfile.TemporaryDirectory() as work_dir:
+                file_name, output_name = os.path.join(work_dir, "in.npy"), os.path.join(work_dir, "out.npy")
+                np.save(file_name, p)
+                stream_passes(file_name, output_name, passes, strip_bytes)
+                p[...] = np.load(output_name, mmap_mode="r")
+        return run
+
+    sort_black = partial(_sort_strip, "brightness", *BLACK_INTERVAL, True)
+    yield ("stream sort black rows",
+           lambda p, c: sort_intervals_batched(p, c, *BLACK_INTERVAL, sort_cols=False),
+           streamed([(False, range, sort_black)]))
+    yield ("stream sort black both",
+           lambda p, c: sort_intervals_batched(p, c, *BLACK_INTERVAL),
+           streamed([(True, range, sort_black), (False, range, sort_black)]))
+    yield ("stream mountains up",
+           lambda p, c: apply_mountain_effect(p, c, "up"),
+           streamed([(True, range, partial(_mountain_stream_strip, "brightness", False, "left", "vectorized"))]))
+    yield ("stream shift checkerboard",
+           lambda p, c: shift_rows_and_cols(p, ranges(200, p.shape[0]), ranges(200, p.shape[1]), 400, 200),
+           streamed([(False, partial(ranges, 200), partial(_shift_stream_strip, 400)),
+                     (True, partial(ranges, 200), partial(_shift_stream_strip, 200))]))
+
+
+def record_cases():
+    """ Yields the name, reference function and optimized function of each benchmark of sort_pixel_list, comparing a
+    gather for each channel (as it used to be done) against moving each pixel as a single record. """
+    from .sort_pixels import sort_pixel_list, BLACK_INTERVAL
+    from .interval_index import IntervalIndex
+
+    def per_channel(row, compressed_row):
+        sorted_indices = np.argsort(compressed_row, kind="stable")
+        for channel in range(row.shape[1]):
+            row[:, channel] = row[:, channel][sorted_indices]
+        compressed_row[:] = compressed_row[sorted_indices]
+
+    def sort_rows(sort_fn, intervals):
+        def run(p, c):
+            interval_index = IntervalIndex(c)
+            for row in range(p.shape[0]):
+                for x_start, x_end in intervals(interval_index, row, p.shape[1]):
+                    sort_fn(p[row, x_start:x_end], c[row, x_start:x_end])
+        return run
+
+    def black(interval_index, row, length):
+        return interval_index.line_intervals(*BLACK_INTERVAL, False, row)
+
+    def whole(interval_index, row, length):
+        return [(0, length)]
+
+    for name, intervals in [("black", black), ("brightness", whole)]:
+        yield f"sort_pixel_list {name} rows", sort_rows(per_channel, intervals), sort_rows(sort_pixel_list, intervals)
+
+
+def segment_cases():
+    """ Yields the name, reference function and optimized function of each benchmark of batch_sort.sort_segments,
+    comparing a comparison sort of every interval at once (as it used to be done) against choosing the counting sort
+    for long enough intervals. The intervals of each row are found by a condition, or are a fixed length. """
+    from .batch_sort import sort_segments, COUNTING_SORT_LENGTH
+    from .interval_index import IntervalIndex
+    from .sort_pixels import BLACK_INTERVAL, WHITE_INTERVAL
+
+    def found(interval):
+        def bounds(c):
+            return IntervalIndex(c).bounds(*interval, False, np.arange(c.shape[0]))
+        return bounds
+
+    def fixed(length):
+        def bounds(c):
+            starts = np.arange(0, c.size, length)
+            return starts, np.minimum(starts + length, c.size)
+        return bounds
+
+    def sort_rows(bounds, counting_length):
+        def run(p, c):
+            starts, ends = bounds(c)
+            sort_segments(p, c, starts, ends, counting_length=counting_length)
+        return run
+
+    cases = [("black", found(BLACK_INTERVAL)), ("white", found(WHITE_INTERVAL)), ("length 4", fixed(4)),
+             ("length 64", fixed(64)), ("length 1024", fixed(1024))]
+    for name, bounds in cases:
+        yield f"sort_segments {name} rows", sort_rows(bounds, None), sort_rows(bounds, COUNTING_SORT_LENGTH)
+
+
+def reshape_cases():
+    """ Yields the name, reference function and optimized function of each reshape_image benchmark. The references
+    factor by trial division down from the square root, and test every side of a fit in turn, as it used to be done. The
+    fits are searched for the same number of pixels as a reshape of the image would be. """
+    import math
+    from .reshape_image import reshape_pixels, factors, fit_candidates, MAX_SIDE
+
+    def trial_factors(n):
+        guess = math.ceil(math.sqrt(n))
+        while n % guess != 0:
+            guess -= 1
+        return n // guess, guess
+
+    def flat_reshape(p, rows, cols):
+        pixels = np.reshape(p, (p.shape[0] * p.shape[1], 1, p.shape[2]))
+        return np.reshape(pixels[:rows * cols], (rows, cols, p.shape[2]))
+
+    def most_square(factor, reshape, drop=0):
+        def run(p, c):
+            # Dropping pixels gives a count with fewer (and larger) factors than the square image's.
+            p = np.reshape(p, (1, -1, p.shape[2]))[:, :p.shape[1] - drop] if drop else p
+            return reshape(p, *factor(p.shape[0] * p.shape[1]))
+        return run
+
+    def wide(reshape):
+        def run(p, c):
+            return reshape(p, p.shape[0] // 2, p.shape[1] * 2)
+        return run
+
+    def side_by_side_fits(p, c, loss_tolerance=0.1):
+        n = p.shape[0] * p.shape[1]
+        fits = [(side_a, n // side_a) for side_a in range(1, min(n, MAX_SIDE) + 1)
+                if n // side_a <= MAX_SIDE and (n - side_a * (n // side_a)) / n <= loss_tolerance]
+        return np.array(fits, dtype=np.int64)
+
+    def vectorized_fits(p, c, loss_tolerance=0.1):
+        return np.stack(fit_candidates(p.shape[0] * p.shape[1], loss_tolerance), axis=1)
+
+    yield "reshape most square", most_square(trial_factors, flat_reshape), most_square(factors, reshape_pixels)
+    yield ("reshape most square odd count", most_square(trial_factors, flat_reshape, 1),
+           most_square(factors, reshape_pixels, 1))
+    yield "reshape wide", wide(flat_reshape), wide(reshape_pixels)
+    yield "reshape fits", side_by_side_fits, vectorized_fits
+
+
+def parity_cases():
+    """ Yields the name, row function and column function of each --parity benchmark. Each column function applies an
+    effect along the columns of an image exactly as the row function does along its rows. Shift's column pass is the
+    only one which is not transposed. """
+    from .sort_pixels import BLACK_INTERVAL, sort_intervals_indexed
+    from .batch_sort import sort_intervals_batched
+    from .mountains import apply_mountain_effect
+    from .shift_pixels import shift_rows_and_cols
+    from .image_utilities import ranges
+
+    def sort(engine, interval, columns):
+        def run(p, c):
+            engine(p, c, *interval, sort_cols=columns, sort_rows=not columns)
+        return run
+
+    def mountains(engine, direction):
+        def run(p, c):
+            apply_mountain_effect(p, c, direction, engine=engine)
+        return run
+
+    def checkerboard(columns, size=200):
+        def run(p, c):
+            lines = ranges(size, p.shape[1 if columns else 0])
+            shift_rows_and_cols(p, [] if columns else lines, lines if columns else [], size, size)
+        return run
+
+    for name, engine in [("batched", sort_intervals_batched), ("per_row", sort_intervals_indexed)]:
+        for interval_name, interval in [("black", BLACK_INTERVAL), ("whole", (None, None))]:
+            if engine is sort_intervals_indexed and interval_name == "whole":
+                continue
+            yield f"sort {interval_name} {name}", sort(engine, interval, False), sort(engine, interval, True)
+    yield "mountains vectorized", mountains("vectorized", "left"), mountains("vectorized", "up")
+    yield "shift checkerboard", checkerboard(False), checkerboard(True)
+
+
+def parity_image(label, image, repeat):
+    """ Runs every --parity benchmark on image, timing each row function on the transpose of image against its column
+    function on image, so both process the same lines. Also checks that both produce the same (transposed) output.
+
+    :param label:   The name of the image, used to identify its results.
+    :param image:   The image to benchmark on.
+    :param repeat:  Number of times to run each benchmark. The fastest run is reported.
+    :return:        A list of dictionaries, holding the results of each benchmark.
+    """
+    transposed_image = np.ascontiguousarray(image.swapaxes(0, 1))
+    results = []
+    for name, rows, columns in parity_cases():
+        row_time, row_output = time_call(rows, transposed_image, repeat)
+        column_time, column_output = time_call(columns, image, repeat)
+        result = {"image": label, "shape": list(image.shape), "benchmark": f"parity {name}", "row_seconds": row_time,
+                  "column_seconds": column_time, "ratio": column_time / max(row_time, 1e-9),
+                  "identical": np.array_equal(row_output.swapaxes(0, 1), column_output)}
+        print(f"{label:>12} {name:<36} rows: {row_time:8.4f}s columns: {column_time:8.4f}s "
+              f"ratio: {result['ratio']:5.2f} identical: {result['identical']}")
+        results.append(result)
+    return results
+
+
+CASES = {
+    "sort": sort_cases,
+    "mountains": mountain_cases,
+    "shift": shift_cases,
+    "reshape": reshape_cases,
+    "stream": stream_cases,
+    "records": record_cases,
+    "segments": segment_cases,
+}
+
+
+def benchmark_image(label, image, repeat, effects, memory=False, golden=None, skip_reference=False):
+    """ Runs every benchmark for each of effects on image, printing the time taken by each implementation, and if memory
+    is True, the peak memory allocated by each.
+
+    :param label:           The name of the image, used to identify its results and golden hashes.
+    :param image:           The image to benchmark on.
+    :param repeat:          Number of times to run each benchmark. The fastest run is reported.
+    :param effects:         The keys of CASES to benchmark.
+    :param memory:          If True, also measures the peak memory allocated by each implementation.
+    :param golden:          A dictionary of the hashes of the reference outputs, keyed by "label: benchmark name".
+                            Outputs are checked against it if given.
+    :param skip_reference:  If True, only runs the optimized implementations.
+    :return:                A list of dictionaries, holding the results of each benchmark.
+    """
+    from itertools import chain
+
+    results = []
+    for name, reference, optimized in chain.from_iterable(CASES[effect]() for effect in effects):
+        result = {"image": label, "shape": list(image.shape), "benchmark": name}
+        optimized_time, optimized_output = time_call(optimized, image, repeat)
+        result["optimized_seconds"] = optimized_time
+        result["optimized_hash"] = output_hash(optimized_output)
+        line = f"{label:>12} {name:<36} "
+        if not skip_reference:
+            reference_time, reference_output = time_call(reference, image, repeat)
+            result["reference_seconds"] = reference_time
+            result["reference_hash"] = output_hash(reference_output)
+            result["identical"] = np.array_equal(reference_output, optimized_output)
+            line += (f"reference: {reference_time:8.4f}s optimized: {optimized_time:8.4f}s "
+                     f"speedup: {reference_time / max(optimized_time, 1e-9):7.1f}x identical: {result['identical']}")
+        else:
+            line += f"optimized: {optimized_time:8.4f}s"
+
+        golden_hash = (golden or {}).get(f"{label}: {name}")
+        if golden_hash is not None:
+            result["matches_golden"] = golden_hash == result["optimized_hash"] and \
+                golden_hash == result.get("reference_hash", golden_hash)
+            line += f" golden: {result['matches_golden']}"
+
+        if memory:
+            result["optimized_peak_bytes"] = peak_memory(optimized, image)
+            line += " peak"
+            if not skip_reference:
+                result["reference_peak_bytes"] = peak_memory(reference, image)
+                line += f" reference: {result['reference_peak_bytes'] / 2 ** 20:8.1f}MiB"
+            line += f" optimized: {result['optimized_peak_bytes'] / 2 ** 20:8.1f}MiB"
+        print(line)
+        results.append(result)
+    return results
+
+
+def main(argv=None, prog=None):
+    """ Program runner: parses the arguments, runs the benchmarks, and writes or checks the golden hashes."""
+    import json
+    import os
+    import platform
+
+    args = parse_args(argv, prog)
+    golden = {}
+    if args.golden is not None and os.path.exists(args.golden):
+        with open(args.golden) as golden_file:
+            golden = json.load(golden_file)
+
+    images = []
+    suffix = "" if args.channels == 3 else f"x{args.channels}"
+    for size in SUITE_SIZES if args.suite else args.sizes:
+        images.append((f"{size}x{size}{suffix}", lambda size=size: synthetic_image(size)))
+        images.append((f"edge {size}{suffix}", lambda size=size: edge_case_image(size)))
+
+    results = []
+    check = None if args.update_golden else golden
+    for label, make_image in images:
+        if args.parity:
+            results += parity_image(label, with_channels(make_image(), args.channels), args.repeat)
+        else:
+            results += benchmark_image(label, with_channels(make_image(), args.channels), args.repeat, args.effects,
+                                       args.memory, check, args.skip_reference)
+    for file_name in args.files:
+        if args.parity:
+            results += parity_image(file_name, load_pixels(file_name), args.repeat)
+        else:
+            results += benchmark_image(file_name, load_pixels(file_name), args.repeat, args.effects, args.memory,
+                                       check, args.skip_reference)
+
+    if args.update_golden:
+        golden.update({f"{result['image']}: {result['benchmark']}": result["reference_hash"] for result in results})
+        with open(args.golden, "w") as golden_file:
+            json.dump(golden, golden_file, indent=2, sort_keys=True)
+
+    if args.json is not None:
+        environment = {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+                       "cpus": os.cpu_count(), "repeat": args.repeat}
+        with open(args.json, "w") as json_file:
+            json.dump({"environment": environment, "results": results}, json_file, indent=2)
+
+    failures = [result for result in results
+                if result.get("identical") is False or result.get("matches_golden") is False]
+    if failures:
+        print(f"{len(failures)} benchmark(s) did not match.")
+        raise SystemExit(1)
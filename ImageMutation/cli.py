@@ -0,0 +1,48 @@
+"""
+The imagemutation command, which runs each script as a subcommand, eg.
+
+    imagemutation sort --files image.png --mode 0
+    imagemutation pipeline --files image.png --pipeline "sort:mode=0 | shift"
+
+The options of a subcommand are the ones its script takes. Only the script of the chosen subcommand is imported, once
+the subcommand is known, so numpy and PIL are not loaded at all to print this help, and each subcommand only loads the
+modules it uses. Also run as python -m ImageMutation. The modules of the package can not be run as scripts on their
+own: each script's main(argv, prog) is only called from here.
+"""
+
+# The script implementing each subcommand, and a summary of it. Each script provides main(argv).
+COMMANDS = {
+    "sort": ("sort_pixels", "Sorts the pixels of intervals of each row and column."),
+    "mountains": ("mountains", "Raises each pixel into a mountain, by its weight."),
+    "shift": ("shift_pixels", "Shifts alternating bands of rows and columns."),
+    "reshape": ("reshape_image", "Rearranges the pixels into an image of a different shape."),
+    "pipeline": ("pipeline", "Applies several effects back to back."),
+    "frames": ("frames", "Applies a pipeline to every frame of an animation or video."),
+    "preview": ("preview", "Previews a pipeline, or a sweep of its parameters, on a downscaled image."),
+    "serve": ("service", "Serves the effects over HTTP."),
+    "cache": ("result_cache", "Prints the statistics of a cache of results."),
+    "benchmark": ("benchmark", "Times the optimized engines against the reference ones."),
+}
+
+
+def parse_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="imagemutation", formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands:\n" + "\n".join(f"  {name:<12} {summary}" for name, (_, summary) in COMMANDS.items()) +
+               "\n\nRun imagemutation COMMAND --help for the options of a command.")
+    parser.add_argument("command", choices=COMMANDS, metavar="COMMAND",
+                        help="The command to run, from the list below.")
+    parser.add_argument("arguments", nargs=argparse.REMAINDER,
+                        help="The options of the command.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """ Program runner: parses the subcommand, then imports and runs its script with the remaining arguments."""
+    import importlib
+
+    args = parse_args(argv)
+    # The script's own usage messages are prefixed with the subcommand.
+    importlib.import_module(f".{COMMANDS[args.command][0]}", __package__).main(args.arguments,
+                                                                               f"imagemutation {args.command}")
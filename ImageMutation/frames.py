@@ -0,0 +1,255 @@
+import numpy as np
+from .interval_index import IntervalIndex
+from .sort_keys import KEY_CACHE
+from .batch_runner import add_batch_arguments, run_ordered
+from .pipeline import EFFECTS, parse_pipeline, effect_module
+from .profiling import add_profile_arguments, Profiler, reset_output
+
+"""
+Applies a pipeline (see pipeline.py) to every frame of an animation or video. Frames are read one at a time, processed
+by a bounded pool of workers, and written back out in their original order, so only a handful of frames are in memory
+at any time, however long the input is (animated files are still held whole while they are encoded - see save_frames).
+
+Animated GIF, APNG and WebP files (or any other multi-frame format PIL supports) are read and written through PIL, eg.
+
+    imagemutation frames --files animation.gif --pipeline "sort:mode=0" --jobs 4
+
+Videos are read as raw RGB frames from standard input, and written as raw RGB frames to standard output, eg. with
+ffmpeg
+
+    ffmpeg -i video.mp4 -f rawvideo -pix_fmt rgb24 - | imagemutation frames --raw 1920x1080 --pipeline "sort:mode=0" |
+        ffmpeg -f rawvideo -pix_fmt rgb24 -s 1920x1080 -r 30 -i - output.mp4
+"""
+
+# For each sort stage of the sequence of frames being processed, the key map and IntervalIndex of the last frame whose
+# intervals were built from scratch, keyed by (sequence, stage). Held per process, so frames processed by the same
+# worker can reuse each other's intervals.
+_REFERENCES = {}
+
+
+def parse_args(argv=None, prog=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--files", "-f", dest="files", default=[], nargs="+",
+                        help="Animated file(s) to apply the pipeline to. Can be any multi-frame format supported by "
+                             "PIL, eg. GIF, APNG or WebP.")
+    parser.add_argument("--pipeline", "-p", dest="pipeline", required=True,
+                        help="The effects to apply to each frame, in order, eg. \"sort:mode=0 | shift\". "
+                             f"Effects are: {', '.join(EFFECTS)}.")
+    parser.add_argument("--raw", dest="raw", default=None,
+                        help="Read raw RGB frames of the given size (eg. 1920x1080) from standard input, and write the "
+                             "processed frames to standard output, rather than processing --files.")
+    parser.add_argument("--frames_per_task", dest="frames_per_task", default=1, type=int,
+                        help="Number of consecutive frames sent to a worker at once.")
+    parser.add_argument("--reuse_intervals", dest="reuse_intervals", default=None, type=float,
+                        help="Reuse the sort intervals of an earlier frame when the mean difference between its key "
+                             "map and the current frame's is at most this value (out of 255). Faster, and steadier "
+                             "between frames, but intervals may be slightly off. Reuse only happens between frames "
+                             "processed by the same worker, so use it with --jobs 1 or --frames_per_task.")
+    add_batch_arguments(parser)
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(argv)
+    if args.raw is not None:
+        try:
+            args.raw = tuple(int(size) for size in args.raw.lower().split("x"))
+        except ValueError:
+            args.raw = ()
+        if len(args.raw) != 2 or min(args.raw) < 1:
+            parser.error("--raw must be given as WIDTHxHEIGHT, eg. 1920x1080.")
+    elif not args.files:
+        parser.error("one of --files or --raw is required.")
+    try:
+        args.stages = parse_pipeline(args.pipeline)
+    except ValueError as e:
+        parser.error(str(e))
+    if any(effect == "reshape" for _, effect, _ in args.stages):
+        parser.error("reshape can not be applied to frames, as every frame must keep its size.")
+    return args
+
+
+def read_frames(file_name):
+    """ Reads the frames of an animated file one at a time.
+
+    :param file_name:   The file to read.
+    :return:            Yields each frame as a rows x cols x channels array. Frames with transparency are RGBA, and
+                        other frames are RGB.
+    """
+    from PIL import Image, ImageSequence
+
+    with Image.open(file_name) as img:
+        mode = "RGBA" if "transparency" in img.info or img.mode in ("RGBA", "LA", "PA") else "RGB"
+        for frame in ImageSequence.Iterator(img):
+            yield np.array(frame.convert(mode))
+
+
+def frame_durations(file_name):
+    """ Returns the display time of each frame of an animated file, in milliseconds. """
+    from PIL import Image, ImageSequence
+
+    with Image.open(file_name) as img:
+        return [frame.info.get("duration", img.info.get("duration", 100)) for frame in ImageSequence.Iterator(img)]
+
+
+def save_frames(frames, output_name, durations, loop=0):
+    """ Saves frames as an animated file, in the format given by the extension of output_name.
+
+    PIL reads the frames more than once while saving, so they are all held in memory until the file is written. Use
+    raw frames (see write_raw_frames) for videos too long for that.
+
+    :param frames:      An iterable of rows x cols x channels arrays.
+    :param output_name: The file to write.
+    :param durations:   The display time of each frame, in milliseconds.
+    :param loop:        Number of times to loop the animation, with 0 looping forever.
+    :return:            Nothing.
+    """
+    from PIL import Image
+
+    frames = [Image.fromarray(frame) for frame in frames]
+    frames[0].save(output_name, save_all=True, append_images=frames[1:], duration=durations, loop=loop)
+
+
+def read_raw_frames(stream, width, height, channels=3):
+    """ Reads raw frames (eg. from ffmpeg -f rawvideo -pix_fmt rgb24) from a binary stream until it ends.
+
+    :param stream:      The stream to read.
+    :param width:       Width of each frame, in pixels.
+    :param height:      Height of each frame, in pixels.
+    :param channels:    Number of bytes per pixel.
+    :return:            Yields each frame as a height x width x channels array.
+    """
+    frame_bytes = width * height * channels
+    while True:
+        frame = bytearray(frame_bytes)
+        view = memoryview(frame)
+        read = 0
+        while read < frame_bytes:
+            count = stream.readinto(view[read:])
+            if not count:
+                break
+            read += count
+        if read == 0:
+            return
+        if read < frame_bytes:
+            raise ValueError(f"The input ended part way through a frame ({read} of {frame_bytes} bytes).")
+        yield np.frombuffer(frame, dtype=np.uint8).reshape(height, width, channels)
+
+
+def write_raw_frames(frames, stream):
+    """ Writes each frame in frames to a binary stream as raw bytes, and returns the number of frames written. """
+    count = 0
+    for frame in frames:
+        stream.write(np.ascontiguousarray(frame).data)
+        count += 1
+    stream.flush()
+    return count
+
+
+def reused_index(sequence, stage, key_map, threshold):
+    """ Returns an IntervalIndex over key_map for a sort stage. It is seeded with the intervals of the previous frame
+    of the same sequence this process sorted in that stage, if that frame's key map differs from key_map by at most
+    threshold on average. Otherwise key_map becomes the reference for later frames.
+
+    :param sequence:    Identifies the sequence of frames (eg. the file) key_map belongs to. Frames of other sequences
+                        are never reused, and their references are dropped once a new sequence starts.
+
+    :param stage:       The index of the sort stage in the pipeline.
+    :param key_map:     The key map of the frame, as sorted by the stage.
+    :param threshold:   The largest mean absolute difference between key maps for which intervals are reused.
+    :return:            An IntervalIndex over key_map.
+    """
+    if not any(key[0] == sequence for key in _REFERENCES):
+        _REFERENCES.clear()
+    reference = _REFERENCES.get((sequence, stage))
+    if reference is None or reference[0].shape != key_map.shape or \
+            np.mean(np.abs(reference[0].astype(np.int16) - key_map)) > threshold:
+        # Copied, as key_map itself is sorted along with the frame.
+        reference_map = key_map.copy()
+        reference = _REFERENCES[sequence, stage] = (reference_map, IntervalIndex(reference_map))
+    return reference[1].seeded(key_map)
+
+
+def process_frame(stages, reuse_threshold, pixels, sequence=None):
+    """ Applies each stage of a pipeline to a single frame, and returns the result.
+
+    :param stages:          The stages to apply, as returned by parse_pipeline.
+    :param reuse_threshold: If not None, sort stages reuse the intervals of similar frames (see reused_index).
+    :param pixels:          The frame. It may be modified in place.
+    :param sequence:        Identifies the sequence of frames pixels belongs to, for reused_index.
+    :return:                The processed frame.
+    """
+    if not pixels.flags.writeable:
+        pixels = pixels.copy()
+    for stage, (_, effect, args) in enumerate(stages):
+        process_pixels = effect_module(effect).process_pixels
+        if effect == "sort" and reuse_threshold is not None:
+            interval_index = reused_index(sequence, stage, KEY_CACHE.get(pixels, args.key), reuse_threshold)
+            pixels = process_pixels(args, pixels, interval_index, key_cache=KEY_CACHE)
+        else:
+            pixels = process_pixels(args, pixels, key_cache=KEY_CACHE)
+    return pixels
+
+
+def process_frames(stages, reuse_threshold, profile, profile_memory, sequence, frames):
+    """ Applies process_frame to each of a list of consecutive (frame number, frame) pairs of sequence, in order, and
+    returns the results. If profile is given, the profile of each frame is recorded to it, including its peak memory if
+    profile_memory is True. """
+    from contextlib import nullcontext
+
+    processed = []
+    for number, pixels in frames:
+        with Profiler(profile, memory=profile_memory).image(f"frame {number}") if profile else nullcontext():
+            processed.append(process_frame(stages, reuse_threshold, pixels, sequence))
+    return processed
+
+
+def map_frames(args, frames):
+    """ Processes frames as specified by args, on up to args.jobs workers.
+
+    :param args:    The parsed arguments.
+    :param frames:  An iterable of frames. It is consumed lazily, as workers become free.
+    :return:        Yields each processed frame, in the same order as frames.
+    """
+    import uuid
+    from functools import partial
+    from itertools import islice
+
+    if args.profile is not None:
+        reset_output(args.profile)
+    frames = enumerate(frames)
+    tasks = iter(lambda: list(islice(frames, max(args.frames_per_task, 1))), [])
+    # Each call processes its own sequence, so intervals are never reused from the frames of another file.
+    sequence = uuid.uuid4().hex
+    for processed in run_ordered(partial(process_frames, args.stages, args.reuse_intervals, args.profile,
+                                         args.profile_memory, sequence), tasks, args.jobs, args.max_in_flight):
+        yield from processed
+
+
+def process_file(args, file_name):
+    """ Applies the pipeline to every frame of a single animated file, and returns the name of the new file. """
+    import os
+
+    output_name = f"{os.path.splitext(file_name)[0]}_frames{os.path.splitext(file_name)[-1]}"
+    save_frames(map_frames(args, read_frames(file_name)), output_name, frame_durations(file_name))
+    return output_name
+
+
+def main(argv=None, prog=None):
+    """ Program runner: parses the arguments and produces the appropriate frames."""
+    import os
+    import sys
+
+    args = parse_args(argv, prog)
+    if args.raw is not None:
+        # Standard output carries the frames, so anything the effects print (in this process or a worker) is sent to
+        # standard error instead.
+        output = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+        sys.stdout.flush()
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        width, height = args.raw
+        with output:
+            write_raw_frames(map_frames(args, read_raw_frames(sys.stdin.buffer, width, height)), output)
+        return
+
+    for file_name in args.files:
+        print(f"Wrote {process_file(args, file_name)}")
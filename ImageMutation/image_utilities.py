@@ -1,33 +1,128 @@
 import numpy as np
+from .profiling import stage
+from contextlib import contextmanager
 
 
 def brightness(pixels):
     """ Returns a matrix for which each entry represents the brightness of the same entry in pixels.
 
-    :param pixels:  A row x col x 3 matrix representing an image.
-    :return:        A row x col x 1 matrix where each entry is the maximum of the three values for the corresponding
-                    pixel.
+    :param pixels:  A row x col x channels matrix representing an image. Images with 3 or more channels are treated as
+                    RGB (with alpha, if there is a 4th channel), and images with fewer as greyscale.
+    :return:        A row x col matrix where each entry is the maximum of the three colour values for the
+                    corresponding pixel, or its grey level.
     """
+    if pixels.shape[2] < 3:
+        return np.copy(pixels[:, :, 0])
     return np.maximum(np.maximum(pixels[:, :, 0], pixels[:, :, 1]), pixels[:, :, 2])
 
 
-def select_random_rows(rows):
-    """ Will randomly select sequential rows. """
+def pixel_records(pixels):
+    """ Returns a view of pixels (a ... x channels array) with a single record for each pixel, so a pixel can be moved
+    with one element copy, whatever the number of channels. The channel axis of pixels must be contiguous (see
+    contiguous_channels), but the other axes may be strided (eg. a column, or a reversed row), as numpy allows since
+    1.23. Records are views, so writing to them writes to pixels.
+
+    :param pixels:  The array to view.
+    :return:        An array of np.void records, with the shape of pixels without its last axis.
+    """
+    return pixels.view(np.dtype((np.void, pixels.shape[-1] * pixels.itemsize)))[..., 0]
+
+
+def _channels_contiguous(pixels):
+    return pixels.shape[-1] == 1 or pixels.strides[-1] == pixels.itemsize
+
+
+@contextmanager
+def contiguous_channels(pixels):
+    """ Yields pixels, if its channel axis is contiguous, so it can be viewed with pixel_records. Otherwise (eg. for a
+    BGR view, pixels[..., ::-1]) yields a copy which is, and writes the copy back to pixels once the context exits.
+
+    :param pixels:  A ... x channels array, which may be modified in place.
+    :return:        Yields pixels, or its copy.
+    """
+    if _channels_contiguous(pixels):
+        yield pixels
+        return
+    copy = np.ascontiguousarray(pixels)
+    yield copy
+    pixels[...] = copy
+
+
+# Approximate size of the square tiles copied at once by transpose_pixels, in bytes. A source and target tile fit in
+# the L1 cache.
+TRANSPOSE_TILE_BYTES = 2 ** 15
+
+
+def transpose_pixels(pixels, out=None):
+    """ Swaps the rows and columns of pixels, one square tile at a time. Within a tile, both the reads and the writes
+    stay in cache, so this is several times faster than np.ascontiguousarray(pixels.swapaxes(0, 1)) on large images,
+    where every read of a column misses the cache.
+
+    :param pixels:  A rows x cols array (eg. a key map), or a rows x cols x channels array. Each pixel is moved as a
+                    single record.
+    :param out:     A cols x rows (x channels) array to write the result to. A new array is allocated if not given.
+    :return:        out, or the new array.
+    """
+    if out is None:
+        out = np.empty((pixels.shape[1], pixels.shape[0]) + pixels.shape[2:], dtype=pixels.dtype)
+    with stage("transpose"):
+        if pixels.ndim == 3:
+            with contiguous_channels(out) as target:
+                _transpose_tiles(pixels if _channels_contiguous(pixels) else np.ascontiguousarray(pixels), target)
+        else:
+            _transpose_tiles(pixels, out)
+    return out
+
+
+def _transpose_tiles(pixels, out):
+    """ Writes pixels transposed into out, for transpose_pixels. """
+    import math
+
+    rows, cols = pixels.shape[:2]
+    source, target = (pixel_records(pixels), pixel_records(out)) if pixels.ndim == 3 else (pixels, out)
+    # The largest power of two side whose tile fits in TRANSPOSE_TILE_BYTES.
+    tile = 1 << max(0, math.isqrt(TRANSPOSE_TILE_BYTES // source.itemsize).bit_length() - 1)
+    for top in range(0, rows, tile):
+        for left in range(0, cols, tile):
+            target[left:left + tile, top:top + tile] = source[top:top + tile, left:left + tile].T
+
+
+@contextmanager
+def transposed(*arrays):
+    """ Yields a transposed copy (see transpose_pixels) of each of arrays, so their columns can be processed as rows,
+    which are contiguous in memory. Once the context exits, each copy is transposed back into its array.
+
+    :param arrays:  rows x cols (x channels) arrays, which are modified in place.
+    :return:        Yields a list of the transposed copies.
+    """
+    copies = [transpose_pixels(array) for array in arrays]
+    yield copies
+    for array, copy in zip(arrays, copies):
+        transpose_pixels(copy, out=array)
+
+
+def select_random_rows(rows, rng=None):
+    """ Will randomly select sequential rows. If provided, rng (a random.Random instance) is used to select rows, which
+    allows the selection to be reproduced by seeding it. """
     import random
+    if rng is None:
+        rng = random
     start = 0
     while start != rows:
-        start = random.randint(start, rows - 1) + 1
+        start = rng.randint(start, rows - 1) + 1
         yield start - 1
 
 
 def ranges(size, max_val, start=0):
     """ Produces a series of intervals of length size, skipping size elements, which end at max_val.
 
-    :param size:        Size of each range (or interval)
+    :param size:        Size of each range (or interval). Must be positive.
     :param start:       The starting interval.
     :param max_val:     The maximum value the intervals will go to.
     :return:            Each value in the covered intervals.
     """
+    if size <= 0:
+        raise ValueError(f"ranges requires a positive size, not {size}.")
 
     not_done = True
     while not_done:
@@ -36,4 +131,301 @@ def ranges(size, max_val, start=0):
             yield i
         start += 2 * size
         if start >= max_val:
-            not_done = False
\ No newline at end of file
+            not_done = False
+
+
+def demo_image(name):
+    """ Returns the path of one of the demo images, which the scripts process by default. They are only present in a
+    checkout of the repository. """
+    import os
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "demo", name)
+
+
+# Default size of the strips held in memory when streaming an image, in bytes.
+STRIP_BYTES = 2 ** 26
+
+
+def add_stream_arguments(parser):
+    """ Adds the --stream, --strip_budget and --temp_dir arguments to parser. """
+    parser.add_argument("--stream", action="store_true",
+                        help="Processes the image strip by strip through files on disk, rather than in memory. For "
+                             "images larger than RAM.")
+    parser.add_argument("--strip_budget", dest="strip_budget", default=STRIP_BYTES // 2 ** 20, type=int,
+                        help="With --stream, the approximate size of each strip held in memory, in MiB.")
+    parser.add_argument("--temp_dir", dest="temp_dir", default=None,
+                        help="With --stream, the directory to keep intermediate files in. Defaults to the system's "
+                             "temporary directory.")
+
+
+def strip_lines(line_bytes, strip_bytes=STRIP_BYTES):
+    """ Returns the number of lines of line_bytes bytes which fit in a strip of strip_bytes bytes (at least 1). """
+    return max(1, strip_bytes // max(line_bytes, 1))
+
+
+def load_pixels(file_name, strip_bytes=STRIP_BYTES):
+    """ Decodes file_name into a writable rows x cols x channels array. Greyscale images have a single channel. Pixels
+    are copied out of the decoded image a strip at a time, so at most one full copy of the image exists besides PIL's
+    own, which is released on return.
+
+    :param file_name:   The image to load. Can be any format supported by PIL.
+    :param strip_bytes: The approximate size of each strip copied.
+    :return:            The pixels of the image.
+    """
+    from PIL import Image
+
+    with stage("decode"), Image.open(file_name) as img:
+        width, height = img.size
+        first_row = np.asarray(img.crop((0, 0, width, 1))).reshape(width, -1)
+        pixels = np.empty((height,) + first_row.shape, dtype=first_row.dtype)
+        step = strip_lines(first_row.nbytes, strip_bytes)
+        for top in range(0, height, step):
+            strip = pixels[top:top + step]
+            strip[...] = np.asarray(img.crop((0, top, width, min(top + step, height)))).reshape(strip.shape)
+    return pixels
+
+
+def save_pixels(pixels, file_name, image_format=None):
+    """ Saves a rows x cols x channels array (as produced by load_pixels) as file_name, which may also be a file object.
+    The format is image_format (eg. "PNG") if given, and otherwise follows the extension of file_name. """
+    from PIL import Image
+
+    with stage("encode"):
+        Image.fromarray(pixels[:, :, 0] if pixels.shape[2] == 1 else pixels).save(file_name, format=image_format)
+
+
+# The number of channels of each image mode whose pixels may be mapped straight from (or to) an uncompressed file.
+RAW_MODES = {"L": 1, "LA": 2, "RGB": 3, "RGBA": 4}
+
+
+def _raw_offset(img):
+    """ Returns the offset of img's pixels within its file if they are stored as uncompressed 8 bit rows (of one of
+    RAW_MODES), in order and without gaps (eg. uncompressed TIFF or PPM), or None otherwise. """
+    width, height = img.size
+    if img.mode not in RAW_MODES or not img.tile:
+        return None
+    row_bytes = width * RAW_MODES[img.mode]
+
+    first_offset = img.tile[0][2]
+    next_top = 0
+    for codec, (left, top, right, bottom), offset, args in sorted(img.tile, key=lambda tile: tile[1][1]):
+        rawmode, stride, orientation = (args, 0, 1) if isinstance(args, str) else (tuple(args) + (0, 1))[:3]
+        if (codec != "raw" or rawmode != img.mode or stride not in (0, row_bytes) or orientation != 1
+                or (left, right, top) != (0, width, next_top) or offset != first_offset + top * row_bytes):
+            return None
+        next_top = bottom
+    return first_offset if next_top == height else None
+
+
+def open_pixels(file_name, work_dir, strip_bytes=STRIP_BYTES):
+    """ Returns a memory mapped, rows x cols x channels array of the pixels of file_name, which should not be modified.
+    Pixels are as load_pixels returns them: the image's mode (and so its channels, eg. alpha) is kept.
+
+    .npy files, and images stored as uncompressed 8 bit rows (eg. TIFF or PPM) are mapped directly. Any other image is
+    decoded by PIL and copied into a file in work_dir a strip at a time. Note that PIL decodes compressed formats in
+    full, so these still briefly need the whole image in memory.
+
+    :param file_name:   The image to open.
+    :param work_dir:    A directory for the decoded pixels, if they need to be decoded.
+    :param strip_bytes: The approximate size of each strip copied.
+    :return:            A np.memmap of the pixels.
+    """
+    import os
+    from PIL import Image
+
+    if os.path.splitext(file_name)[-1].lower() == ".npy":
+        pixels = np.load(file_name, mmap_mode="r")
+        return pixels.reshape(pixels.shape[0], pixels.shape[1], -1)
+
+    with Image.open(file_name) as img:
+        width, height = img.size
+        offset = _raw_offset(img)
+        if offset is not None:
+            return np.memmap(file_name, dtype=np.uint8, mode="r", offset=offset,
+                             shape=(height, width, RAW_MODES[img.mode]))
+
+        first_row = np.asarray(img.crop((0, 0, width, 1))).reshape(width, -1)
+        pixels = np.memmap(os.path.join(work_dir, "decoded.raw"), dtype=first_row.dtype, mode="w+",
+                           shape=(height,) + first_row.shape)
+        step = strip_lines(first_row.nbytes, strip_bytes)
+        for top in range(0, height, step):
+            strip = pixels[top:top + step]
+            strip[...] = np.asarray(img.crop((0, top, width, min(top + step, height)))).reshape(strip.shape)
+        pixels.flush()
+    return pixels
+
+
+def _tiff_header(rows, cols, channels=3):
+    """ Returns the header of an uncompressed, single strip 8 bit TIFF file of 1 (greyscale), 2 (greyscale and alpha),
+    3 (RGB) or 4 (RGBA) channels, which is followed by the pixels. """
+    import struct
+
+    entry_count = 11 if channels in (2, 4) else 10
+    # Up to two bits per sample fit in the entry itself. Any more are stored after the entries.
+    bits_offset = 8 + 2 + entry_count * 12 + 4
+    header_bytes = bits_offset + (2 * channels if channels > 2 else 0)
+    bits = sum(8 << (16 * i) for i in range(channels)) if channels <= 2 else bits_offset
+    entries = [
+        (256, 4, 1, cols),                          # ImageWidth
+        (257, 4, 1, rows),                          # ImageLength
+        (258, 3, channels, bits),                   # BitsPerSample
+        (259, 3, 1, 1),                             # Compression: none
+        (262, 3, 1, 2 if channels >= 3 else 1),     # PhotometricInterpretation: RGB, or BlackIsZero
+        (273, 4, 1, header_bytes),                  # StripOffsets
+        (277, 3, 1, channels),                      # SamplesPerPixel
+        (278, 4, 1, rows),                          # RowsPerStrip
+        (279, 4, 1, rows * cols * channels),        # StripByteCounts
+        (284, 3, 1, 1),                             # PlanarConfiguration: contiguous
+    ]
+    if channels in (2, 4):
+        entries.append((338, 3, 1, 2))              # ExtraSamples: unassociated alpha
+    return (b"II*\x00" + struct.pack("<IH", 8, len(entries))
+            + b"".join(struct.pack("<HHII", *entry) for entry in entries)
+            + struct.pack("<I", 0) + (struct.pack(f"<{channels}H", *[8] * channels) if channels > 2 else b""))
+
+
+@contextmanager
+def pixels_writer(output_name, shape, work_dir, dtype=np.uint8):
+    """ Yields a writable, memory mapped array of shape (rows x cols x channels), which is saved as output_name once
+    the context exits.
+
+    .npy files, 8 bit .tif/.tiff files, and 8 bit greyscale or RGB .ppm files are mapped directly, so the output is
+    written as the array is filled in. Other formats are encoded by PIL (as save_pixels does) from a file in work_dir,
+    which needs the whole image in memory.
+
+    :param output_name: The file to write.
+    :param shape:       The shape of the image.
+    :param work_dir:    A directory to keep the pixels in, if output_name can not be mapped directly.
+    :param dtype:       The type of the pixels, eg. as returned by open_pixels.
+    """
+    import os
+
+    rows, cols, channels = shape
+    extension = os.path.splitext(output_name)[-1].lower()
+    mapped = extension == ".npy" or np.dtype(dtype) == np.uint8 and (
+        extension in (".tif", ".tiff") and channels in RAW_MODES.values() or extension == ".ppm" and channels in (1, 3))
+    if extension == ".npy":
+        pixels = np.lib.format.open_memmap(output_name, mode="w+", dtype=dtype, shape=shape)
+    elif mapped:
+        if extension == ".ppm":
+            header = f"P{5 if channels == 1 else 6}\n{cols} {rows}\n255\n".encode()
+        else:
+            header = _tiff_header(rows, cols, channels)
+        if extension != ".ppm" and len(header) + rows * cols * channels >= 2 ** 32:
+            raise ValueError(f"{output_name}: images of 4GiB or more can not be streamed to TIFF. Use .npy instead.")
+        with open(output_name, "wb") as output:
+            output.write(header)
+            output.truncate(len(header) + rows * cols * channels)
+        pixels = np.memmap(output_name, dtype=np.uint8, mode="r+", offset=len(header), shape=shape)
+    else:
+        pixels = np.memmap(os.path.join(work_dir, "output.raw"), dtype=dtype, mode="w+", shape=shape)
+
+    yield pixels
+
+    pixels.flush()
+    if not mapped:
+        save_pixels(np.asarray(pixels), output_name)
+
+
+def transpose_on_disk(source, target, strip_bytes=STRIP_BYTES):
+    """ Copies source into target with its rows and columns swapped, a square tile of about strip_bytes bytes at a
+    time, so memory use does not depend on the size of the image. Each tile is transposed as transpose_pixels does.
+
+    :param source:      A rows x cols x channels array, usually memory mapped.
+    :param target:      A memory mapped cols x rows x channels array.
+    :param strip_bytes: The approximate size of each tile.
+    :return:            Nothing.
+    """
+    import math
+
+    rows, cols = source.shape[:2]
+    tile = max(1, math.isqrt(strip_lines(source.itemsize * source[:1, :1].size, strip_bytes)))
+    with stage("transpose"):
+        for top in range(0, rows, tile):
+            for left in range(0, cols, tile):
+                _transpose_tiles(source[top:top + tile, left:left + tile], target[left:left + tile, top:top + tile])
+            target.flush()
+
+
+def stream_lines(source, target, fn, selected, strip_bytes=STRIP_BYTES):
+    """ Applies fn to the rows of source a strip at a time, and writes each strip to the same rows of target. Only one
+    strip is held in memory at once.
+
+    :param source:      A rows x cols x channels array, usually memory mapped. May be the same array as target.
+    :param target:      A memory mapped array with the same shape as source.
+    :param fn:          Called as fn(strip, local_selected), where strip is an in memory copy of a strip of rows, which
+                        fn modifies in place, and local_selected is an array of the selected rows in the strip
+                        (relative to its first row). Not called on strips without selected rows.
+    :param selected:    An iterable of the rows to process.
+    :param strip_bytes: The approximate size of each strip.
+    :return:            Nothing.
+    """
+    rows = source.shape[0]
+    selected = np.unique(np.fromiter(selected, dtype=np.intp))
+    step = strip_lines(source.nbytes // max(rows, 1), strip_bytes)
+    for top in range(0, rows, step):
+        bottom = min(top + step, rows)
+        local_selected = selected[np.searchsorted(selected, top):np.searchsorted(selected, bottom)] - top
+        if len(local_selected) == 0 and source is target:
+            continue
+        with stage("read strip"):
+            strip = np.array(source[top:bottom])
+        if len(local_selected) > 0:
+            with stage("process strip"):
+                fn(strip, local_selected)
+        with stage("write strip"):
+            target[top:bottom] = strip
+            target.flush()
+
+
+def stream_passes(file_name, output_name, passes, strip_bytes=STRIP_BYTES, temp_dir=None):
+    """ Applies a series of row and column passes to file_name, writing the result to output_name, with only one strip
+    of the image in memory at a time. Row passes read and write the image a strip of rows at a time. Column passes
+    first transpose the image into a file on disk, process its rows (the columns of the image) in strips, and
+    transpose it back.
+
+    See open_pixels and pixels_writer for the formats which can be read and written without holding the whole image in
+    memory. Intermediate files are about the size of the (uncompressed) image, and at most two exist at once.
+
+    :param file_name:   The image to process.
+    :param output_name: The file to write the result to.
+    :param passes:      A list of (columns, iterator, fn) tuples, applied in order. If columns is True, the pass is
+                        applied to the columns of the image, otherwise to its rows. iterator is called with the number
+                        of lines (columns or rows) in the image, and yields the lines to process (eg. range). fn is
+                        called on each strip of lines, as in stream_lines, with the lines as rows of the strip.
+    :param strip_bytes: The approximate size of each strip held in memory.
+    :param temp_dir:    The directory to keep intermediate files in. Defaults to the system's temporary directory.
+    :return:            Nothing.
+    """
+    import os
+    import tempfile
+
+    with tempfile.TemporaryDirectory(dir=temp_dir) as work_dir:
+        source = open_pixels(file_name, work_dir, strip_bytes)
+        rows, cols, channels = source.shape
+
+        def scratch(name, shape):
+            return np.memmap(os.path.join(work_dir, name), dtype=source.dtype, mode="w+", shape=shape)
+
+        with pixels_writer(output_name, source.shape, work_dir, source.dtype) as output:
+            current = source
+            transposed = None
+            for i, (columns, iterator, fn) in enumerate(passes):
+                if i == len(passes) - 1:
+                    target = output
+                elif current is source:
+                    target = scratch("pixels.raw", source.shape)
+                else:
+                    target = current
+
+                if columns:
+                    if transposed is None:
+                        transposed = scratch("transposed.raw", (cols, rows, channels))
+                    transpose_on_disk(current, transposed, strip_bytes)
+                    stream_lines(transposed, transposed, fn, iterator(cols), strip_bytes)
+                    transpose_on_disk(transposed, target, strip_bytes)
+                else:
+                    stream_lines(current, target, fn, iterator(rows), strip_bytes)
+                current = target
+
+            if not passes:
+                stream_lines(source, output, None, [], strip_bytes)
@@ -0,0 +1,226 @@
+import numpy as np
+from bisect import bisect_left
+from .image_utilities import transpose_pixels
+
+"""
+Precomputed interval boundaries. Rather than scanning the remainder of a row for every boundary (as the get_*_index
+functions in sort_pixels.py do), each thresholded map is reduced once per image to the positions where it changes value,
+so the next boundary in a row is a binary search away.
+
+Conditions are (comparator, value) pairs, eg. ("<=", 60) marks every pixel with a weight of at most 60. An interval
+starts on a pixel matching start and runs up to (but not including) the next pixel matching end. The quirks of sort_row
+are kept: a match at the very first position searched is treated as "not found", so a row which starts on a match for
+start is not sorted at all, and sorting stops if an interval ends on a match for start.
+"""
+
+COMPARATORS = {
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+
+COMPLEMENTS = {
+    "<": ">=",
+    "<=": ">",
+    ">": "<=",
+    ">=": "<",
+}
+
+
+def interval_mask(compressed_lines, condition):
+    """ Returns a boolean array marking each entry of compressed_lines which satisfies condition.
+
+    :param compressed_lines:    Array of pixel weights.
+    :param condition:           A (comparator, value) pair, where comparator is one of the keys of COMPARATORS.
+    :return:                    A boolean array with the same shape as compressed_lines.
+    """
+    comparator, value = condition
+    return COMPARATORS[comparator](compressed_lines, value)
+
+
+def complement(condition):
+    """ Returns the condition which is satisfied exactly when condition is not. """
+    comparator, value = condition
+    return COMPLEMENTS[comparator], value
+
+
+def implies(condition, other):
+    """ Returns True if every weight satisfying condition also satisfies other. """
+    (comparator, value), (other_comparator, other_value) = condition, other
+    if comparator[0] != other_comparator[0]:
+        return False
+    if value == other_value:
+        return comparator == other_comparator or len(other_comparator) == 2
+    return value < other_value if comparator[0] == "<" else value > other_value
+
+
+def next_position(positions, x, limit):
+    """ For each entry in x, returns the first entry of positions which is at least x, or limit if that entry does not
+    exist or is not less than limit. positions must be sorted. """
+    if len(positions) == 0:
+        return limit.copy()
+    k = np.searchsorted(positions, x)
+    candidates = positions[np.minimum(k, len(positions) - 1)]
+    return np.where((k < len(positions)) & (candidates < limit), candidates, limit)
+
+
+class RunIndex:
+    """ The runs of a lines x length boolean mask, stored as the (flattened) positions at which each run of True and
+    each run of False values starts. """
+
+    def __init__(self, mask):
+        lines, length = mask.shape
+        self.length = length
+        self.mask = mask.reshape(-1)
+
+        line_starts = np.arange(0, lines * length, length, dtype=np.intp)
+        if length > 1:
+            line, offset = np.divmod(np.flatnonzero(np.diff(mask, axis=1)), length - 1)
+            changes = line * length + offset + 1
+            edges = np.sort(np.concatenate((line_starts, changes)))
+        else:
+            edges = line_starts
+
+        run_values = self.mask[edges]
+        self.rising = edges[run_values]
+        self.falling = edges[~run_values]
+
+    def next_match(self, x, limit, polarity=True):
+        """ For each position in x, returns the first position at or after it (and before limit) where the mask is equal
+        to polarity, or limit if there is none. """
+        inside = x < limit
+        matches = np.zeros(len(x), dtype=bool)
+        matches[inside] = self.mask[x[inside]] == polarity
+        return np.where(matches, x, next_position(self.rising if polarity else self.falling, x, limit))
+
+    def line_runs(self, line):
+        """ Returns the row of the mask for the given line, and the offsets at which its runs of True and False values
+        start. """
+        line_start = line * self.length
+        line_end = line_start + self.length
+        rising = self.rising[np.searchsorted(self.rising, line_start):np.searchsorted(self.rising, line_end)]
+        falling = self.falling[np.searchsorted(self.falling, line_start):np.searchsorted(self.falling, line_end)]
+        return self.mask[line_start:line_end], (rising - line_start).tolist(), (falling - line_start).tolist()
+
+
+class IntervalIndex:
+    """ Lazily built run indices for the thresholded weights of an image, along its columns and rows. Each threshold is
+    only indexed once: a condition and its complement share a RunIndex. Sorting an interval which starts on a condition
+    and ends on its complement only reorders pixels within a run of that condition, so indices which cannot change
+    under that reordering are kept between passes. """
+
+    def __init__(self, compressed_image):
+        self.compressed_image = compressed_image
+        self._runs = {}
+        self._seed = None
+
+    def seeded(self, compressed_image):
+        """ Returns an IntervalIndex over compressed_image which, until it is first invalidated, uses the runs of this
+        index rather than building its own. For an image which is nearly identical to this index's image (eg. the next
+        frame of a video), this saves rebuilding the runs, at the cost of intervals which may be slightly off. """
+        index = IntervalIndex(compressed_image)
+        index._seed = self
+        return index
+
+    def runs(self, condition, columns):
+        """ Returns the RunIndex for condition along the columns (or rows) of the image, and the value of the mask
+        which satisfies condition. """
+        polarity = condition[0][0] == "<"
+        if not polarity:
+            condition = complement(condition)
+
+        key = (condition, columns)
+        if key not in self._runs and self._seed is not None:
+            self._runs[key] = self._seed.runs(condition, columns)[0]
+        if key not in self._runs:
+            weights = transpose_pixels(self.compressed_image) if columns else self.compressed_image
+            self._runs[key] = RunIndex(interval_mask(weights, condition))
+        return self._runs[key], polarity
+
+    def bounds(self, start, end, columns, selected):
+        """ Finds every interval to sort in each selected line, with all lines walked in lockstep.
+
+        :param start:       The condition which starts an interval.
+        :param end:         The condition which ends an interval.
+        :param columns:     If True, lines are the columns of the image. Otherwise, they are the rows.
+        :param selected:    The lines to find intervals in.
+        :return:            Two arrays, containing the start and (exclusive) end of each interval, as positions in the
+                            flattened array of selected lines.
+        """
+        start_runs, start_polarity = self.runs(start, columns)
+        end_runs, end_polarity = self.runs(end, columns)
+        length = start_runs.length
+
+        line_start = selected * length
+        line_end = line_start + length
+        shift = line_start - np.arange(len(selected), dtype=np.intp) * length
+
+        starts = []
+        ends = []
+
+        x_start = start_runs.next_match(line_start, line_end, start_polarity)
+        active = (x_start != line_start) & (x_start != line_end)
+        while np.any(active):
+            x_start, line_end, shift = x_start[active], line_end[active], shift[active]
+            x_end = end_runs.next_match(x_start, line_end, end_polarity)
+            x_end[x_end == x_start] = line_end[x_end == x_start]
+            starts.append(x_start - shift)
+            ends.append(x_end - shift)
+
+            x_start = start_runs.next_match(x_end, line_end, start_polarity)
+            active = (x_end != line_end) & (x_start != x_end) & (x_start != line_end)
+
+        if not starts:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        return np.concatenate(starts), np.concatenate(ends)
+
+    def line_intervals(self, start, end, columns, line):
+        """ Returns the (start, exclusive end) offsets of every interval to sort in a single line. """
+        start_runs, start_polarity = self.runs(start, columns)
+        end_runs, end_polarity = self.runs(end, columns)
+        start_mask, start_rising, start_falling = start_runs.line_runs(line)
+        end_mask, end_rising, end_falling = end_runs.line_runs(line)
+        start_edges = start_rising if start_polarity else start_falling
+        end_edges = end_rising if end_polarity else end_falling
+        length = len(start_mask)
+
+        def next_match(mask, edges, polarity, x):
+            if x >= length:
+                return length
+            if mask[x] == polarity:
+                return x
+            k = bisect_left(edges, x)
+            return edges[k] if k < len(edges) else length
+
+        intervals = []
+        x_start = next_match(start_mask, start_edges, start_polarity, 0)
+        if x_start == 0:
+            return intervals
+        while x_start != length:
+            x_end = next_match(end_mask, end_edges, end_polarity, x_start)
+            if x_end == x_start:
+                x_end = length
+            intervals.append((x_start, x_end))
+            if x_end == length:
+                break
+            x_start = next_match(start_mask, start_edges, start_polarity, x_end)
+            if x_start == x_end:
+                break
+        return intervals
+
+    def invalidate(self, start, end):
+        """ Discards every index which may have been changed by sorting the intervals from start to end (or entire
+        lines, if start is None). """
+        if self._seed is not None:
+            # Runs taken from the seed were never exact for this image, so they can not be kept.
+            self._seed = None
+            self._runs.clear()
+            return
+        if start is None or end != complement(start):
+            self._runs.clear()
+            return
+        for key in list(self._runs):
+            condition = key[0]
+            if not (implies(start, condition) or implies(start, complement(condition))):
+                del self._runs[key]
@@ -1,25 +1,39 @@
-from PIL import Image
 import numpy as np
-from image_utilities import brightness
+from .image_utilities import demo_image, pixel_records, contiguous_channels, load_pixels, save_pixels, \
+    add_stream_arguments, stream_passes, transpose_pixels, transposed
+from .sort_keys import KEYS, resolve_key
+from .batch_runner import add_batch_arguments, run_files
+from .result_cache import add_cache_arguments, result_cache
+from .strips import add_strip_arguments, strip_runner
+from .profiling import add_profile_arguments, stage
 
 
-def parse_args():
+def parse_args(argv=None, prog=None):
     import argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--files", "-f", default=["../demo/alexander-andrews--Bq3TeSBRdE-unsplash.jpg"],
-                        nargs="+",
-                        help="File(s) to apply a mountain effect to. Can be any format supported by PIL. ")
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--files", "-f", default=[demo_image("alexander-andrews--Bq3TeSBRdE-unsplash.jpg")],
+                        nargs="+", help="File(s) to apply a mountain effect to. Can be any format supported by PIL. ")
     parser.add_argument("--direction", "-d", dest="direction", type=str, default="up",
                         choices=["down", "up", "left", "right"],
                         help="Direction that mountains will go.")
+    parser.add_argument("--key", "-k", dest="key", default="brightness", choices=sorted(KEYS),
+                        help="The weight of each pixel, which determines its height.")
     parser.add_argument("--darkness", "--dark", dest="darkness", action="store_true",
                         help="Instead of using brightness (eg. height of maximum rgb value), will use darkness to "
-                             "determine height.")
+                             "determine height. Inverts --key, if it is given.")
+    parser.add_argument("--engine", default="vectorized", choices=["vectorized", "per_row"],
+                        help="vectorized: Applies the effect to every row or column at once.\n"
+                             "per_row: Applies the effect to each row or column separately.")
     # TODO: implement valleys.
     # parser.add_argument("--valleys", "-v", dest="valleys", action="store_true",
     #                     help="Instead of mountains, produces valleys.")
 
-    return parser.parse_args()
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_profile_arguments(parser)
+    add_strip_arguments(parser)
+    add_stream_arguments(parser)
+    return parser.parse_args(argv)
 
 
 def apply_mountain_effect_row(row, compressed_row):
@@ -30,16 +44,86 @@ def apply_mountain_effect_row(row, compressed_row):
     # view the image: for instance, if max_height = 0, then you're looking at the top pixel.
 
     for pix, height, i in zip(row[::-1], compressed_row[::-1], range(row_len - 1, -1, -1)):
-        top_pixel = max(0, i - height)
-        copy_row[top_pixel:max_height, 0] = pix[0]
-        copy_row[top_pixel:max_height, 1] = pix[1]
-        copy_row[top_pixel:max_height, 2] = pix[2]
+        top_pixel = max(0, i - int(height))
+        copy_row[top_pixel:max_height] = pix
         max_height = min(max_height, top_pixel)
 
     row[:] = copy_row[:]
 
 
-def apply_mountain_effect(image, compressed_image, direction="down"):
+def mountain_sources(compressed_lines):
+    """ Finds the pixel that apply_mountain_effect_row places at each position of each line.
+
+    Pixels are applied from the end of the line to the start, and pixel i fills the positions from
+    max(0, i - compressed_row[i]) up to the top of the pixels already applied. Position p therefore ends up with the
+    last pixel whose top is at or before p: a pixel only fills positions if its top is above the top of every pixel
+    after it, and it then fills every position up to the next such pixel.
+
+    :param compressed_lines:    A lines x length array of pixel heights.
+    :return:                    A lines x length array, where each element is the index (within its line) of the pixel
+                                which ends up at that position.
+    """
+    count, length = compressed_lines.shape
+    index_type = np.int32 if length < 2 ** 31 else np.int64
+    positions = np.arange(length, dtype=index_type)
+    tops = np.maximum(positions - compressed_lines.astype(index_type), 0)
+
+    # The minimum top of the pixels after each pixel - the position up to which it fills.
+    fill_to = np.empty_like(tops)
+    fill_to[:, -1] = length
+    np.minimum.accumulate(tops[:, :0:-1], axis=1, out=fill_to[:, -2::-1])
+    np.minimum(fill_to[:, :-1], length, out=fill_to[:, :-1])
+
+    line_ids, pixel_ids = np.nonzero(tops < fill_to)
+    sources = np.full((count, length), -1, dtype=index_type)
+    sources[line_ids, tops[line_ids, pixel_ids]] = pixel_ids
+    np.maximum.accumulate(sources, axis=1, out=sources)
+
+    # Heights below zero can leave positions uncovered, which keep their own pixel.
+    return np.where(sources < 0, positions, sources)
+
+
+def mountain_lines(array, direction):
+    """ Returns a view of array where each row is a line that apply_mountain_effect_row is applied to, for the "left"
+    or "right" direction. Up and down are applied as left and right to a transposed copy (see
+    apply_mountain_effect). """
+    if direction == "left":
+        return array
+    return array[:, ::-1]
+
+
+# The approximate number of pixels processed at once by the vectorized engine, which bounds the size of its temporary
+# arrays.
+BLOCK_PIXELS = 2 ** 22
+
+
+def apply_mountain_effect_lines(lines, compressed_lines, block_pixels=BLOCK_PIXELS):
+    """ Applies apply_mountain_effect_row to every row of lines at once. Lines are processed in blocks of about
+    block_pixels pixels, to bound the size of temporary arrays.
+
+    :param lines:               A lines x length x channels array (or view) of pixels, which is modified in place.
+    :param compressed_lines:    A lines x length array of pixel heights.
+    :param block_pixels:        The approximate number of pixels to process at once.
+    :return:                    Nothing.
+    """
+    count, length = compressed_lines.shape
+    block = max(1, block_pixels // max(length, 1))
+
+    for first in range(0, count, block):
+        sources = mountain_sources(compressed_lines[first:first + block])
+        block_lines = np.ascontiguousarray(lines[first:first + block])
+        sources += np.arange(0, block_lines.shape[0] * length, length, dtype=sources.dtype)[:, np.newaxis]
+        pixels = pixel_records(block_lines.reshape(block_lines.shape[0] * length, -1))
+        with contiguous_channels(lines[first:first + block]) as target:
+            pixel_records(target)[...] = np.take(pixels, sources)
+
+
+def _mountain_strip(image, compressed_image, selected, direction, engine):
+    """ Applies the mountain effect to a strip of an image. """
+    apply_mountain_effect(image, compressed_image, direction, engine=engine)
+
+
+def apply_mountain_effect(image, compressed_image, direction="down", strip_runner=None, engine="vectorized"):
     """
 
     SIDE EFFECTS: Will modify the input image - provide a copy to apply the effect on if this is unwanted.
@@ -48,19 +132,38 @@ def apply_mountain_effect(image, compressed_image, direction="down"):
     :param image:               The image to modify.
     :param compressed_image:    The array with the same number of rows and columns as image, where each element is
                                 the weight of the pixel compared to its neighbours (higher pixels will be sorted to the
-                                end).
+                                end). May instead be the name of a key in sort_keys.KEYS, which is computed from image.
+    :param strip_runner:        A StripRunner to split the columns (or rows) between. If workers are processes, image
+                                and compressed_image must be the arrays given by strip_runner.apply.
+    :param engine:              "vectorized" to process every line at once, or "per_row" to apply
+                                apply_mountain_effect_row to each line.
     :return:                    Nothing. Image is modified in place - user is expected to provide a copy.
     """
 
     rows, cols, _ = image.shape
-
-    if direction == "up":
-        for col in range(cols):
-            apply_mountain_effect_row(image[:, col], compressed_image[:, col])
-    elif direction == "down":
-        for col in range(cols):
-            apply_mountain_effect_row(image[:, col][::-1], compressed_image[:, col][::-1])
-    elif direction == "left":
+    compressed_image = resolve_key(image, compressed_image)
+
+    if strip_runner is not None:
+        columns = direction in ("up", "down")
+        strip_runner.run(_mountain_strip, [image, compressed_image], columns, range(cols if columns else rows),
+                         direction, engine)
+        return
+
+    if direction in ("up", "down"):
+        # Columns are raised as the rows of transposed copies, where up and down become left and right, so they are
+        # read and written sequentially. Only a band of about BLOCK_PIXELS pixels is copied at a time.
+        band = max(1, BLOCK_PIXELS // max(rows, 1))
+        for first in range(0, cols, band):
+            with transposed(image[:, first:first + band]) as (lines,):
+                apply_mountain_effect(lines, transpose_pixels(compressed_image[:, first:first + band]),
+                                      {"up": "left", "down": "right"}[direction], engine=engine)
+        return
+
+    if engine == "vectorized":
+        apply_mountain_effect_lines(mountain_lines(image, direction), mountain_lines(compressed_image, direction))
+        return
+
+    if direction == "left":
         for row in range(rows):
             apply_mountain_effect_row(image[row, :], compressed_image[row, :])
     elif direction == "right":
@@ -68,24 +171,56 @@ def apply_mountain_effect(image, compressed_image, direction="down"):
             apply_mountain_effect_row(image[row, :][::-1], compressed_image[row, :][::-1])
 
 
-def main():
-    """ Program runner: parses the arguments and produces the appropriate images."""
-    import os
+def _mountain_stream_strip(key, darkness, direction, engine, strip, selected):
+    """ Applies the mountain effect to a strip of rows of an image which is being streamed. """
+    compressed = KEYS[key](strip)
+    apply_mountain_effect(strip, 255 - compressed if darkness else compressed, direction, engine=engine)
 
-    args = parse_args()
-    for file_name in args.files:
-        img = Image.open(file_name)
-        pixels = np.copy(np.asarray(img))
-        if args.darkness:
-            pixels_compressed = 255 - brightness(pixels)
-        else:
-            pixels_compressed = brightness(pixels)
 
-        apply_mountain_effect(pixels, pixels_compressed, args.direction)
+def process_pixels(args, pixels, key_cache=None):
+    """ Applies the mountain effect to pixels in place, as specified by args, and returns them. The key map is taken
+    from key_cache (a sort_keys.KeyCache), if one is given, and otherwise computed. """
+    pixels_compressed = resolve_key(pixels, args.key, key_cache)
+    if args.darkness:
+        pixels_compressed = 255 - pixels_compressed
+
+    with stage("mountains"), strip_runner(args) as runner:
+        if runner is None:
+            apply_mountain_effect(pixels, pixels_compressed, args.direction, engine=args.engine)
+        else:
+            runner.apply(apply_mountain_effect, [pixels, pixels_compressed], args.direction, runner, args.engine)
+    if key_cache is not None:
+        key_cache.invalidate(pixels)
+    return pixels
 
-        im = Image.fromarray(pixels)
-        im.save(f"{os.path.splitext(file_name)[0]}_mountains{os.path.splitext(file_name)[-1]}")
 
+def process_file(args, file_name):
+    """ Applies the mountain effect to a single file, as specified by args, and returns the name of the new file. """
+    import os
+    from functools import partial
+
+    output_name = f"{os.path.splitext(file_name)[0]}_mountains{os.path.splitext(file_name)[-1]}"
+    cache = result_cache(args, "mountains", file_name)
+    if cache.fetch(output_name):
+        return output_name
+
+    if args.stream:
+        # Columns are streamed as the rows of the transposed image, where up and down become left and right.
+        columns = args.direction in ("up", "down")
+        direction = {"up": "left", "down": "right"}.get(args.direction, args.direction)
+        passes = [(columns, range, partial(_mountain_stream_strip, args.key, args.darkness, direction, args.engine))]
+        stream_passes(file_name, output_name, passes, args.strip_budget * 2 ** 20, args.temp_dir)
+    else:
+        save_pixels(process_pixels(args, load_pixels(file_name)), output_name)
+    cache.store(output_name)
+    return output_name
+
+
+def main(argv=None, prog=None):
+    """ Program runner: parses the arguments and produces the appropriate images."""
+    from functools import partial
 
-if __name__ == "__main__":
-    main()
+    args = parse_args(argv, prog)
+    if run_files(partial(process_file, args), args.files, args.jobs, args.max_in_flight, args.profile,
+                 args.profile_memory):
+        raise SystemExit(1)
@@ -0,0 +1,151 @@
+from .image_utilities import demo_image, load_pixels, save_pixels
+from .sort_keys import KEY_CACHE, KeyCache
+from .batch_runner import add_batch_arguments, run_files
+from .result_cache import add_cache_arguments, result_cache
+from .profiling import add_profile_arguments
+
+"""
+Applies several effects to an image back to back. The image is decoded once, each effect modifies the same in memory
+pixels, and the result is encoded once at the end.
+
+A pipeline is a list of stages separated by "|". Each stage is the name of an effect, optionally followed by ":" and a
+comma separated list of options. The options are the ones the effect's own script takes, without the leading dashes.
+Options with values are written option=value (with several values separated by spaces), and flags are written on their
+own, eg.
+
+    imagemutation pipeline --files image.png --pipeline "sort:mode=0,row_only | mountains:direction=up | shift"
+
+Sort key maps (eg. brightness) are shared between stages through a sort_keys.KeyCache. A stage only recomputes a map if
+an earlier stage changed the pixels without keeping that map up to date.
+"""
+
+# The script implementing each effect. Each provides parse_args(argv, prog) and process_pixels(args, pixels, key_cache).
+EFFECTS = {
+    "sort": "sort_pixels",
+    "mountains": "mountains",
+    "shift": "shift_pixels",
+    "reshape": "reshape_image",
+}
+
+
+def parse_args(argv=None, prog=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--files", "-f", dest="files", default=[demo_image("nasa--hI5dX2ObAs-unsplash.jpg")],
+                        nargs="+", help="File(s) to apply the pipeline to. Can be any format supported by PIL. ")
+    parser.add_argument("--pipeline", "-p", dest="pipeline", required=True,
+                        help="The effects to apply, in order, eg. \"sort:mode=0,row_only | mountains:direction=up\". "
+                             f"Effects are: {', '.join(EFFECTS)}.")
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_profile_arguments(parser)
+
+    args = parser.parse_args(argv)
+    try:
+        args.stages = parse_pipeline(args.pipeline)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
+def effect_module(effect):
+    """ Imports and returns the module implementing effect, a key of EFFECTS. """
+    import importlib
+    return importlib.import_module(f".{EFFECTS[effect]}", __package__)
+
+
+def stage_argv(options):
+    """ Converts the options of a stage (eg. "mode=0,row_only") into command line arguments for its effect's script
+    (eg. ["--mode", "0", "--row_only"]). """
+    argv = []
+    for option in filter(None, (option.strip() for option in options.split(","))):
+        name, _, value = option.partition("=")
+        argv.append(f"--{name.strip()}")
+        argv += value.split()
+    return argv
+
+
+def parse_pipeline(pipeline):
+    """ Parses a pipeline (see the module documentation).
+
+    :param pipeline:    The pipeline to parse.
+    :return:            A list of (description, effect, args) tuples for each stage, where effect is a key of EFFECTS,
+                        and args are the arguments parsed by the effect's script.
+    """
+    stages = []
+    for stage in pipeline.split("|"):
+        effect, _, options = stage.strip().partition(":")
+        effect = effect.strip()
+        if effect not in EFFECTS:
+            raise ValueError(f"unknown effect {effect!r} in pipeline. Effects are: {', '.join(EFFECTS)}.")
+        args = effect_module(effect).parse_args(stage_argv(options), f"{effect} (pipeline stage)")
+        if getattr(args, "stream", False):
+            raise ValueError(f"stage {stage.strip()!r} can not use --stream in a pipeline.")
+        stages.append((stage.strip(), effect, args))
+    if not stages:
+        raise ValueError("the pipeline has no stages.")
+    return stages
+
+
+def run_pipeline(pixels, stages, key_cache=None):
+    """ Applies each stage of a pipeline to pixels in turn.
+
+    :param pixels:      A rows x cols x channels array of pixels, which may be modified in place.
+    :param stages:      The stages to apply, as returned by parse_pipeline.
+    :param key_cache:   The KeyCache the stages share key maps through. Defaults to a new one, used by this call only.
+    :return:            The resulting pixels, and a list of the time taken by each stage, in seconds.
+    """
+    import time
+
+    if key_cache is None:
+        key_cache = KeyCache()
+    timings = []
+    for _, effect, args in stages:
+        process_pixels = effect_module(effect).process_pixels
+        start = time.perf_counter()
+        pixels = process_pixels(args, pixels, key_cache=key_cache)
+        timings.append(time.perf_counter() - start)
+    return pixels, timings
+
+
+def process_file(args, file_name):
+    """ Applies the pipeline to a single file, printing the time taken by each step, and returns the name of the new
+    file. """
+    import os
+    import time
+
+    output_name = f"{os.path.splitext(file_name)[0]}_pipeline{os.path.splitext(file_name)[-1]}"
+    cache = result_cache(args, "pipeline", file_name)
+    if cache.fetch(output_name):
+        print(f"{file_name}: cached")
+        return output_name
+
+    hits, misses = KEY_CACHE.hits, KEY_CACHE.misses
+
+    start = time.perf_counter()
+    pixels = load_pixels(file_name)
+    decode_time = time.perf_counter() - start
+
+    pixels, timings = run_pipeline(pixels, args.stages, KEY_CACHE)
+
+    start = time.perf_counter()
+    save_pixels(pixels, output_name)
+    encode_time = time.perf_counter() - start
+    cache.store(output_name)
+
+    report = [f"{file_name}:", f"  {'decode':<50} {decode_time:8.3f}s"]
+    report += [f"  {description:<50} {timing:8.3f}s" for (description, _, _), timing in zip(args.stages, timings)]
+    report += [f"  {'encode':<50} {encode_time:8.3f}s",
+               f"  key maps computed: {KEY_CACHE.misses - misses}, reused: {KEY_CACHE.hits - hits}"]
+    print("\n".join(report))
+    return output_name
+
+
+def main(argv=None, prog=None):
+    """ Program runner: parses the arguments and produces the appropriate images."""
+    from functools import partial
+
+    args = parse_args(argv, prog)
+    if run_files(partial(process_file, args), args.files, args.jobs, args.max_in_flight, args.profile,
+                 args.profile_memory):
+        raise SystemExit(1)
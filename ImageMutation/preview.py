@@ -0,0 +1,240 @@
+import numpy as np
+from functools import lru_cache
+from .image_utilities import demo_image, save_pixels
+from .sort_keys import KEY_CACHE
+from .batch_runner import add_batch_arguments, run_ordered
+from .result_cache import CACHE_BYTES, add_cache_arguments, result_cache
+from .pipeline import EFFECTS, parse_pipeline, run_pipeline
+from .profiling import stage
+
+"""
+Previews effects on a downscaled proxy of an image, so their parameters can be tuned without processing the full image
+for every attempt. A pipeline (see pipeline.py) renders a single preview, eg.
+
+    imagemutation preview --files image.jpg --pipeline "sort:mode=0,black_val=40"
+
+and a sweep renders the pipeline once for every combination of values of its {placeholders}, laid out as a labelled
+contact sheet, eg.
+
+    imagemutation preview --files image.jpg --pipeline "sort:mode=3,black_val={black},white_val={white}" \
+        --sweep black=20,40,60,80 --sweep white=120,160,200 --jobs 4
+
+The image is decoded and downscaled once (JPEGs are decoded straight at a reduced scale), and the key maps the variants
+start from are computed once, however many variants there are. Every parameter of a variant - thresholds included - is
+one of its own arguments, so variants are independent of each other, and are rendered in parallel on --jobs workers.
+With --cache_dir, proxies are kept in the cache of results, so later previews of the same image skip the decode.
+
+Parameters measured in pixels (eg. shift's checkerboard) cover more of a proxy than of the full image. Divide them by
+the scale the proxy was shrunk by to match.
+"""
+
+# Default size of the longest side of a proxy, in pixels.
+PROXY_SIDE = 512
+
+
+def parse_args(argv=None, prog=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--files", "-f", dest="files", default=[demo_image("nasa--hI5dX2ObAs-unsplash.jpg")],
+                        nargs="+", help="File(s) to preview. Can be any format supported by PIL. ")
+    parser.add_argument("--pipeline", "-p", dest="pipeline", required=True,
+                        help="The effects to preview, as for pipeline.py, eg. \"sort:mode=0,black_val={black}\". "
+                             "With --sweep, values may be {placeholders}. "
+                             f"Effects are: {', '.join(EFFECTS)}.")
+    parser.add_argument("--sweep", dest="sweep", default=[], action="append",
+                        help="Values of a placeholder of --pipeline, as name=value,value,... Given once for each "
+                             "placeholder, and every combination of values is rendered.")
+    parser.add_argument("--max_side", dest="max_side", default=PROXY_SIDE, type=int,
+                        help="Size of the longest side of the proxy the effects are applied to, in pixels.")
+    parser.add_argument("--columns", dest="columns", default=None, type=int,
+                        help="Number of variants in each row of the contact sheet. Defaults to a square grid.")
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+
+    args = parser.parse_args(argv)
+    if args.max_side < 1:
+        parser.error("argument --max_side must be at least 1.")
+    grid = {}
+    for option in args.sweep:
+        name, _, values = option.partition("=")
+        name, values = name.strip(), [value.strip() for value in values.split(",") if value.strip()]
+        if not name or not values:
+            parser.error(f"argument --sweep must be given as name=value,value,..., not {option!r}.")
+        if name in grid:
+            parser.error(f"argument --sweep was given twice for {name!r}.")
+        grid[name] = values
+    try:
+        args.variants = sweep_variants(args.pipeline, grid)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
+def downscale(file_name, max_side=PROXY_SIDE):
+    """ Decodes an image shrunk to fit within max_side x max_side pixels, keeping its aspect ratio. JPEGs are decoded
+    at a reduced scale, rather than decoded in full and then shrunk.
+
+    :param file_name:   The image to decode. Can be any format supported by PIL.
+    :param max_side:    The largest size of either side of the result, in pixels. Smaller images are not enlarged.
+    :return:            A rows x cols x channels array, as returned by image_utilities.load_pixels.
+    """
+    from PIL import Image
+
+    with stage("decode"), Image.open(file_name) as img:
+        img.draft(img.mode, (max_side, max_side))
+        img.thumbnail((max_side, max_side))
+        pixels = np.array(img)
+    return pixels.reshape(pixels.shape[0], pixels.shape[1], -1)
+
+
+def load_proxy(file_name, max_side=PROXY_SIDE, cache_dir=None, cache_size=CACHE_BYTES // 2 ** 20):
+    """ Returns the proxy of an image (see downscale). Proxies are kept in memory for as long as their file is
+    unchanged, so the array returned is read-only, and is shared by every caller. Copy it before modifying it.
+
+    :param file_name:   The image to load.
+    :param max_side:    The largest size of either side of the proxy, in pixels.
+    :param cache_dir:   A cache of results (see result_cache.py) to keep the proxy in, or None.
+    :param cache_size:  The size of the cache, in MiB.
+    :return:            The proxy, as a read-only rows x cols x channels array.
+    """
+    import os
+
+    path = os.path.abspath(file_name)
+    return _load_proxy(path, os.stat(path).st_mtime_ns, max_side, cache_dir, cache_size)
+
+
+@lru_cache(maxsize=8)
+def _load_proxy(path, modified, max_side, cache_dir, cache_size):
+    """ Loads a proxy for load_proxy. modified is only used to tell apart the versions of a file in the lru_cache. """
+    import os
+    import tempfile
+    from types import SimpleNamespace
+
+    cache = result_cache(SimpleNamespace(max_side=max_side, cache_dir=cache_dir, cache_size=cache_size), "proxy", path)
+    with tempfile.TemporaryDirectory() as work_dir:
+        proxy_name = os.path.join(work_dir, "proxy.npy")
+        if cache.fetch(proxy_name):
+            proxy = np.load(proxy_name)
+        else:
+            proxy = downscale(path, max_side)
+            np.save(proxy_name, proxy)
+            cache.store(proxy_name)
+    proxy.flags.writeable = False
+    return proxy
+
+
+def sweep_variants(template, grid):
+    """ Parses a pipeline once for each combination of values of its placeholders.
+
+    :param template:    A pipeline (see pipeline.py), where values may be {placeholders}, eg. "sort:black_val={black}".
+    :param grid:        A dictionary of the values of each placeholder, eg. {"black": [20, 40]}. May be empty, if
+                        template has no placeholders.
+    :return:            A list of (parameters, stages) for each combination, where parameters is a dictionary of the
+                        value of each placeholder, and stages are as returned by parse_pipeline. The last placeholder
+                        varies fastest.
+    """
+    from itertools import product
+    from string import Formatter
+
+    placeholders = {field for _, field, _, _ in Formatter().parse(template) if field is not None}
+    if placeholders != set(grid):
+        missing, unused = sorted(placeholders - set(grid)), sorted(set(grid) - placeholders)
+        raise ValueError(f"the pipeline's placeholders do not match the swept values (no values for: "
+                         f"{', '.join(missing) or 'none'}, not in the pipeline: {', '.join(unused) or 'none'}).")
+
+    variants = []
+    for values in product(*grid.values()):
+        parameters = dict(zip(grid, values))
+        variants.append((parameters, parse_pipeline(template.format(**parameters))))
+    return variants
+
+
+def render_variant(proxy, key_maps, stages):
+    """ Applies the stages of a pipeline to a copy of proxy, and returns the result.
+
+    :param proxy:       The pixels to start from. They are not modified.
+    :param key_maps:    A dictionary of maps of proxy for any keys (see sort_keys.py), by name. Copies are given to the
+                        first stage, rather than it computing them again.
+    :param stages:      The stages to apply, as returned by parse_pipeline.
+    :return:            The rendered pixels.
+    """
+    pixels = proxy.copy()
+    for name, key_map in key_maps.items():
+        KEY_CACHE.put(pixels, name, key_map.copy())
+    return run_pipeline(pixels, stages, KEY_CACHE)[0]
+
+
+def sweep(proxy, variants, jobs=1, max_in_flight=None):
+    """ Renders each variant of a pipeline on the same proxy.
+
+    :param proxy:           The pixels to render the variants on. They are not modified.
+    :param variants:        The variants to render, as returned by sweep_variants.
+    :param jobs:            Number of worker processes to render the variants on.
+    :param max_in_flight:   Maximum number of variants sent to the workers at once (see batch_runner.run_ordered).
+    :return:                A list of the rendered pixels of each variant, in the same order as variants.
+    """
+    from functools import partial
+
+    # The first stage of every variant weighs the same pixels, so their key maps are shared. Later stages weigh pixels
+    # which depend on the variant.
+    names = {args.key for _, stages in variants for _, _, args in stages[:1] if hasattr(args, "key")}
+    key_maps = {name: KEY_CACHE.get(proxy, name) for name in names}
+    return list(run_ordered(partial(render_variant, proxy, key_maps), [stages for _, stages in variants], jobs,
+                            max_in_flight))
+
+
+def contact_sheet(images, labels, columns=None, padding=4, label_height=14):
+    """ Lays images out in a grid, each above its label.
+
+    :param images:          A list of rows x cols x channels arrays. They may differ in size.
+    :param labels:          The text to write under each image.
+    :param columns:         Number of images in each row of the grid. Defaults to a square grid.
+    :param padding:         Space left around each image, in pixels.
+    :param label_height:    Space left under each image for its label, in pixels.
+    :return:                The sheet, as a rows x cols x 3 array.
+    """
+    import math
+    from PIL import Image, ImageDraw
+
+    columns = max(1, min(columns or math.ceil(math.sqrt(len(images))), len(images)))
+    tile_rows = max(image.shape[0] for image in images) + label_height + padding
+    tile_cols = max(image.shape[1] for image in images) + padding
+    sheet = np.full((math.ceil(len(images) / columns) * tile_rows + padding, columns * tile_cols + padding, 3), 255,
+                    dtype=np.uint8)
+
+    corners = [(padding + (i // columns) * tile_rows, padding + (i % columns) * tile_cols) for i in range(len(images))]
+    for (top, left), image in zip(corners, images):
+        # Greyscale is spread across all three channels, and alpha is dropped.
+        rgb = image[:, :, [0, 0, 0]] if image.shape[2] < 3 else image[:, :, :3]
+        sheet[top:top + image.shape[0], left:left + image.shape[1]] = rgb
+
+    sheet_image = Image.fromarray(sheet)
+    draw = ImageDraw.Draw(sheet_image)
+    for (top, left), image, label in zip(corners, images, labels):
+        draw.text((left, top + image.shape[0] + 1), label, fill=(0, 0, 0))
+    return np.array(sheet_image)
+
+
+def process_file(args, file_name):
+    """ Renders the preview of a single file (or the contact sheet of its sweep), and returns the name of the new
+    file. """
+    import os
+
+    proxy = load_proxy(file_name, args.max_side, args.cache_dir, args.cache_size)
+    images = sweep(proxy, args.variants, args.jobs, args.max_in_flight)
+    if args.sweep:
+        labels = [" ".join(f"{name}={value}" for name, value in parameters.items()) for parameters, _ in args.variants]
+        pixels, suffix = contact_sheet(images, labels, args.columns), "sweep"
+    else:
+        pixels, suffix = images[0], "preview"
+
+    output_name = f"{os.path.splitext(file_name)[0]}_{suffix}{os.path.splitext(file_name)[-1]}"
+    save_pixels(pixels, output_name)
+    return output_name
+
+
+def main(argv=None, prog=None):
+    """ Program runner: parses the arguments and produces the appropriate previews."""
+    args = parse_args(argv, prog)
+    for file_name in args.files:
+        print(f"Wrote {process_file(args, file_name)}")
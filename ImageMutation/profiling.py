@@ -0,0 +1,197 @@
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+"""
+Records where the time goes while processing an image: the wall time and number of calls of each stage (eg. decode,
+key maps, interval search, segment sort, encode), counts of the work done (eg. intervals sorted, lines visited), and
+optionally the peak memory allocated. Measuring memory traces every allocation (with tracemalloc), which slows down
+allocation heavy stages by a large factor, so it is off unless asked for (--profile_memory), and its timings should not
+be compared with those of runs without it.
+
+Code marks its stages with stage(name), and its work with count(name, n). Both do nothing unless a Profiler is recording
+an image, so they cost next to nothing when profiling is off, eg.
+
+    with stage("interval search"):
+        starts, ends = interval_index.bounds(start, end, columns, selected)
+    count("intervals sorted", len(starts))
+
+Recording is started with Profiler.image, which produces a record for the image once it is done. Records are passed to
+the Profiler's on_image hook, and written to its output file: as JSON lines (one record per image), or if the file name
+ends in .json, as a Chrome trace (which can be opened in chrome://tracing or Perfetto). Several processes can write to
+the same output file at once, once reset_output has prepared it.
+"""
+
+# The Profiler recording the current image, if any. Shared by every thread in the process, so stages run by strip
+# workers are recorded too.
+_active = None
+
+# Returned by stage when profiling is off. nullcontext instances can be reused.
+_NOT_RECORDING = nullcontext()
+
+# The start of a Chrome trace file, which is followed by its events.
+TRACE_HEADER = "[\n"
+
+
+def stage(name, trace=True):
+    """ Returns a context manager which records the time spent in it as the stage called name, if an image is being
+    profiled. If trace is False, the stage is only totalled, and not written as a Chrome trace event. This is for stages
+    entered many times per image (eg. per interval), which would otherwise swamp the trace. """
+    if _active is None:
+        return _NOT_RECORDING
+    return _active.stage(name, trace)
+
+
+def count(name, n=1):
+    """ Adds n to the count called name, if an image is being profiled. """
+    if _active is not None:
+        _active.count(name, n)
+
+
+def add_profile_arguments(parser):
+    """ Adds the --profile and --profile_memory arguments to parser. """
+    parser.add_argument("--profile", dest="profile", default=None,
+                        help="Record the time and call counts of each stage of each image to this file. Written as "
+                             "JSON lines, or as a Chrome trace if the file name ends in .json.")
+    parser.add_argument("--profile_memory", dest="profile_memory", action="store_true",
+                        help="With --profile, also record the peak memory allocated for each image. This traces every "
+                             "allocation, which slows down the stages being timed.")
+
+
+def reset_output(output):
+    """ Starts a run's output file afresh, replacing any file left by an earlier run. A Chrome trace starts with its
+    opening bracket, so this must be called before any process appends to it. """
+    try:
+        os.unlink(output)
+    except FileNotFoundError:
+        pass
+    if output.endswith(".json"):
+        with open(output, "x") as f:
+            f.write(TRACE_HEADER)
+
+
+def _append(output, text, header=""):
+    """ Appends text to output with a single write, so writes from several processes do not interleave. header is
+    written first if output does not exist yet (ie. reset_output was not called), which is only safe if a single
+    process writes to output. """
+    if header:
+        try:
+            with open(output, "x") as f:
+                f.write(header)
+        except FileExistsError:
+            pass
+    handle = os.open(output, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(handle, text.encode())
+    finally:
+        os.close(handle)
+
+
+class Profiler:
+    """ Profiles images one at a time.
+
+    :param output:      A file to append each image's record to, or None. If several processes write to it, it must
+                        be prepared with reset_output first.
+    :param on_image:    A function called with each image's record (a dict) and its list of Chrome trace events, or
+                        None.
+    :param memory:      If True, also records the peak memory allocated for each image, through tracemalloc. This
+                        slows down the code being profiled.
+    """
+
+    def __init__(self, output=None, on_image=None, memory=False):
+        self.output = output
+        self.on_image = on_image
+        self.memory = memory
+        self._lock = threading.Lock()
+        self._record = None
+        self._events = None
+
+    @contextmanager
+    def image(self, label):
+        """ Profiles the code run inside the context as the processing of a single image, called label. Yields the
+        record, which is complete once the context exits. A record holds the image's label, process id, total wall
+        time, each stage's total time and calls, the counts, and if memory is True, the peak memory allocated (in
+        bytes). """
+        global _active
+        import tracemalloc
+
+        started_tracing = self.memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.memory:
+            tracemalloc.reset_peak()
+            memory = tracemalloc.get_traced_memory()[0]
+
+        record = self._record = {"image": label, "pid": os.getpid(), "wall": 0.0, "stages": {}, "counts": {}}
+        self._events = []
+        previous, _active = _active, self
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            end = time.perf_counter()
+            _active = previous
+            record["wall"] = end - start
+            if self.memory:
+                record["peak_memory"] = tracemalloc.get_traced_memory()[1] - memory
+            if started_tracing:
+                tracemalloc.stop()
+            summary = dict(record["counts"], **({"peak_memory": record["peak_memory"]} if self.memory else {}))
+            events = [self._event(label, start, end, summary)]
+            events += self._events
+            self._record = self._events = None
+            self._emit(record, events)
+
+    @contextmanager
+    def stage(self, name, trace=True):
+        """ Records the time spent in the context as the stage called name. See the module function stage. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                if self._record is not None:
+                    totals = self._record["stages"].setdefault(name, {"time": 0.0, "calls": 0})
+                    totals["time"] += end - start
+                    totals["calls"] += 1
+                    if trace:
+                        self._events.append(self._event(name, start, end))
+
+    def count(self, name, n=1):
+        """ Adds n to the count called name. """
+        with self._lock:
+            if self._record is not None:
+                counts = self._record["counts"]
+                counts[name] = counts.get(name, 0) + int(n)
+
+    @staticmethod
+    def _event(name, start, end, args=None):
+        """ Returns a Chrome trace event for a span of time, measured with time.perf_counter. """
+        event = {"name": name, "ph": "X", "ts": start * 1e6, "dur": (end - start) * 1e6, "pid": os.getpid(),
+                 "tid": threading.get_ident()}
+        if args:
+            event["args"] = args
+        return event
+
+    def _emit(self, record, events):
+        import json
+
+        if self.on_image is not None:
+            self.on_image(record, events)
+        if self.output is None:
+            return
+        if self.output.endswith(".json"):
+            # The Chrome trace array format allows the closing bracket (and a trailing comma) to be left out, so events
+            # can be appended by any number of processes.
+            _append(self.output, "".join(json.dumps(event) + ",\n" for event in events), header=TRACE_HEADER)
+        else:
+            _append(self.output, json.dumps(record) + "\n")
+
+
+def profile_file(process_file, output, file_name, memory=False):
+    """ Runs process_file(file_name), recording its profile (and peak memory, if memory is True) to output, and
+    returns its result. """
+    with Profiler(output, memory=memory).image(file_name):
+        return process_file(file_name)
@@ -1,13 +1,22 @@
-from PIL import Image
+import math
 import numpy as np
-from image_utilities import ranges
+from collections import Counter
+from functools import lru_cache
+from .image_utilities import demo_image, load_pixels, save_pixels
+from .batch_runner import add_batch_arguments, run_files
+from .result_cache import add_cache_arguments, result_cache
+from .profiling import add_profile_arguments, stage
 
 
-def parse_args():
+# The largest width or height PIL can save.
+MAX_SIDE = 65535
+
+
+def parse_args(argv=None, prog=None):
     import argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--files", "-f", dest="files", default=["../demo/nasa--hI5dX2ObAs-unsplash.jpg"], nargs="+",
-                        help="File(s) to sort. Can be any format supported by PIL. ")
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--files", "-f", dest="files", default=[demo_image("nasa--hI5dX2ObAs-unsplash.jpg")],
+                        nargs="+", help="File(s) to sort. Can be any format supported by PIL. ")
     fit_options = parser.add_mutually_exclusive_group(required=True)
     fit_options.add_argument("--reshape", nargs=2, type=int, default=None,
                              help="Output shape. Row col order.")
@@ -15,82 +24,185 @@ def parse_args():
                              help="Will fit to a random rectangle.")
     fit_options.add_argument("--most_square", action="store_true",
                              help="Will fit to the most square rectangle.")
-
-    return parser.parse_args()
-
-
-def random_fit(n, loss_tolerance=0.1):
+    fit_options.add_argument("--aspect", type=float, default=None,
+                             help="Will fit to the rectangle closest to this aspect ratio (width / height).")
+    parser.add_argument("--loss_tolerance", type=float, default=0.1,
+                        help="The largest fraction of pixels which --random_fit and --aspect may drop.")
+    parser.add_argument("--pad", action="store_true",
+                        help="If --reshape has more pixels than the image, pads the end with black pixels. Otherwise, "
+                             "the image must have at least as many pixels as the new shape.")
+
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.reshape is not None and not all(1 <= side <= MAX_SIDE for side in args.reshape):
+        parser.error(f"--reshape sides must be between 1 and {MAX_SIDE}.")
+    if not 0 <= args.loss_tolerance <= 1:
+        parser.error("--loss_tolerance must be between 0 and 1.")
+    if args.aspect is not None and args.aspect <= 0:
+        parser.error("--aspect must be positive.")
+    return args
+
+
+@lru_cache(maxsize=None)
+def primes_up_to(limit):
+    """ Returns an array of the primes up to limit (inclusive), found with a sieve of Eratosthenes. """
+    sieve = np.ones(limit + 1, dtype=bool)
+    sieve[:2] = False
+    for i in range(2, math.isqrt(limit) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = False
+    return np.flatnonzero(sieve)
+
+
+def prime_factors(n):
+    """ Returns the prime factors of n (with repeats) in ascending order, found by trial division by primes. """
+    factorization = []
+    # A single sieve up to MAX_SIDE covers the pixel count of any image PIL can save.
+    for prime in primes_up_to(max(MAX_SIDE, math.isqrt(n))).tolist():
+        if prime * prime > n:
+            break
+        while n % prime == 0:
+            factorization.append(prime)
+            n //= prime
+    if n > 1:
+        factorization.append(n)
+    return factorization
+
+
+@lru_cache(maxsize=256)
+def divisors(n):
+    """ Returns a sorted array of every divisor of n. """
+    found = np.ones(1, dtype=np.int64)
+    for prime, power in Counter(prime_factors(n)).items():
+        found = (found[:, None] * prime ** np.arange(power + 1)).ravel()
+    found.sort()
+    found.flags.writeable = False
+    return found
+
+
+def random_fit(n, loss_tolerance=0.1, rng=None):
     """ Returns a random pair of values which, when multiplied, is close to n.
 
     :param n:               The number to produce a random fit for.
     :param loss_tolerance:  The maximum negative difference that is allowed.
+    :param rng:             A random.Random instance to draw the fit with. Defaults to the random module.
     :return:                Two numbers which, when multiplied, are between 100*(1-loss_tolerance)% and 100% of n.
     """
-
     assert 0 <= loss_tolerance <= 1
-    assert n < 65535 ** 2
-    # Max dim is 65535
+    assert n < MAX_SIDE ** 2
     import random
+    if rng is None:
+        rng = random
+
+    side_a, side_b = fit_candidates(n, loss_tolerance)
+    choice = rng.randrange(len(side_a))
+    return int(side_a[choice]), int(side_b[choice])
+
 
-    side_a = random.randint(0, n)
+def fit_candidates(n, loss_tolerance):
+    """ Returns every pair of sides of at most MAX_SIDE whose product is between 100*(1-loss_tolerance)% and 100% of n,
+    as two arrays. The first side of each pair is the one chosen, and the second is n // first. """
+    side_a = np.arange(max(1, -(-n // MAX_SIDE)), min(n, MAX_SIDE) + 1, dtype=np.int64)
     side_b = n // side_a
-    while side_a > 65535 or side_b > 65535:
-        side_a = random.randint(0, n)
-        side_b = n // side_a
+    fits = (side_b <= MAX_SIDE) & (n - side_a * side_b <= loss_tolerance * n)
+    if not fits.any():
+        raise ValueError(f"No rectangle with sides of at most {MAX_SIDE} fits {n} pixels, with a loss tolerance of "
+                         f"{loss_tolerance}.")
+    return side_a[fits], side_b[fits]
 
-    while (n - side_a * side_b) / n > loss_tolerance:
-        side_a += 1
-        side_b = n // side_a
 
-    return side_a, side_b
+def aspect_fit(n, aspect, loss_tolerance=0.1):
+    """ Returns the rows and columns, whose product is close to n, of the rectangle closest to an aspect ratio.
+
+    :param n:               The number of pixels to fit.
+    :param aspect:          The aspect ratio to fit, as width / height.
+    :param loss_tolerance:  The largest fraction of n which may be left over.
+    :return:                The rows and columns of the rectangle.
+    """
+    cols, rows = fit_candidates(n, loss_tolerance)
+    best = np.argmin(np.abs(np.log(cols / rows / aspect)))
+    return int(rows[best]), int(cols[best])
 
 
 def factors(n):
     """ Returns the factors of n which are closest to being square.
 
     :param n:       The number to produce factors for
-    :return:        Two
+    :return:        Two factors of n, the second being the largest factor which is at most the (rounded up) square root
+                    of n.
     """
-    import math
-    guess = math.ceil(math.sqrt(n))
-    while n % guess != 0:
-        guess -= 1
-    return int(n / guess), int(guess)
+    found = divisors(n)
+    guess = int(found[np.searchsorted(found, math.isqrt(n - 1) + 1, side="right") - 1])
+    return n // guess, guess
 
 
-def main():
-    """ Program runner: parses the arguments and produces the appropriate images."""
-    import os
+def reshape_pixels(pixel_view, reshape_rows, reshape_cols, pad=False):
+    """ Rearranges the pixels of an image (in row order) into an image of reshape_rows x reshape_cols. Pixels which do
+    not fit are dropped. The result is a view of pixel_view, unless it is padded (or pixel_view is not contiguous).
 
-    args = parse_args()
+    :param pixel_view:      The rows x cols x channels image to reshape.
+    :param reshape_rows:    The number of rows of the new image.
+    :param reshape_cols:    The number of columns of the new image.
+    :param pad:             If the new image has more pixels than the original, pads it with black pixels. Otherwise,
+                            the new image must not have more pixels than the original.
+    :return:                The reshaped image.
+    """
+    rows, cols, channels = pixel_view.shape
+    true_pixel_count = rows * cols
+    num_pixels = reshape_rows * reshape_cols
 
-    for file_name in args.files:
-        img = Image.open(file_name)
+    pixels = np.reshape(pixel_view, (true_pixel_count, channels))
 
-        pixel_view = np.asarray(img)
-        rows, cols, _ = pixel_view.shape
-        true_pixel_count = rows * cols
+    if true_pixel_count < num_pixels:
+        if not pad:
+            raise ValueError(f"Can not reshape {true_pixel_count} pixels to {reshape_rows} x {reshape_cols} without "
+                             f"padding.")
+        padded = np.zeros((num_pixels, channels), dtype=pixel_view.dtype)
+        padded[:true_pixel_count] = pixels
+        pixels = padded
 
-        if args.reshape:
-            reshape_rows, reshape_cols = args.reshape
-        elif args.most_square:
-            reshape_rows, reshape_cols = factors(true_pixel_count)
-        else:
-            reshape_rows, reshape_cols = random_fit(true_pixel_count)
+    return np.reshape(pixels[:num_pixels], (reshape_rows, reshape_cols, channels))
 
-        num_pixels = reshape_rows * reshape_cols
 
-        pixels = np.reshape(pixel_view, (rows * cols, 1, 3))
+def process_pixels(args, pixel_view, key_cache=None):
+    """ Returns pixel_view reshaped as specified by args. key_cache is unused, as reshaping changes no pixels. """
+    rows, cols, _ = pixel_view.shape
+    true_pixel_count = rows * cols
 
-        if true_pixel_count < num_pixels and args.pad:
-            extension = np.zeros((num_pixels - true_pixel_count, 3), dtype=np.uint8)
-            pixels = np.append(pixels, extension)
+    if args.reshape:
+        reshape_rows, reshape_cols = args.reshape
+    elif args.most_square:
+        reshape_rows, reshape_cols = factors(true_pixel_count)
+    elif args.aspect is not None:
+        reshape_rows, reshape_cols = aspect_fit(true_pixel_count, args.aspect, args.loss_tolerance)
+    else:
+        reshape_rows, reshape_cols = random_fit(true_pixel_count, args.loss_tolerance)
 
-        pixels = np.reshape(pixels[:num_pixels], (reshape_rows, reshape_cols, 3))
+    with stage("reshape"):
+        return reshape_pixels(pixel_view, reshape_rows, reshape_cols, args.pad)
 
-        im = Image.fromarray(pixels)
-        im.save(f"{os.path.splitext(file_name)[0]}_reshaped{os.path.splitext(file_name)[-1]}")
 
+def process_file(args, file_name):
+    """ Reshapes a single file, as specified by args, and returns the name of the new file. """
+    import os
+
+    output_name = f"{os.path.splitext(file_name)[0]}_reshaped{os.path.splitext(file_name)[-1]}"
+    cache = result_cache(args, "reshape", file_name)
+    if cache.fetch(output_name):
+        return output_name
+
+    save_pixels(process_pixels(args, load_pixels(file_name)), output_name)
+    cache.store(output_name)
+    return output_name
+
+
+def main(argv=None, prog=None):
+    """ Program runner: parses the arguments and produces the appropriate images."""
+    from functools import partial
 
-if __name__ == "__main__":
-    main()
+    args = parse_args(argv, prog)
+    if run_files(partial(process_file, args), args.files, args.jobs, args.max_in_flight, args.profile,
+                 args.profile_memory):
+        raise SystemExit(1)
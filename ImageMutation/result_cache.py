@@ -0,0 +1,357 @@
+import os
+from contextlib import contextmanager
+
+"""
+An on-disk cache of the files written by effects, shared between runs and between the workers of a run. A result is
+keyed by the SHA-256 of the source file, the name of the effect, the arguments which affect its output (including any
+random seed) and the output format. A hit is copied straight to the output file, without decoding the source or running
+the effect.
+
+Entries are written to a temporary file and renamed into place, so workers sharing a cache never see partial entries.
+The cache holds at most a fixed number of bytes, evicting the least recently used entries (by modification time, which
+is updated on every hit) once it is full. A size of 0 turns the cache off: nothing is looked up, stored or counted.
+
+Scripts use it through result_cache(args, effect, file_name) in their process_file, eg.
+
+    cache = result_cache(args, "sort", file_name)
+    if not cache.fetch(output_name):
+        ...
+        cache.store(output_name)
+
+Hit and miss counts are kept per process in the cache directory, and summed by ResultCache.stats, so they cover every
+worker. Run imagemutation cache to print them. The counts of processes which have exited are merged into a single
+file (on POSIX systems), so the directory does not fill up with them.
+"""
+
+CACHE_BYTES = 2 ** 30
+
+# Bump when a change to an effect alters its output, so older entries are no longer used.
+CACHE_VERSION = 2
+
+# Arguments which only affect how an effect is run, not its output, and so are left out of cache keys. Pipeline stages
+# are described by the pipeline argument they were parsed from.
+EXECUTION_ARGUMENTS = {"files", "jobs", "max_in_flight", "strip_workers", "strip_processes", "stream", "strip_budget",
+                       "temp_dir", "engine", "cache_dir", "cache_size", "profile", "profile_memory", "stages"}
+
+
+def _cache_size(value):
+    """ Parses the --cache_size argument, which may not be negative. """
+    import argparse
+
+    size = int(value)
+    if size < 0:
+        raise argparse.ArgumentTypeError(f"must be at least 0, not {size}.")
+    return size
+
+
+def add_cache_arguments(parser):
+    """ Adds the --cache_dir and --cache_size arguments to parser. """
+    parser.add_argument("--cache_dir", dest="cache_dir", default=None,
+                        help="Directory of a cache of results. Files which have already been processed with the same "
+                             "arguments are copied from the cache rather than processed again.")
+    parser.add_argument("--cache_size", dest="cache_size", default=CACHE_BYTES // 2 ** 20, type=_cache_size,
+                        help="Maximum size of the cache, in MiB. The least recently used results are evicted first. "
+                             "0 turns the cache off.")
+
+
+def file_digest(file_name, block_bytes=2 ** 20):
+    """ Returns the SHA-256 of the contents of a file, as a hex string. """
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(block_bytes), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def deterministic(args):
+    """ Returns whether the output of an effect is determined by args, ie. nothing is drawn at random without a seed,
+    including in any pipeline stage. """
+    if getattr(args, "random_rows", False) and getattr(args, "seed", None) is None:
+        return False
+    if getattr(args, "random_fit", False):
+        return False
+    return all(deterministic(stage_args) for _, _, stage_args in getattr(args, "stages", ()))
+
+
+def atomic_copy(source, target):
+    """ Copies source to target, through a temporary file next to target, so target is either absent (or its previous
+    contents) or complete. """
+    import shutil
+    import tempfile
+
+    handle, temp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target)), prefix=".tmp-")
+    try:
+        with os.fdopen(handle, "wb") as temp, open(source, "rb") as f:
+            shutil.copyfileobj(f, temp)
+        os.replace(temp_name, target)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
+
+
+def _can_merge_stats():
+    """ Returns whether the counts of exited processes can be merged: the files of counts can be locked, and whether
+    a process is running can be checked without affecting it. """
+    return os.name == "posix"
+
+
+def _running(pid):
+    """ Returns whether the process with the given id is running (POSIX only). """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextmanager
+def _stats_lock(directory, exclusive):
+    """ Holds a lock on the files of counts in directory, so they are not read while being merged (POSIX only). """
+    if not _can_merge_stats():
+        yield
+        return
+
+    import fcntl
+
+    with open(os.path.join(directory, "stats.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def _read_counts(path):
+    """ Returns the counts saved in path, or none if it is missing or partially written. """
+    import json
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_json(directory, name, value):
+    """ Writes value to a file in directory, through a temporary file, so readers never see a partial file. """
+    import json
+    import tempfile
+
+    handle, temp_name = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    with os.fdopen(handle, "w") as f:
+        json.dump(value, f)
+    os.replace(temp_name, os.path.join(directory, name))
+
+
+class ResultCache:
+    """ A directory of results, keyed by content. Safe to share between processes. """
+
+    def __init__(self, directory, max_bytes=CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pid = os.getpid()
+        os.makedirs(os.path.join(directory, "entries"), exist_ok=True)
+        self._load_stats()
+        self._merge_stats()
+        if _can_merge_stats():
+            import atexit
+            atexit.register(self._merge_stats, True)
+
+    def key(self, file_name, effect, args):
+        """ Returns the key of the result of applying effect to file_name with args, or None if the result can not be
+        cached. """
+        import hashlib
+        import json
+
+        if not deterministic(args):
+            return None
+        parameters = {name: value for name, value in sorted(vars(args).items()) if name not in EXECUTION_ARGUMENTS}
+        description = json.dumps([CACHE_VERSION, effect, parameters, os.path.splitext(file_name)[-1].lower()],
+                                 default=str)
+        return hashlib.sha256(f"{file_digest(file_name)}\n{description}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, "entries", key)
+
+    def fetch(self, key, output_name):
+        """ Copies the result with the given key to output_name, and returns True if it was cached. Otherwise returns
+        False. """
+        try:
+            atomic_copy(self._path(key), output_name)
+        except FileNotFoundError:
+            self.misses += 1
+            self._save_stats()
+            return False
+        try:
+            # Marks the entry as recently used.
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            # Evicted by another worker since it was copied, which is harmless.
+            pass
+        self.hits += 1
+        self._save_stats()
+        return True
+
+    def store(self, key, output_name):
+        """ Adds output_name to the cache as the result with the given key, then evicts results if the cache is
+        full. """
+        atomic_copy(output_name, self._path(key))
+        self.evict()
+
+    def entries(self):
+        """ Returns a list of (modification time, size, path) for each entry, least recently used first. """
+        entries = []
+        with os.scandir(os.path.join(self.directory, "entries")) as scan:
+            for entry in scan:
+                if entry.name.startswith(".tmp-"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(entries)
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache holds at most max_bytes. """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._save_stats()
+
+    def _stats_name(self):
+        return os.path.join(self.directory, f"stats-{os.getpid()}.json")
+
+    def _load_stats(self):
+        """ Continues from the counts previously saved by this process (or an earlier one with the same id). """
+        import json
+
+        try:
+            with open(self._stats_name()) as f:
+                for count, value in json.load(f).items():
+                    setattr(self, count, value)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def _save_stats(self):
+        """ Writes this process' counts to the cache directory, replacing the previous ones. """
+        _write_json(self.directory, os.path.basename(self._stats_name()),
+                    {"hits": self.hits, "misses": self.misses, "evictions": self.evictions})
+
+    def _stats_files(self):
+        """ Returns the names of the files of counts in the cache directory: the merged counts, and those of each
+        process. """
+        return [name for name in os.listdir(self.directory)
+                if name == "stats.json" or name.startswith("stats-") and name.endswith(".json")]
+
+    def _merge_stats(self, exiting=False):
+        """ Adds the counts of every process which has exited (including this one, if exiting) to the merged counts,
+        and deletes their own files. Processes are only checked for on POSIX systems. Elsewhere, files are kept. """
+        if not _can_merge_stats() or os.getpid() != self.pid:
+            return
+        with _stats_lock(self.directory, True):
+            merged = _read_counts(os.path.join(self.directory, "stats.json"))
+            finished = []
+            for name in self._stats_files():
+                if name == "stats.json":
+                    continue
+                try:
+                    pid = int(name[len("stats-"):-len(".json")])
+                except ValueError:
+                    continue
+                if (pid == self.pid and exiting) or (pid != self.pid and not _running(pid)):
+                    for count, value in _read_counts(os.path.join(self.directory, name)).items():
+                        merged[count] = merged.get(count, 0) + value
+                    finished.append(name)
+            if not finished:
+                return
+            _write_json(self.directory, "stats.json", merged)
+            for name in finished:
+                os.unlink(os.path.join(self.directory, name))
+
+    def stats(self):
+        """ Returns the number of entries and bytes in the cache, and the hits, misses and evictions of every process
+        which has used it (since clear_stats). """
+        stats = {"entries": 0, "bytes": 0, "hits": 0, "misses": 0, "evictions": 0}
+        for _, size, _ in self.entries():
+            stats["entries"] += 1
+            stats["bytes"] += size
+        with _stats_lock(self.directory, False):
+            for name in self._stats_files():
+                for count, value in _read_counts(os.path.join(self.directory, name)).items():
+                    stats[count] += value
+        return stats
+
+    def clear_stats(self):
+        """ Resets the hit, miss and eviction counts of every process. """
+        with _stats_lock(self.directory, True):
+            for name in self._stats_files():
+                os.unlink(os.path.join(self.directory, name))
+        self.hits = self.misses = self.evictions = 0
+
+
+class CachedResult:
+    """ The cache entry for one result, as returned by result_cache. If caching is off, or the result can not be cached,
+    fetch always misses and store does nothing. """
+
+    def __init__(self, cache=None, key=None):
+        self.cache = cache
+        self.key = key
+
+    def fetch(self, output_name):
+        """ Copies the cached result to output_name, and returns True if there was one. Otherwise returns False. """
+        return self.key is not None and self.cache.fetch(self.key, output_name)
+
+    def store(self, output_name):
+        """ Adds output_name to the cache as the result. """
+        if self.key is not None:
+            self.cache.store(self.key, output_name)
+
+
+# One cache per directory in each process, so its counts accumulate.
+_CACHES = {}
+
+
+def result_cache(args, effect, file_name):
+    """ Returns the CachedResult for applying effect to file_name, as specified by args. Caching is off if args has no
+    cache_dir, or a cache_size of 0. """
+    if getattr(args, "cache_dir", None) is None or args.cache_size == 0:
+        return CachedResult()
+    directory = os.path.abspath(args.cache_dir)
+    # Forked workers start with their parent's caches, whose counts are not theirs.
+    if directory not in _CACHES or _CACHES[directory].pid != os.getpid():
+        _CACHES[directory] = ResultCache(directory)
+    cache = _CACHES[directory]
+    cache.max_bytes = args.cache_size * 2 ** 20
+    return CachedResult(cache, cache.key(file_name, effect, args))
+
+
+def parse_args(argv=None, prog=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--cache_dir", dest="cache_dir", required=True, help="The cache to report on.")
+    parser.add_argument("--clear_stats", dest="clear_stats", action="store_true",
+                        help="Reset the hit, miss and eviction counts after reporting them.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None, prog=None):
+    """ Program runner: prints the statistics of a cache."""
+    args = parse_args(argv, prog)
+    cache = ResultCache(args.cache_dir)
+    for name, value in cache.stats().items():
+        print(f"{name:<10} {value}")
+    if args.clear_stats:
+        cache.clear_stats()
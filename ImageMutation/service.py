@@ -0,0 +1,425 @@
+import asyncio
+from .image_utilities import load_pixels, save_pixels
+from .pipeline import EFFECTS, parse_pipeline, run_pipeline, effect_module
+
+"""
+Serves the effects over HTTP, from a single long running process, so requests do not pay for starting Python, importing
+numpy and PIL, and parsing arguments. Only the standard library is needed.
+
+An image is processed by POSTing it to /<effect>, with the effect's options (as taken by its script, without the leading
+dashes) in the query string, or to /pipeline with a pipeline (see pipeline.py). The response is the processed image, in
+the same format as the request, eg.
+
+    curl --data-binary @image.png "http://localhost:8000/sort?mode=0&row_only" -o sorted.png
+    curl --data-binary @image.png "http://localhost:8000/pipeline?pipeline=sort:mode=0|shift" -o out.png
+
+GET /metrics returns the service's counters and queue depth as JSON.
+
+Images are decoded, processed and encoded on a pool of worker processes. Requests wait in a queue for a worker, and are
+rejected (503) once max_pending are queued or running. A request which takes longer than its timeout to complete is
+answered with 504 - although work which has already started still runs to completion, as processes can not be
+interrupted. Options are checked by the effects' own parsers before a request is queued, so requests which are invalid,
+or which could never finish (eg. a checkerboard of size 0), are answered with 400 without reaching a worker. Small
+images are micro-batched: a worker takes up to batch_size of them (waiting up to batch_window for more to arrive) and
+processes them in one call, which saves a round trip to the pool per image.
+"""
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 411: "Length Required",
+           413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+class Overloaded(Exception):
+    """ Raised when a request is not admitted, as too many requests are already pending. """
+
+
+class Job:
+    """ A request waiting for (or being processed by) a worker. """
+
+    def __init__(self, stages, data, small):
+        self.stages = stages
+        self.data = data
+        self.small = small
+        self.future = asyncio.get_running_loop().create_future()
+
+
+def process_request(stages, data):
+    """ Decodes an encoded image, applies a pipeline to it, and returns it encoded in the same format. Runs in a worker
+    process. """
+    import io
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        image_format = img.format
+    pixels, _ = run_pipeline(load_pixels(io.BytesIO(data)), stages)
+    output = io.BytesIO()
+    save_pixels(pixels, output, image_format)
+    return output.getvalue()
+
+
+def process_batch(requests):
+    """ Applies process_request to each (stages, data) pair in requests. Runs in a worker process.
+
+    :return:    The result of each request, or the exception it raised.
+    """
+    results = []
+    for stages, data in requests:
+        try:
+            results.append(process_request(stages, data))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _warm_up():
+    """ Imports every effect in a new worker process, so the first request it handles does not pay for it. """
+    for effect in EFFECTS:
+        effect_module(effect)
+
+
+class EffectService:
+    """ Runs requests on a pool of worker processes, with admission control, timeouts and micro-batching. Use as an
+    asynchronous context manager, from within a running event loop.
+
+    :param workers:         Number of worker processes.
+    :param max_pending:     Maximum number of requests queued or running at once. Further requests are rejected.
+    :param timeout:         Seconds a request may take, including time queued, before it fails with a TimeoutError.
+    :param batch_bytes:     Requests with at most this many bytes of image are small, and may be batched.
+    :param batch_size:      Maximum number of small requests processed by a worker in one call.
+    :param batch_window:    Seconds to wait for further small requests before sending an incomplete batch.
+    """
+
+    def __init__(self, workers=1, max_pending=64, timeout=30.0, batch_bytes=2 ** 18, batch_size=8,
+                 batch_window=0.005):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.batch_bytes = batch_bytes
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+
+        self.counters = dict.fromkeys(["admitted", "rejected", "completed", "failed", "timed_out", "batches",
+                                       "batched_requests"], 0)
+        self.running = 0
+        self.held = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._queue = None
+        self._executor = None
+        self._dispatchers = []
+
+    async def __aenter__(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        self._queue = asyncio.Queue()
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_warm_up)
+        self._dispatchers = [asyncio.create_task(self._dispatch()) for _ in range(self.workers)]
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for dispatcher in self._dispatchers:
+            dispatcher.cancel()
+        await asyncio.gather(*self._dispatchers, return_exceptions=True)
+        self._executor.shutdown(cancel_futures=True)
+
+    @property
+    def queue_depth(self):
+        """ Number of admitted requests which are not yet being processed. """
+        return self._queue.qsize() + self.held
+
+    async def submit(self, stages, data):
+        """ Processes an encoded image with a pipeline, and returns the encoded result.
+
+        :param stages:  The stages to apply, as returned by parse_pipeline.
+        :param data:    The encoded image.
+        :return:        The encoded result, in the same format as data.
+        :raises:        Overloaded if the request was not admitted, TimeoutError if it took longer than the timeout,
+                        or the exception raised while processing it.
+        """
+        loop = asyncio.get_running_loop()
+        if self.queue_depth + self.running >= self.max_pending:
+            self.counters["rejected"] += 1
+            raise Overloaded(f"{self.max_pending} requests are already pending.")
+        self.counters["admitted"] += 1
+
+        start = loop.time()
+        job = Job(stages, data, len(data) <= self.batch_bytes)
+        self._queue.put_nowait(job)
+        try:
+            # On a timeout, job.future is cancelled, and dispatchers skip it.
+            result = await asyncio.wait_for(job.future, self.timeout)
+        except asyncio.TimeoutError:
+            self.counters["timed_out"] += 1
+            raise
+        except Exception:
+            self.counters["failed"] += 1
+            raise
+        self.counters["completed"] += 1
+        latency = loop.time() - start
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        return result
+
+    def _take_small(self, jobs):
+        """ Moves small jobs from the queue into jobs, until the batch is full or a large job is found. Returns the
+        large job, if one was found. """
+        while len(jobs) < self.batch_size and not self._queue.empty():
+            job = self._queue.get_nowait()
+            if not job.small:
+                return job
+            jobs.append(job)
+        return None
+
+    async def _dispatch(self):
+        """ Sends jobs from the queue to the pool, one call at a time. """
+        loop = asyncio.get_running_loop()
+        carried = None
+        while True:
+            if carried is None:
+                job = await self._queue.get()
+            else:
+                job, carried = carried, None
+                self.held -= 1
+            jobs = [job]
+            if job.small:
+                carried = self._take_small(jobs)
+                if carried is None and len(jobs) < self.batch_size and self.batch_window > 0:
+                    await asyncio.sleep(self.batch_window)
+                    carried = self._take_small(jobs)
+                self.held += carried is not None
+
+            jobs = [job for job in jobs if not job.future.done()]
+            if not jobs:
+                continue
+            if len(jobs) > 1:
+                self.counters["batches"] += 1
+                self.counters["batched_requests"] += len(jobs)
+
+            self.running += len(jobs)
+            try:
+                results = await loop.run_in_executor(self._executor, process_batch,
+                                                     [(job.stages, job.data) for job in jobs])
+            except Exception as e:
+                # Eg. a worker process died.
+                results = [e] * len(jobs)
+            finally:
+                self.running -= len(jobs)
+
+            for job, result in zip(jobs, results):
+                if job.future.done():
+                    continue
+                if isinstance(result, Exception):
+                    job.future.set_exception(result)
+                else:
+                    job.future.set_result(result)
+
+    def metrics(self):
+        """ Returns the service's counters, queue depth and latencies, as a dict. """
+        completed = self.counters["completed"]
+        return dict(self.counters, queue_depth=self.queue_depth, running=self.running, max_pending=self.max_pending,
+                    workers=self.workers, mean_latency=self.total_latency / completed if completed else 0.0,
+                    max_latency=self.max_latency)
+
+
+def _is_number(token):
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+
+def stage_options(effect, options):
+    """ Checks the options of a stage of a request, before they are given to the effect's script.
+
+    :param effect:  The name of the effect.
+    :param options: A list of (name, value) pairs, where value is "" for flags.
+    :return:        The options, as a stage of a pipeline, eg. "sort:mode=0,row_only".
+    :raises:        ValueError if an option controls how the effect is run (eg. its workers), rather than its output,
+                    or a value could be read as more options or stages.
+    """
+    from .result_cache import EXECUTION_ARGUMENTS
+
+    for name, value in options:
+        if name in EXECUTION_ARGUMENTS:
+            raise ValueError(f"option {name!r} of {effect} controls how the effect is run, which is up to the service.")
+        if any(character in name + value for character in "|,="):
+            raise ValueError(f"option {name!r} of {effect} contains one of \"|\", \",\" or \"=\".")
+        if any(token.startswith("-") and not _is_number(token) for token in [name] + value.split()):
+            raise ValueError(f"option {name!r} of {effect} contains an option of its own.")
+    return ":".join(filter(None, [effect, ",".join(f"{name}={value}" if value else name for name, value in options)]))
+
+
+def request_stages(effect, query):
+    """ Parses the effect and query string of a request into pipeline stages. Only the options of each effect's own
+    script which affect its output can be given: options which control how it is run (see
+    result_cache.EXECUTION_ARGUMENTS, eg. strip_workers) are rejected, as are abbreviated or aliased options.
+
+    :param effect:  The path of the request, without the leading "/": the name of an effect, or "pipeline".
+    :param query:   The query string. For an effect, these are its options, eg. "mode=0&row_only". For a pipeline, it
+                    is the pipeline, eg. "pipeline=sort:mode=0|shift".
+    :return:        The stages, as returned by parse_pipeline.
+    :raises:        ValueError if the options are not valid.
+    """
+    import contextlib
+    import io
+    from urllib.parse import parse_qsl
+    from PIL import Image
+
+    options = parse_qsl(query, keep_blank_values=True)
+    if effect == "pipeline":
+        pipeline = dict(options).get("pipeline")
+        if not pipeline:
+            raise ValueError("a pipeline must be given, eg. /pipeline?pipeline=sort:mode=0|shift")
+        requested = []
+        for stage in pipeline.split("|"):
+            name, _, text = stage.strip().partition(":")
+            pairs = [option.strip().partition("=")[::2] for option in text.split(",") if option.strip()]
+            requested.append((name.strip(), [(option.strip(), value.strip()) for option, value in pairs]))
+    else:
+        requested = [(effect, options)]
+    pipeline = " | ".join(stage_options(name, stage) for name, stage in requested)
+
+    # The scripts' argument parsers exit on errors, after printing them.
+    errors = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(errors):
+            parsed = parse_pipeline(pipeline)
+    except SystemExit:
+        lines = errors.getvalue().strip().splitlines()
+        raise ValueError(lines[-1].partition("error: ")[2] if lines else f"invalid options for {effect}.")
+
+    # Options must be given by their full names, so only the effect's own parameters are accepted.
+    for (_, name, args), (_, stage) in zip(parsed, requested):
+        for option, _ in stage:
+            if option not in vars(args):
+                raise ValueError(f"unknown option {option!r} of {name}.")
+        # A reshape allocates its whole output when it pads, so it may be no larger than the images PIL will decode.
+        if name == "reshape" and args.reshape is not None and Image.MAX_IMAGE_PIXELS is not None and \
+                args.reshape[0] * args.reshape[1] > Image.MAX_IMAGE_PIXELS:
+            raise ValueError(f"reshape may not produce more than {Image.MAX_IMAGE_PIXELS} pixels.")
+    return parsed
+
+
+async def read_request(reader, max_body):
+    """ Reads a HTTP request.
+
+    :return:    The status to respond with if the request is not valid (or None), the method, the target and the body.
+    """
+    method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if method != "POST":
+        return None, method, target, b""
+    if "content-length" not in headers:
+        return 411, method, target, b""
+    length = int(headers["content-length"])
+    if length > max_body:
+        return 413, method, target, b""
+    return None, method, target, await reader.readexactly(length)
+
+
+async def respond(service, method, target, body):
+    """ Handles a request.
+
+    :return:    The status, content type and body of the response, and any extra headers.
+    """
+    import json
+    from urllib.parse import urlsplit
+
+    url = urlsplit(target)
+    effect = url.path.strip("/")
+    if effect == "metrics":
+        if method != "GET":
+            return 405, "text/plain", b"Use GET.", {}
+        return 200, "application/json", json.dumps(service.metrics()).encode(), {}
+    if effect not in EFFECTS and effect != "pipeline":
+        return 404, "text/plain", f"Unknown effect. Effects are: {', '.join(EFFECTS)}, pipeline.".encode(), {}
+    if method != "POST":
+        return 405, "text/plain", b"POST an image.", {}
+
+    try:
+        stages = request_stages(effect, url.query)
+    except ValueError as e:
+        return 400, "text/plain", str(e).encode(), {}
+    try:
+        return 200, "application/octet-stream", await service.submit(stages, body), {}
+    except Overloaded as e:
+        return 503, "text/plain", str(e).encode(), {"Retry-After": "1"}
+    except asyncio.TimeoutError:
+        return 504, "text/plain", b"The request timed out.", {}
+    except Exception as e:
+        return 500, "text/plain", f"{type(e).__name__}: {e}".encode(), {}
+
+
+async def handle_connection(service, max_body, reader, writer):
+    """ Answers a single request on a connection, then closes it. """
+    try:
+        status, method, target, body = await read_request(reader, max_body)
+        if status is None:
+            status, content_type, body, headers = await respond(service, method, target, body)
+        else:
+            content_type, body, headers = "text/plain", REASONS[status].encode(), {}
+    except (ValueError, asyncio.IncompleteReadError):
+        status, content_type, body, headers = 400, "text/plain", b"Malformed request.", {}
+    except Exception as e:
+        # Answered rather than left to the server, which would close the connection without a response.
+        status, content_type, body, headers = 500, "text/plain", f"{type(e).__name__}: {e}".encode(), {}
+
+    head = [f"HTTP/1.1 {status} {REASONS[status]}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}",
+            "Connection: close"] + [f"{name}: {value}" for name, value in headers.items()]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+def parse_args(argv=None, prog=None):
+    import argparse
+    import os
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--host", dest="host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", dest="port", default=8000, type=int, help="Port to listen on.")
+    parser.add_argument("--workers", dest="workers", default=os.cpu_count() or 1, type=int,
+                        help="Number of worker processes. Defaults to the number of CPUs.")
+    parser.add_argument("--max_pending", dest="max_pending", default=64, type=int,
+                        help="Maximum number of requests queued or running. Further requests are answered with 503.")
+    parser.add_argument("--timeout", dest="timeout", default=30.0, type=float,
+                        help="Seconds a request may take, including time queued, before it is answered with 504.")
+    parser.add_argument("--batch_bytes", dest="batch_bytes", default=256, type=int,
+                        help="Images of at most this many KiB are small, and are batched together.")
+    parser.add_argument("--batch_size", dest="batch_size", default=8, type=int,
+                        help="Maximum number of small images processed by a worker at once.")
+    parser.add_argument("--batch_window", dest="batch_window", default=5.0, type=float,
+                        help="Milliseconds to wait for more small images before processing an incomplete batch.")
+    parser.add_argument("--max_body", dest="max_body", default=64, type=int,
+                        help="Largest image accepted, in MiB. Larger ones are answered with 413.")
+    return parser.parse_args(argv)
+
+
+async def serve(args):
+    """ Runs the service until cancelled. """
+    from functools import partial
+
+    async with EffectService(args.workers, args.max_pending, args.timeout, args.batch_bytes * 2 ** 10,
+                             args.batch_size, args.batch_window / 1000) as service:
+        server = await asyncio.start_server(partial(handle_connection, service, args.max_body * 2 ** 20),
+                                            args.host, args.port)
+        print(f"Serving on http://{args.host}:{args.port} with {args.workers} workers")
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None, prog=None):
+    """ Program runner: parses the arguments and serves requests until interrupted."""
+    args = parse_args(argv, prog)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
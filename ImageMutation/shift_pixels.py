@@ -1,18 +1,35 @@
-from PIL import Image
 import numpy as np
-from image_utilities import ranges
+from .image_utilities import demo_image, ranges, load_pixels, save_pixels, add_stream_arguments, stream_passes
+from .batch_runner import add_batch_arguments, run_files
+from .result_cache import add_cache_arguments, result_cache
+from .strips import add_strip_arguments, strip_runner
+from .profiling import add_profile_arguments, stage
 
 
-def parse_args():
+def parse_args(argv=None, prog=None):
     import argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--files", "-f", dest="files", default=["../demo/nasa--hI5dX2ObAs-unsplash.jpg"], nargs="+",
-                        help="File(s) to sort. Can be any format supported by PIL. ")
-    parser.add_argument("--checkerboard", nargs=1, default=200,
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--files", "-f", dest="files", default=[demo_image("nasa--hI5dX2ObAs-unsplash.jpg")],
+                        nargs="+", help="File(s) to sort. Can be any format supported by PIL. ")
+    parser.add_argument("--checkerboard", type=int, default=200,
                         help="Size of checkerboard pattern.")
     parser.add_argument("--crop_to_fit", action="store_true",
                         help="Crops the image to fit the checkerboard pattern.")
-    return parser.parse_args()
+    parser.add_argument("--engine", default="batched", choices=["batched", "per_row"],
+                        help="batched: Shifts every selected row or column at once.\n"
+                             "per_row: Shifts each row and column separately.")
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_profile_arguments(parser)
+    add_strip_arguments(parser)
+    add_stream_arguments(parser)
+
+    args = parser.parse_args(argv)
+    if args.checkerboard <= 0:
+        parser.error("argument --checkerboard must be at least 1.")
+    if args.stream and args.crop_to_fit:
+        parser.error("argument --crop_to_fit can not be used with --stream.")
+    return args
 
 
 def shift_row_wrapped(row: np.ndarray, shift_by: int):
@@ -39,48 +56,170 @@ def shift_row_wrapped(row: np.ndarray, shift_by: int):
     row[row_len - shift_by:] = left_part
 
 
-def shift_rows_and_cols(image, rows_to_shift, cols_to_shift, shift_rows_by, shift_columns_by):
+def shift_lines(image, selected, shift_by, columns=False, scratch_bytes=2 ** 24):
+    """ Shifts each selected row (or column) of image to the right (or down), as shift_row_wrapped does. Consecutive
+    selected lines are shifted together, as a slice of the image, through a scratch buffer which is reused for every
+    block of lines.
+
+    :param image:           The image to modify, in place.
+    :param selected:        An array of the rows (or columns) to shift. Each line should appear at most once.
+    :param shift_by:        The amount to shift the lines by to the right (-ve if to the left). Either an int, or an
+                            array with one entry for each entry of selected.
+    :param columns:         If True, shifts columns, rather than rows.
+    :param scratch_bytes:   The approximate size of the scratch buffer.
+    :return:                Nothing: operations are done in place.
+    """
+    line_axis = 1 if columns else 0
+    length = image.shape[1 - line_axis]
+    if len(selected) == 0 or length == 0:
+        return
+
+    uniform = np.ndim(shift_by) == 0
+    shift_by = np.asarray(shift_by, dtype=np.intp) % length
+    if uniform and shift_by == 0:
+        return
+
+    order = np.argsort(selected, kind="stable")
+    selected = np.asarray(selected)[order]
+    if not uniform:
+        shift_by = shift_by[order]
+
+    line_size = image.size // image.shape[line_axis]
+    block = max(1, min(len(selected), scratch_bytes // max(line_size * image.itemsize, 1)))
+    scratch = np.empty(block * line_size, dtype=image.dtype)
+
+    # Runs of consecutive lines, split into blocks of at most block lines.
+    breaks = np.flatnonzero(np.diff(selected) != 1) + 1
+    for run_start, run_end in zip(np.concatenate(([0], breaks)), np.concatenate((breaks, [len(selected)]))):
+        for first in range(run_start, run_end, block):
+            last = min(first + block, run_end)
+            lines = slice(selected[first], selected[last - 1] + 1)
+            view = image[:, lines] if columns else image[lines]
+            shifted = scratch[:view.size].reshape(view.shape)
+
+            # Both as lines x length x channels views.
+            view_lines = np.moveaxis(view, line_axis, 0)
+            shifted_lines = np.moveaxis(shifted, line_axis, 0)
+            if uniform:
+                shifted_lines[:, shift_by:] = view_lines[:, :length - shift_by]
+                shifted_lines[:, :shift_by] = view_lines[:, length - shift_by:]
+            else:
+                for line, shifted_line, amount in zip(view_lines, shifted_lines, shift_by[first:last]):
+                    shifted_line[amount:] = line[:length - amount]
+                    shifted_line[:amount] = line[length - amount:]
+            view[...] = shifted
+
+
+def _shift_strip(image, selected, shift_by, columns, engine):
+    """ Shifts the selected columns (or rows) of a strip of an image. shift_by has an entry for every line of the
+    strip. """
+    if columns:
+        shift_rows_and_cols(image, [], selected, 0, shift_by[selected], engine=engine)
+    else:
+        shift_rows_and_cols(image, selected, [], shift_by[selected], 0, engine=engine)
+
+
+def shift_rows_and_cols(image, rows_to_shift, cols_to_shift, shift_rows_by, shift_columns_by, strip_runner=None,
+                        engine="batched"):
     """ Shifts all specified rows and columns (in rows_to_shift and cols_to_shift) by the specified amount. This wraps.
 
     SIDE EFFECTS: Will modify the input image - provide a copy to sort on if this is unwanted.
 
-    :param shift_columns_by:    How many pixels to shift the specified columns by.
-    :param shift_rows_by:       How many pixels to shift the specified rows by.
-    :param cols_to_shift:       The specific columns in the image which should be shifted.
-    :param rows_to_shift:       The specific rows in the image which should be shifted.
+    :param shift_columns_by:    How many pixels to shift the specified columns by. Either an int, or a sequence with
+                                one entry for each of cols_to_shift.
+    :param shift_rows_by:       How many pixels to shift the specified rows by. Either an int, or a sequence with one
+                                entry for each of rows_to_shift.
+    :param cols_to_shift:       The specific columns in the image which should be shifted. Each column should appear at
+                                most once.
+    :param rows_to_shift:       The specific rows in the image which should be shifted. Each row should appear at most
+                                once.
     :param image:               The image to modify.
+    :param strip_runner:        A StripRunner to split the rows and columns between. If workers are processes, image
+                                must be the array given by strip_runner.apply.
+    :param engine:              "batched" to shift blocks of rows (or columns) at once, or "per_row" to shift each row
+                                and column separately.
     :return:                    Nothing. Image is modified in place - user is expected to provide a copy.
     """
 
-    for row in rows_to_shift:
-        shift_row_wrapped(image[row, :], shift_rows_by)
+    rows, cols, _ = image.shape
+    rows_to_shift = np.fromiter(rows_to_shift, dtype=np.intp)
+    cols_to_shift = np.fromiter(cols_to_shift, dtype=np.intp)
+
+    if strip_runner is not None:
+        row_shifts = np.zeros(rows, dtype=np.intp)
+        row_shifts[rows_to_shift] = shift_rows_by
+        col_shifts = np.zeros(cols, dtype=np.intp)
+        col_shifts[cols_to_shift] = shift_columns_by
+        strip_runner.run(_shift_strip, [image], False, rows_to_shift, False, engine, per_line=[row_shifts])
+        strip_runner.run(_shift_strip, [image], True, cols_to_shift, True, engine, per_line=[col_shifts])
+        return
 
-    for col in cols_to_shift:
-        shift_row_wrapped(image[:, col], shift_columns_by)
+    if engine == "batched":
+        shift_lines(image, rows_to_shift, shift_rows_by)
+        shift_lines(image, cols_to_shift, shift_columns_by, columns=True)
+        return
 
+    for row, shift_by in zip(rows_to_shift, np.broadcast_to(shift_rows_by, rows_to_shift.shape)):
+        shift_row_wrapped(image[row, :], int(shift_by))
+
+    for col, shift_by in zip(cols_to_shift, np.broadcast_to(shift_columns_by, cols_to_shift.shape)):
+        shift_row_wrapped(image[:, col], int(shift_by))
 
-def main():
-    """ Program runner: parses the arguments and produces the appropriate images."""
-    import os
 
-    args = parse_args()
+def _shift_stream_strip(shift_by, strip, selected):
+    """ Shifts the selected rows of a strip of an image which is being streamed. """
+    shift_lines(strip, selected, shift_by)
 
-    for file_name in args.files:
-        img = Image.open(file_name)
-        pixels = np.copy(np.asarray(img))
-        rows, cols, _ = pixels.shape
 
-        if args.crop_to_fit:
-            rows -= rows % args.checkerboard
-            cols -= cols % args.checkerboard
-            pixels = pixels[0:rows, 0:cols]
+def process_pixels(args, pixels, key_cache=None):
+    """ Shifts pixels in place, as specified by args, and returns them (cropped, if args.crop_to_fit is set). Any maps
+    of pixels in key_cache (a sort_keys.KeyCache) are discarded. """
+    rows, cols, _ = pixels.shape
 
-        shift_rows_and_cols(pixels, ranges(args.checkerboard, rows), ranges(args.checkerboard, cols),
-                            2*args.checkerboard, args.checkerboard)
+    if args.crop_to_fit:
+        rows -= rows % args.checkerboard
+        cols -= cols % args.checkerboard
+        pixels = pixels[0:rows, 0:cols]
 
-        im = Image.fromarray(pixels)
-        im.save(f"{os.path.splitext(file_name)[0]}_shifted{os.path.splitext(file_name)[-1]}")
+    with stage("shift"), strip_runner(args) as runner:
+        if runner is None:
+            shift_rows_and_cols(pixels, ranges(args.checkerboard, rows), ranges(args.checkerboard, cols),
+                                2*args.checkerboard, args.checkerboard, engine=args.engine)
+        else:
+            runner.apply(shift_rows_and_cols, [pixels], ranges(args.checkerboard, rows),
+                         ranges(args.checkerboard, cols), 2*args.checkerboard, args.checkerboard, runner, args.engine)
+    if key_cache is not None:
+        key_cache.invalidate(pixels)
+    return pixels
 
 
-if __name__ == "__main__":
-    main()
+def process_file(args, file_name):
+    """ Shifts the pixels of a single file, as specified by args, and returns the name of the new file. """
+    import os
+    from functools import partial
+
+    output_name = f"{os.path.splitext(file_name)[0]}_shifted{os.path.splitext(file_name)[-1]}"
+    cache = result_cache(args, "shift", file_name)
+    if cache.fetch(output_name):
+        return output_name
+
+    if args.stream:
+        # Columns are streamed as the rows of the transposed image.
+        checkerboard = partial(ranges, args.checkerboard)
+        passes = [(False, checkerboard, partial(_shift_stream_strip, 2*args.checkerboard)),
+                  (True, checkerboard, partial(_shift_stream_strip, args.checkerboard))]
+        stream_passes(file_name, output_name, passes, args.strip_budget * 2 ** 20, args.temp_dir)
+    else:
+        save_pixels(process_pixels(args, load_pixels(file_name)), output_name)
+    cache.store(output_name)
+    return output_name
+
+
+def main(argv=None, prog=None):
+    """ Program runner: parses the arguments and produces the appropriate images."""
+    from functools import partial
+
+    args = parse_args(argv, prog)
+    if run_files(partial(process_file, args), args.files, args.jobs, args.max_in_flight, args.profile,
+                 args.profile_memory):
+        raise SystemExit(1)
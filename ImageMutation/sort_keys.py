@@ -0,0 +1,201 @@
+import numpy as np
+from collections import OrderedDict
+from .image_utilities import brightness
+from .profiling import stage, count
+
+"""
+Sort keys map an image (a rows x cols x channels array) to a rows x cols uint8 array holding the weight of each pixel.
+Effects sort on these weights, and use them to find intervals and heights. Keys are registered by name in KEYS, so
+effects (and the command line) can take the name of a key rather than a function.
+
+Key maps can be memoized in a KeyCache. Then several passes or effects on the same image share one map rather than
+each computing their own.
+"""
+
+KEYS = {}
+
+
+def register_key(name):
+    """ Returns a decorator which registers a function as the sort key called name. The function takes a
+    rows x cols x channels array of pixels, and returns a new rows x cols uint8 array. """
+    def register(fn):
+        KEYS[name] = fn
+        return fn
+    return register
+
+
+def _colour_channels(pixels):
+    """ Returns the red, green and blue channels of pixels. Greyscale images use their grey level for all three. """
+    if pixels.shape[2] < 3:
+        return pixels[:, :, 0], pixels[:, :, 0], pixels[:, :, 0]
+    return pixels[:, :, 0], pixels[:, :, 1], pixels[:, :, 2]
+
+
+def _by_block(fn, pixels, block_pixels=2 ** 20):
+    """ Applies fn to blocks of about block_pixels pixels at a time, so the temporary arrays of fn stay small, and
+    returns the results as a single uint8 map. """
+    rows, cols = pixels.shape[:2]
+    key_map = np.empty((rows, cols), dtype=np.uint8)
+    block = max(1, block_pixels // max(cols, 1))
+    for first in range(0, rows, block):
+        key_map[first:first + block] = fn(pixels[first:first + block])
+    return key_map
+
+
+register_key("brightness")(brightness)
+
+
+@register_key("darkness")
+def darkness(pixels):
+    """ The inverse of brightness: 255 minus the maximum of the colour values. """
+    return 255 - brightness(pixels)
+
+
+@register_key("luminance")
+def luminance(pixels):
+    """ Rec. 709 luma (0.2126 R + 0.7152 G + 0.0722 B), computed in 8 bit fixed point. """
+    def block(pixels):
+        red, green, blue = (channel.astype(np.uint16) for channel in _colour_channels(pixels))
+        return (54 * red + 183 * green + 19 * blue + 128) >> 8
+    return _by_block(block, pixels)
+
+
+@register_key("hue")
+def hue(pixels):
+    """ HSV hue, with the colour wheel (starting at red) scaled to [0, 256). Grey pixels have a hue of 0. """
+    def block(pixels):
+        red, green, blue = (channel.astype(np.float32) for channel in _colour_channels(pixels))
+        high = np.maximum(np.maximum(red, green), blue)
+        delta = high - np.minimum(np.minimum(red, green), blue)
+        delta[delta == 0] = 1
+        sector = np.where(high == red, (green - blue) / delta,
+                          np.where(high == green, 2 + (blue - red) / delta, 4 + (red - green) / delta))
+        return np.round(sector * (256 / 6)).astype(np.int16) % 256
+    return _by_block(block, pixels)
+
+
+@register_key("saturation")
+def saturation(pixels):
+    """ HSV saturation ((max - min) / max), scaled to [0, 255]. Black pixels have a saturation of 0. """
+    def block(pixels):
+        red, green, blue = (channel.astype(np.uint16) for channel in _colour_channels(pixels))
+        high = np.maximum(np.maximum(red, green), blue)
+        low = np.minimum(np.minimum(red, green), blue)
+        return ((high - low) * 255 + high // 2) // np.maximum(high, 1)
+    return _by_block(block, pixels)
+
+
+def channel_key(channel):
+    """ Returns a key which is the value of a single channel: 0 for red, 1 for green, 2 for blue or 3 for alpha.
+    Greyscale images use their grey level for red, green and blue, and images without alpha are fully opaque. """
+    def key(pixels):
+        if channel < 3:
+            return np.copy(_colour_channels(pixels)[channel])
+        if pixels.shape[2] in (2, 4):
+            return np.copy(pixels[:, :, -1])
+        return np.full(pixels.shape[:2], 255, dtype=np.uint8)
+    return key
+
+
+for _channel, _name in enumerate(["red", "green", "blue", "alpha"]):
+    register_key(_name)(channel_key(_channel))
+
+
+def _owner(pixels):
+    """ Returns the array which owns the memory of pixels: pixels itself, or the array it is (eventually) a view of. """
+    while isinstance(pixels.base, np.ndarray):
+        pixels = pixels.base
+    return pixels
+
+
+def _view_key(pixels):
+    """ Returns the array owning the memory of pixels, and a key identifying which part of it pixels views. """
+    owner = _owner(pixels)
+    offset = pixels.__array_interface__["data"][0] - owner.__array_interface__["data"][0]
+    return owner, (id(owner), offset, pixels.shape, pixels.strides, pixels.dtype.str)
+
+
+class KeyCache:
+    """ A least recently used cache of key maps, keyed by image and key name, which holds at most max_bytes of maps.
+    Images are identified by the array owning their memory and the part of it they view, so a view (eg. a crop) of an
+    image has its own maps, and maps are found again through a new view of the same part. The maps of an image are
+    dropped when the array owning its memory is garbage collected.
+
+    Maps are shared, not copied. Any code which modifies an image must call invalidate once it is done, unless it kept
+    the image's maps up to date. For example, sorting permutes the map it sorts by along with the pixels. As maps are
+    found by where an image is in memory rather than by its contents, a cache must only be given to code which keeps
+    to this, and not to code which may write a new image into the same array.
+    """
+
+    def __init__(self, max_bytes=2 ** 28):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._maps = OrderedDict()
+        self._finalizers = {}
+
+    def get(self, pixels, name):
+        """ Returns the map of pixels for the key called name, computing it if it is not cached. """
+        entry = (_view_key(pixels)[1], name)
+        if entry in self._maps:
+            self.hits += 1
+            count("key maps reused")
+            self._maps.move_to_end(entry)
+            return self._maps[entry]
+
+        self.misses += 1
+        count("key maps computed")
+        with stage(f"key map {name}"):
+            key_map = KEYS[name](pixels)
+        self.put(pixels, name, key_map)
+        return key_map
+
+    def put(self, pixels, name, key_map):
+        """ Caches key_map as the map of pixels for the key called name, eg. a copy of a map computed for an identical
+        image. The map is shared, not copied. """
+        import weakref
+
+        if key_map.nbytes > self.max_bytes:
+            return
+
+        owner, view = _view_key(pixels)
+        entry = (view, name)
+        if entry in self._maps:
+            self.bytes -= self._maps.pop(entry).nbytes
+        if id(owner) not in self._finalizers:
+            self._finalizers[id(owner)] = weakref.finalize(owner, self._discard, id(owner))
+        self._maps[entry] = key_map
+        self.bytes += key_map.nbytes
+        while self.bytes > self.max_bytes:
+            _, evicted = self._maps.popitem(last=False)
+            self.bytes -= evicted.nbytes
+
+    def invalidate(self, pixels, keep=()):
+        """ Discards the cached maps of pixels, other than those for the keys named in keep, and every map of any other
+        view of the same memory, which may overlap pixels. """
+        view = _view_key(pixels)[1]
+        for entry in [entry for entry in self._maps
+                      if entry[0][0] == view[0] and not (entry[0] == view and entry[1] in keep)]:
+            self.bytes -= self._maps.pop(entry).nbytes
+
+    def _discard(self, owner_id):
+        """ Discards every map of the views of the array with the given id, once it has been garbage collected. """
+        self._finalizers.pop(owner_id, None)
+        for entry in [entry for entry in self._maps if entry[0][0] == owner_id]:
+            self.bytes -= self._maps.pop(entry).nbytes
+
+
+# Shared by the pipeline, frames and preview scripts, which give it to each effect they apply, so effects applied to the
+# same image in one process reuse its maps. Effects only use a cache they are given.
+KEY_CACHE = KeyCache()
+
+
+def resolve_key(pixels, key, cache=None):
+    """ Returns key if it is already a map of weights. Otherwise key is the name of a key in KEYS, and its map of pixels
+    is returned, from cache if one is given. """
+    if not isinstance(key, str):
+        return key
+    if cache is not None:
+        return cache.get(pixels, key)
+    return KEYS[key](pixels)
@@ -1,6 +1,13 @@
-from PIL import Image
 import numpy as np
-from image_utilities import brightness, select_random_rows
+from .image_utilities import demo_image, pixel_records, contiguous_channels, select_random_rows, load_pixels, \
+    save_pixels, add_stream_arguments, stream_passes, transposed
+from .batch_sort import sort_intervals_batched
+from .sort_keys import KEYS, resolve_key
+from .interval_index import IntervalIndex
+from .batch_runner import add_batch_arguments, run_files
+from .result_cache import add_cache_arguments, result_cache
+from .strips import add_strip_arguments, strip_runner
+from .profiling import add_profile_arguments, stage, count
 
 """
 Note that rows in the context of this code will refer to either a row or column if it is in the function name:
@@ -8,18 +15,34 @@ Note that rows in the context of this code will refer to either a row or column
  If it is not inside the function name, and is not specified in the arguments, rows refers to the rows in the image.
 """
 
+# Default thresholds of modes 0 and 2. Each sort can be given its own, with --black_val and --white_val.
 BLACK_VAL = 60
 WHITE_VAL = 150
 
 
-def parse_args():
+def black_interval(value=BLACK_VAL):
+    """ Returns the (start, end) conditions of mode 0 for the indexed and batched engines, equivalent to
+    get_black_index and get_non_black_index with the same value. """
+    return ("<=", value), (">", value)
+
+
+def white_interval(value=WHITE_VAL):
+    """ Returns the (start, end) conditions of mode 2, equivalent to get_white_index and get_non_white_index. """
+    return (">=", value), ("<", value)
+
+
+BLACK_INTERVAL = black_interval()
+WHITE_INTERVAL = white_interval()
+
+
+def parse_args(argv=None, prog=None):
     import argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--files", "-f", dest="files", default=["../demo/nasa--hI5dX2ObAs-unsplash.jpg"], nargs="+",
-                        help="File(s) to sort. Can be any format supported by PIL. ")
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--files", "-f", dest="files", default=[demo_image("nasa--hI5dX2ObAs-unsplash.jpg")],
+                        nargs="+", help="File(s) to sort. Can be any format supported by PIL. ")
     parser.add_argument("--mode", "-m", dest="mode", default=1, type=int, choices=[0, 1, 2, 3],
                         help="0: Sorts on black levels\n"
-                             "1: Sorts on brightness values\n"
+                             "1: Sorts on brightness values (or --key)\n"
                              "2: Sorts on white levels\n"
                              "3: Sorts on both both black and white levels.")
     # TODO: implement this.
@@ -27,84 +50,115 @@ def parse_args():
     #                     help="Will not sort on the given channel.")
     parser.add_argument("--random_rows", action="store_true",
                         help="If selected, rows and columns will be randomly selected to be sorted.")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed for --random_rows. The same seed will always select the same rows and columns.")
     parser.add_argument("--custom_interval", type=int, nargs="*", default=None,
                         help="Will start sorting on a number less than or equal to the first number supplied, and a"
                              "number higher than the second number supplied.")
+    parser.add_argument("--black_val", type=int, default=BLACK_VAL,
+                        help="Weight at or below which a pixel is black, for modes 0 and 3.")
+    parser.add_argument("--white_val", type=int, default=WHITE_VAL,
+                        help="Weight at or above which a pixel is white, for modes 2 and 3.")
+
+    parser.add_argument("--key", "-k", dest="key", default="brightness", choices=sorted(KEYS),
+                        help="The weight of each pixel. Pixels are sorted by it, and --mode and --custom_interval "
+                             "compare against it.")
 
     row_or_col = parser.add_mutually_exclusive_group()
     row_or_col.add_argument("--row_only", action="store_true",
                             help="Will only sort rows.")
     row_or_col.add_argument("--col_only", action="store_true",
                             help="Will only sort columns")
-
-    args = parser.parse_args()
+    parser.add_argument("--engine", default="batched", choices=["batched", "per_row"],
+                        help="batched: Sorts every row or column at once.\n"
+                             "per_row: Sorts each row and column separately. Does not use --strip_workers or "
+                             "--stream.")
+    parser.add_argument("--unstable", action="store_true",
+                        help="Lets pixels of equal weight be sorted in any order, which can be faster for keys wider "
+                             "than a byte. The output may then change between numpy versions. Only used by the "
+                             "batched engine.")
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_profile_arguments(parser)
+    add_strip_arguments(parser)
+    add_stream_arguments(parser)
+
+    args = parser.parse_args(argv)
     if args.custom_interval:
         args.mode = -1
         if len(args.custom_interval) > 2:
-            raise argparse.ArgumentParser("argument custom_interval requires between 1 and 2 arguments.")
-        else:
-            for light_level in args.custom_interval:
-                if light_level < 0 or light_level > 255:
-                    raise argparse.ArgumentParser("argument custom_interval requires numbers to be between 0 and 255.")
+            parser.error("argument --custom_interval requires between 1 and 2 arguments.")
+        for light_level in args.custom_interval:
+            if light_level < 0 or light_level > 255:
+                parser.error("argument --custom_interval requires numbers to be between 0 and 255.")
+    for name in ("black_val", "white_val"):
+        if not 0 <= getattr(args, name) <= 255:
+            parser.error(f"argument --{name} must be between 0 and 255.")
 
     return args
 
 
-def get_non_black_index(x_start, row: np.ndarray):
-    point = np.argmax(row[x_start:] > BLACK_VAL)
+def get_non_black_index(x_start, row: np.ndarray, value=BLACK_VAL):
+    point = np.argmax(row[x_start:] > value)
     if point == 0:
         return -1
     return point + x_start
 
 
-def get_black_index(x_start, row: np.ndarray):
-    point = np.argmax(row[x_start:] <= BLACK_VAL)
+def get_black_index(x_start, row: np.ndarray, value=BLACK_VAL):
+    point = np.argmax(row[x_start:] <= value)
     if point == 0:
         return -1
     return point + x_start
 
 
-def get_non_white_index(x_start, row: np.ndarray):
+def get_non_white_index(x_start, row: np.ndarray, value=WHITE_VAL):
     """ Get first index that is not "white" past x_start. Returns -1 if no such index exists. """
-    point = np.argmax(row[x_start:] < WHITE_VAL)
+    point = np.argmax(row[x_start:] < value)
     if point == 0:
         return -1
     return point + x_start
 
 
-def get_white_index(x_start, row: np.ndarray):
+def get_white_index(x_start, row: np.ndarray, value=WHITE_VAL):
     """ Get first index that is "white" past x_start. Returns -1 if no such index exists. """
-    point = np.argmax(row[x_start:] >= WHITE_VAL)
+    point = np.argmax(row[x_start:] >= value)
     if point == 0:
         return -1
     return point + x_start
 
 
 def sort_pixel_list(row, compressed_row, sort_compressed=True):
-    """ Sorts both row and compressed_row (if sort_compressed is True) based on compressed_row. """
-    sorted_indices = np.argsort(compressed_row)
-    row[:, 0] = row[:, 0][sorted_indices]
-    row[:, 1] = row[:, 1][sorted_indices]
-    row[:, 2] = row[:, 2][sorted_indices]
+    """ Sorts both row and compressed_row (if sort_compressed is True) based on compressed_row. Each pixel is moved as a
+    single record, so row may have any number of channels. """
+    count("intervals sorted")
+    with stage("segment sort", trace=False), contiguous_channels(row) as row:
+        sorted_indices = np.argsort(compressed_row, kind="stable")
+        records = pixel_records(row)
+        records[:] = records[sorted_indices]
 
-    # This produces interesting effects when disabled.
-    if sort_compressed:
-        compressed_row[:] = compressed_row[sorted_indices]
+        # This produces interesting effects when disabled.
+        if sort_compressed:
+            compressed_row[:] = compressed_row[sorted_indices]
 
 
 def sort_row(row, compressed_row, start_point_fn, end_point_fn):
     """ Sorts the row based on compressed_row, using start_point_fn and end_point_fn to determine where to start, and
     stop sorting a given region. """
     len_row = len(row)
-    x_start = start_point_fn(0, compressed_row)
+    count("lines visited")
+    with stage("interval search", trace=False):
+        x_start = start_point_fn(0, compressed_row)
     while x_start != len_row and x_start != -1:
-        x_end = end_point_fn(x_start, compressed_row)
+        with stage("interval search", trace=False):
+            x_end = end_point_fn(x_start, compressed_row)
         if x_end == -1:
             x_end = len_row
         sort_pixel_list(row[x_start:x_end], compressed_row[x_start:x_end])
         if x_end == len_row:
             break
-        x_start = start_point_fn(x_end, compressed_row)
+        with stage("interval search", trace=False):
+            x_start = start_point_fn(x_end, compressed_row)
 
 
 def sort_intervals(image, compressed_image, start_point_fn, end_point_fn,
@@ -121,7 +175,7 @@ def sort_intervals(image, compressed_image, start_point_fn, end_point_fn,
     :param image:               The image to modify.
     :param compressed_image:    The array with the same number of rows and columns as image, where each element is
                                 the weight of the pixel compared to its neighbours (higher pixels will be sorted to the
-                                end).
+                                end). May instead be the name of a key in sort_keys.KEYS, which is computed from image.
     :param start_point_fn:      A function which produces some start point given a point and a complete row.
     :param end_point_fn:        A function which produces an end point occurring after the start point, given the start
                                 point and complete row.
@@ -131,69 +185,179 @@ def sort_intervals(image, compressed_image, start_point_fn, end_point_fn,
     """
 
     rows, cols, _ = image.shape
+    compressed_image = resolve_key(image, compressed_image)
 
     if sort_cols:
-        for col in iterator(cols):
-            sort_row(image[:, col], compressed_image[:, col], start_point_fn, end_point_fn)
+        # Columns are sorted as the rows of transposed copies, so they are read and written sequentially.
+        with transposed(image, compressed_image) as (lines, compressed_lines):
+            for col in iterator(cols):
+                sort_row(lines[col], compressed_lines[col], start_point_fn, end_point_fn)
     if sort_rows:
         for row in iterator(rows):
             sort_row(image[row, :], compressed_image[row, :], start_point_fn, end_point_fn)
 
 
-def main():
-    """ Program runner: parses the arguments and produces the appropriate images."""
-    import os
+def sort_intervals_indexed(image, compressed_image, start, end, iterator=range, sort_cols=True, sort_rows=True,
+                           interval_index=None):
+    """ Produces the same output as sort_intervals, but finds the intervals in each row using a precomputed
+    IntervalIndex, rather than scanning the row for each boundary.
+
+    SIDE EFFECTS: Will modify the input image - provide a copy to sort on if this is unwanted.
+
+    :param start:               The (comparator, value) condition which starts an interval.
+    :param end:                 The (comparator, value) condition which ends an interval.
+    :param interval_index:      An IntervalIndex over compressed_image, which may be shared between calls on the same
+                                image. One is built if not provided.
+
+    See sort_intervals for the remaining parameters.
+    """
+
+    rows, cols, _ = image.shape
+    compressed_image = resolve_key(image, compressed_image)
+    if interval_index is None:
+        interval_index = IntervalIndex(compressed_image)
+
+    if sort_cols:
+        with transposed(image, compressed_image) as (lines, compressed_lines):
+            for col in iterator(cols):
+                count("lines visited")
+                with stage("interval search", trace=False):
+                    intervals = interval_index.line_intervals(start, end, True, col)
+                for x_start, x_end in intervals:
+                    sort_pixel_list(lines[col, x_start:x_end], compressed_lines[col, x_start:x_end])
+        interval_index.invalidate(start, end)
+    if sort_rows:
+        for row in iterator(rows):
+            count("lines visited")
+            with stage("interval search", trace=False):
+                intervals = interval_index.line_intervals(start, end, False, row)
+            for x_start, x_end in intervals:
+                sort_pixel_list(image[row, x_start:x_end], compressed_image[row, x_start:x_end])
+        interval_index.invalidate(start, end)
+
+
+def sort_image(pixels, pixels_compressed, args, strip_runner=None, interval_index=None):
+    """ Sorts pixels (and pixels_compressed) in place, as specified by args. strip_runner is only used by the batched
+    engine. interval_index is an IntervalIndex over pixels_compressed to start from (eg. one seeded from a previous
+    frame), and one is built if it is not given. """
+    import random
+    from functools import partial
 
-    args = parse_args()
-    iterator = select_random_rows if args.random_rows else range
+    iterator = partial(select_random_rows, rng=random.Random(args.seed)) if args.random_rows else range
 
     if args.custom_interval:
-        def interval_start_fn(x_start, row: np.ndarray):
-            point = np.argmax(row[x_start:] >= args.custom_interval[0])
-            if point == 0:
-                return -1
-            return point + x_start
-
-        if len(args.custom_interval) == 2:
-            def interval_end_fn(x_start, row: np.ndarray):
-                point = np.argmax(row[x_start:] < args.custom_interval[1])
-                if point == 0:
-                    return -1
-                return point + x_start
-        else:
-            def interval_end_fn(x_start, row: np.ndarray):
-                point = np.argmax(row[x_start:] < args.custom_interval[0])
-                if point == 0:
-                    return -1
-                return point + x_start
+        interval = ((">=", args.custom_interval[0]), ("<", args.custom_interval[-1]))
+
+    # Shared between the black and white passes of mode 3.
+    if interval_index is None:
+        interval_index = IntervalIndex(pixels_compressed)
 
-    for file_name in args.files:
-        img = Image.open(file_name)
-        pixels = np.copy(np.asarray(img))
-        pixels_compressed = brightness(pixels)
+    if args.engine == "batched":
+        def sort(start, end):
+            sort_intervals_batched(pixels, pixels_compressed, start, end, iterator, not args.row_only,
+                                   not args.col_only, interval_index, strip_runner, not args.unstable)
 
         if args.custom_interval:
-            sort_intervals(pixels, pixels_compressed, interval_start_fn, interval_end_fn, iterator,
-                           not args.row_only, not args.col_only)
+            sort(*interval)
         else:
             if args.mode == 0 or args.mode == 3:
                 print("sorting on black")
-                sort_intervals(pixels, pixels_compressed, get_black_index, get_non_black_index, iterator,
-                               not args.row_only, not args.col_only)
+                sort(*black_interval(args.black_val))
             if args.mode == 2 or args.mode == 3:
                 print("sorting on white")
-                sort_intervals(pixels, pixels_compressed, get_white_index, get_non_white_index, iterator,
-                               not args.row_only, not args.col_only)
+                sort(*white_interval(args.white_val))
             if args.mode == 1:
-                # start_fn: returns 0 on entering loop
-                # end_fn: returns the length - sorts the entire list
-                # start_fn: x is returned, and x is end.
-                sort_intervals(pixels, pixels_compressed, lambda x, y: x, lambda x, y: len(y), iterator,
-                               not args.row_only, not args.col_only)
+                sort(None, None)
+    elif args.custom_interval:
+        sort_intervals_indexed(pixels, pixels_compressed, *interval, iterator,
+                               not args.row_only, not args.col_only, interval_index)
+    else:
+        if args.mode == 0 or args.mode == 3:
+            print("sorting on black")
+            sort_intervals_indexed(pixels, pixels_compressed, *black_interval(args.black_val), iterator,
+                                   not args.row_only, not args.col_only, interval_index)
+        if args.mode == 2 or args.mode == 3:
+            print("sorting on white")
+            sort_intervals_indexed(pixels, pixels_compressed, *white_interval(args.white_val), iterator,
+                                   not args.row_only, not args.col_only, interval_index)
+        if args.mode == 1:
+            # start_fn: returns 0 on entering loop
+            # end_fn: returns the length - sorts the entire list
+            # start_fn: x is returned, and x is end.
+            sort_intervals(pixels, pixels_compressed, lambda x, y: x, lambda x, y: len(y), iterator,
+                           not args.row_only, not args.col_only)
+
+
+def _sort_strip(key, start, end, stable, strip, selected):
+    """ Sorts the selected rows of a strip of an image which is being streamed. """
+    sort_intervals_batched(strip, key, start, end, lambda rows: selected, sort_cols=False, stable=stable)
+
+
+def stream_sort_passes(args):
+    """ Returns the passes for stream_passes which sort an image as sort_image does with the batched engine. """
+    import random
+    from functools import partial
 
-        im = Image.fromarray(pixels)
-        im.save(f"{os.path.splitext(file_name)[0]}_sorted{os.path.splitext(file_name)[-1]}")
+    iterator = partial(select_random_rows, rng=random.Random(args.seed)) if args.random_rows else range
 
+    if args.custom_interval:
+        intervals = [((">=", args.custom_interval[0]), ("<", args.custom_interval[-1]))]
+    else:
+        intervals = []
+        if args.mode == 0 or args.mode == 3:
+            intervals.append(black_interval(args.black_val))
+        if args.mode == 2 or args.mode == 3:
+            intervals.append(white_interval(args.white_val))
+        if args.mode == 1:
+            intervals.append((None, None))
+
+    passes = []
+    for start, end in intervals:
+        if not args.row_only:
+            passes.append((True, iterator, partial(_sort_strip, args.key, start, end, not args.unstable)))
+        if not args.col_only:
+            passes.append((False, iterator, partial(_sort_strip, args.key, start, end, not args.unstable)))
+    return passes
+
+
+def process_pixels(args, pixels, interval_index=None, key_cache=None):
+    """ Sorts pixels in place, as specified by args, and returns them. interval_index is passed to sort_image. The key
+    map is taken from key_cache (a sort_keys.KeyCache), if one is given, and otherwise computed. """
+    pixels_compressed = resolve_key(pixels, args.key, key_cache)
+
+    with stage("sort"), strip_runner(args) as runner:
+        if runner is None:
+            sort_image(pixels, pixels_compressed, args, interval_index=interval_index)
+        else:
+            runner.apply(sort_image, [pixels, pixels_compressed], args, runner, interval_index)
+    if key_cache is not None:
+        # The key was sorted along with the pixels, but any other cached key is now out of date.
+        key_cache.invalidate(pixels, keep=(args.key,))
+    return pixels
+
+
+def process_file(args, file_name):
+    """ Sorts a single file, as specified by args, and returns the name of the sorted file. """
+    import os
+
+    output_name = f"{os.path.splitext(file_name)[0]}_sorted{os.path.splitext(file_name)[-1]}"
+    cache = result_cache(args, "sort", file_name)
+    if cache.fetch(output_name):
+        return output_name
+
+    if args.stream:
+        stream_passes(file_name, output_name, stream_sort_passes(args), args.strip_budget * 2 ** 20, args.temp_dir)
+    else:
+        save_pixels(process_pixels(args, load_pixels(file_name)), output_name)
+    cache.store(output_name)
+    return output_name
+
+
+def main(argv=None, prog=None):
+    """ Program runner: parses the arguments and produces the appropriate images."""
+    from functools import partial
 
-if __name__ == "__main__":
-    main()
+    args = parse_args(argv, prog)
+    if run_files(partial(process_file, args), args.files, args.jobs, args.max_in_flight, args.profile,
+                 args.profile_memory):
+        raise SystemExit(1)
@@ -0,0 +1,159 @@
+import numpy as np
+
+"""
+Runs the row and column passes of an effect over strips of a single image in parallel. Row passes are split into strips
+of rows, and column passes into strips of columns, so each worker only touches its own part of the image. Workers
+operate directly on views of the image - threads share the process' memory, and processes attach to the image through
+multiprocessing.shared_memory - so the image is never copied per worker.
+
+Lines to process are always selected in the calling process, before being split into strips. Selections drawn from a
+seeded random number generator (eg. --random_rows) are therefore identical to those of a serial run, no matter how many
+workers there are, and so is the output.
+"""
+
+
+def add_strip_arguments(parser):
+    """ Adds the --strip_workers and --strip_processes arguments to parser. """
+    parser.add_argument("--strip_workers", dest="strip_workers", default=1, type=int,
+                        help="Number of workers to split each row and column pass of an image between.")
+    parser.add_argument("--strip_processes", dest="strip_processes", action="store_true",
+                        help="Use processes (with the image in shared memory) rather than threads for strip workers.")
+
+
+def split_strips(selected, size, strips):
+    """ Splits the lines [0, size) into at most strips contiguous strips.
+
+    :param selected:    Sorted array of the lines to process.
+    :param size:        Number of lines.
+    :param strips:      Number of strips to produce.
+    :return:            A list of (start, end, local_selected) tuples, where local_selected contains the lines in
+                        selected which fall in [start, end), relative to start. Empty strips are omitted.
+    """
+    bounds = np.linspace(0, size, max(strips, 1) + 1).astype(np.intp)
+    splits = np.searchsorted(selected, bounds)
+    return [(start, end, selected[splits[i]:splits[i + 1]] - start)
+            for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])) if splits[i] != splits[i + 1]]
+
+
+def strip_views(arrays, columns, start, end):
+    """ Returns views of the lines [start, end) of each array - columns if columns is True, rows otherwise. """
+    if columns:
+        return [array[:, start:end] for array in arrays]
+    return [array[start:end] for array in arrays]
+
+
+def _run_shared_strip(fn, specs, columns, start, end, local_selected, args):
+    """ Runs fn on a strip of arrays held in shared memory. Runs in a worker process. """
+    from multiprocessing import shared_memory
+
+    handles = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    try:
+        arrays = [np.ndarray(shape, dtype=dtype, buffer=handle.buf)
+                  for handle, (_, shape, dtype) in zip(handles, specs)]
+        fn(*strip_views(arrays, columns, start, end), local_selected, *args)
+        del arrays
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+class StripRunner:
+    """ A pool of workers for strip-parallel passes. Use as a context manager. """
+
+    def __init__(self, workers, processes=False):
+        self.workers = workers
+        self.processes = processes
+        self._executor = None
+        self._shared = []
+
+    def __enter__(self):
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+        executor = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+        self._executor = executor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._executor.shutdown()
+
+    def apply(self, fn, arrays, *args):
+        """ Runs fn(*arrays, *args), where fn calls run on the arrays. If workers are processes, arrays are first copied
+        into shared memory, which fn operates on, and the results are copied back into arrays once it returns.
+
+        :param fn:      The function to run. It must not keep references to the arrays it is given.
+        :param arrays:  The arrays which fn modifies.
+        :param args:    Additional arguments to fn.
+        :return:        The result of fn.
+        """
+        if not self.processes:
+            return fn(*arrays, *args)
+
+        from multiprocessing import shared_memory
+
+        handles = [shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1)) for array in arrays]
+        shared = [np.ndarray(array.shape, dtype=array.dtype, buffer=handle.buf)
+                  for array, handle in zip(arrays, handles)]
+        try:
+            for array, shared_array in zip(arrays, shared):
+                shared_array[...] = array
+            self._shared = list(zip(shared, handles))
+
+            result = fn(*shared, *args)
+
+            for array, shared_array in zip(arrays, shared):
+                array[...] = shared_array
+        finally:
+            # Every view of the shared memory must be released before it can be closed.
+            self._shared = []
+            shared = shared_array = None
+            for handle in handles:
+                handle.close()
+                handle.unlink()
+        return result
+
+    def _spec(self, array):
+        for shared, handle in self._shared:
+            if shared is array:
+                return handle.name, array.shape, array.dtype
+        raise ValueError("Arrays passed to a process StripRunner must be those given to fn by StripRunner.apply.")
+
+    def run(self, fn, arrays, columns, selected, *args, per_line=()):
+        """ Runs fn(*views, local_selected, *strip_per_line, *args) on each strip of the arrays, and waits for every
+        strip to finish.
+
+        :param fn:          The function to run on each strip. Must be picklable if workers are processes.
+        :param arrays:      The arrays to split. Each must have the same number of rows and columns.
+        :param columns:     If True, the arrays are split into strips of columns. Otherwise, strips of rows.
+        :param selected:    An iterable of the lines (columns or rows) to process.
+        :param args:        Additional arguments to fn.
+        :param per_line:    One dimensional arrays with an entry per line, which are split into strips along with the
+                            arrays. Each is passed to fn (as strip_per_line) after local_selected.
+        :return:            Nothing.
+        """
+        size = arrays[0].shape[1 if columns else 0]
+        selected = np.unique(np.fromiter(selected, dtype=np.intp))
+        strips = split_strips(selected, size, self.workers)
+
+        if self.processes:
+            specs = [self._spec(array) for array in arrays]
+            futures = [self._executor.submit(_run_shared_strip, fn, specs, columns, start, end, local_selected,
+                                             tuple(line[start:end] for line in per_line) + args)
+                       for start, end, local_selected in strips]
+        else:
+            futures = [self._executor.submit(fn, *strip_views(arrays, columns, start, end), local_selected,
+                                             *(line[start:end] for line in per_line), *args)
+                       for start, end, local_selected in strips]
+
+        # Barrier: the next pass may depend on every line of this one.
+        for future in futures:
+            future.result()
+
+
+def strip_runner(args):
+    """ Returns a StripRunner as specified by args. If strips are not in use, returns a context manager which produces
+    None instead. """
+    from contextlib import nullcontext
+
+    if args.strip_workers <= 1:
+        return nullcontext()
+    return StripRunner(args.strip_workers, args.strip_processes)
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from ImageMutation import mountains, sort_pixels
+from ImageMutation.batch_sort import sort_lines, sort_segments
+from ImageMutation.image_utilities import contiguous_channels, pixel_records, transpose_pixels
+from ImageMutation.sort_pixels import sort_pixel_list
+
+
+def random_image(seed=0, shape=(24, 40, 3)):
+    return np.random.RandomState(seed).randint(0, 256, shape, dtype=np.uint8)
+
+
+def test_contiguous_channels_writes_the_copy_back():
+    image = random_image()
+    bgr = image[..., ::-1]
+    with contiguous_channels(bgr) as pixels:
+        assert not np.shares_memory(pixels, image)
+        records = pixel_records(pixels)
+        records[0, :] = records[1, :]
+    assert np.array_equal(image[0], image[1])
+
+    with contiguous_channels(image[:, ::-1]) as pixels:
+        assert np.shares_memory(pixels, image)
+
+
+@pytest.mark.parametrize("module, argv", [(sort_pixels, ["--mode", "0"]), (sort_pixels, ["--engine", "per_row"]),
+                                          (sort_pixels, ["--row_only"]), (mountains, ["--direction", "up"]),
+                                          (mountains, ["--direction", "left"]),
+                                          (mountains, ["--direction", "right", "--engine", "per_row"])])
+def test_effects_accept_a_bgr_view(module, argv):
+    args = module.parse_args(["--files", "image.png"] + argv)
+    image = random_image()
+    expected = module.process_pixels(args, np.ascontiguousarray(image[..., ::-1]))
+    module.process_pixels(args, image[..., ::-1])
+    assert np.array_equal(image[..., ::-1], expected)
+
+
+def test_record_moves_accept_a_bgr_view():
+    image, weights = random_image(), random_image(1)[:, :, 0]
+    expected = image[..., ::-1].copy()
+
+    assert np.array_equal(transpose_pixels(image[..., ::-1]), expected.swapaxes(0, 1))
+    out = np.empty_like(image.swapaxes(0, 1))
+    transpose_pixels(image, out[..., ::-1])
+    assert np.array_equal(out[..., ::-1], image.swapaxes(0, 1))
+
+    row_weights = weights[0].copy()
+    sort_pixel_list(expected[0], row_weights.copy())
+    sort_pixel_list(image[0, :, ::-1], row_weights)
+    assert np.array_equal(image[0, :, ::-1], expected[0])
+
+    sort_lines(expected, weights.copy())
+    sort_lines(image[..., ::-1], weights.copy())
+    assert np.array_equal(image[..., ::-1], expected)
+
+    starts, ends = np.array([3, 50, 400]), np.array([20, 90, 700])
+    sort_segments(expected, weights[::-1].copy(), starts, ends)
+    sort_segments(image[..., ::-1], weights[::-1].copy(), starts, ends)
+    assert np.array_equal(image[..., ::-1], expected)
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from ImageMutation.interval_index import IntervalIndex
+from ImageMutation.sort_pixels import BLACK_INTERVAL, WHITE_INTERVAL, get_black_index, get_non_black_index, \
+    get_white_index, get_non_white_index
+
+"""
+Pins the quirk of sort_row that IntervalIndex reproduces: a match at the very first position searched is treated as "not
+found" (-1), so a row which starts on a match for the start condition is not sorted at all, and sorting stops when an
+interval ends on a match for the start condition.
+"""
+
+INTERVALS = [(BLACK_INTERVAL, get_black_index, get_non_black_index),
+             (WHITE_INTERVAL, get_white_index, get_non_white_index)]
+
+
+def row_intervals(row, start_fn, end_fn):
+    """ The intervals sort_row sorts in row, with the get_*_index functions as start_fn and end_fn. """
+    length = len(row)
+    intervals = []
+    x_start = start_fn(0, row)
+    while x_start != length and x_start != -1:
+        x_end = end_fn(x_start, row)
+        if x_end == -1:
+            x_end = length
+        intervals.append((x_start, x_end))
+        if x_end == length:
+            break
+        x_start = start_fn(x_end, row)
+    return intervals
+
+
+@pytest.mark.parametrize("index_fn, match, other", [(get_black_index, 0, 255), (get_non_black_index, 255, 0),
+                                                    (get_white_index, 255, 0), (get_non_white_index, 0, 255)])
+def test_index_functions_treat_first_position_as_not_found(index_fn, match, other):
+    row = np.array([match, other, match, other], dtype=np.uint8)
+    # The first element matches.
+    assert index_fn(0, row) == -1
+    # x_start itself matches, further along the row.
+    assert index_fn(2, row) == -1
+    # Otherwise, the first match after x_start is found.
+    assert index_fn(1, row) == 2
+    # The last element matches, and is x_start.
+    assert index_fn(3, np.array([other, other, other, match], dtype=np.uint8)) == -1
+    # Nothing matches before the end of the row.
+    assert index_fn(0, np.full(4, other, dtype=np.uint8)) == -1
+
+
+@pytest.mark.parametrize("interval, start_fn, end_fn", INTERVALS)
+def test_row_starting_on_a_match_is_not_sorted(interval, start_fn, end_fn):
+    match = 0 if interval is BLACK_INTERVAL else 255
+    row = np.array([match, 128, match, match, 128], dtype=np.uint8)
+    index = IntervalIndex(row[np.newaxis, :])
+    assert row_intervals(row, start_fn, end_fn) == []
+    assert index.line_intervals(*interval, False, 0) == []
+    starts, ends = index.bounds(*interval, False, np.array([0]))
+    assert len(starts) == 0 and len(ends) == 0
+
+
+@pytest.mark.parametrize("interval, start_fn, end_fn", INTERVALS)
+def test_intervals_at_the_end_of_a_row(interval, start_fn, end_fn):
+    match = 0 if interval is BLACK_INTERVAL else 255
+    rows = np.array([[128, 128, 128, match],        # Starts on the last element, and runs to the end of the row.
+                     [128, match, match, match],    # Never ends.
+                     [128, match, 128, 128],        # Ends before the end of the row, and nothing starts after it.
+                     [128, 128, 128, 128]],         # Never starts.
+                    dtype=np.uint8)
+    index = IntervalIndex(rows)
+    expected = [[(3, 4)], [(1, 4)], [(1, 2)], []]
+    for line, row in enumerate(rows):
+        assert row_intervals(row, start_fn, end_fn) == expected[line]
+        assert index.line_intervals(*interval, False, line) == expected[line]
+        # And the same along columns.
+        assert IntervalIndex(rows.T.copy()).line_intervals(*interval, True, line) == expected[line]
+
+    starts, ends = index.bounds(*interval, False, np.arange(len(rows)))
+    flattened = sorted((line * 4 + x_start, line * 4 + x_end)
+                       for line, intervals in enumerate(expected) for x_start, x_end in intervals)
+    assert sorted(zip(starts.tolist(), ends.tolist())) == flattened
+
+
+@pytest.mark.parametrize("interval, start_fn, end_fn", INTERVALS)
+def test_index_matches_sort_row_on_random_rows(interval, start_fn, end_fn):
+    rng = np.random.RandomState(0)
+    levels = np.array([0, 59, 60, 61, 100, 149, 150, 151, 255], dtype=np.uint8)
+    rows = levels[rng.randint(0, len(levels), (64, 16))]
+    index = IntervalIndex(rows)
+    expected = [row_intervals(row, start_fn, end_fn) for row in rows]
+    assert [index.line_intervals(*interval, False, line) for line in range(len(rows))] == expected
+
+    starts, ends = index.bounds(*interval, False, np.arange(len(rows)))
+    flattened = sorted((line * 16 + x_start, line * 16 + x_end)
+                       for line, intervals in enumerate(expected) for x_start, x_end in intervals)
+    assert sorted(zip(starts.tolist(), ends.tolist())) == flattened
@@ -0,0 +1,84 @@
+import math
+import numpy as np
+import pytest
+from ImageMutation.reshape_image import MAX_SIDE, aspect_fit, divisors, factors, fit_candidates, prime_factors, \
+    random_fit, reshape_pixels
+
+
+def trial_factors(n):
+    """ factors, as it used to be implemented: trial division down from the square root. """
+    guess = math.ceil(math.sqrt(n))
+    while n % guess != 0:
+        guess -= 1
+    return n // guess, guess
+
+
+@pytest.mark.parametrize("n", [3, 65521, 65537, 1000003, 4294967291])
+def test_factors_of_primes(n):
+    assert prime_factors(n) == [n]
+    assert divisors(n).tolist() == [1, n]
+    # 2 is the only prime whose (rounded up) square root is itself.
+    assert factors(n) == (n, 1)
+
+
+@pytest.mark.parametrize("n", [1, 4, 9, 65536, 1024 * 1024, 65521 ** 2, 4095 * 4095])
+def test_factors_of_perfect_squares(n):
+    side = math.isqrt(n)
+    assert factors(n) == (side, side)
+
+
+@pytest.mark.parametrize("n", list(range(1, 200)) + [1920 * 1080, 1000 * 999, 2 * 65521, 65521 * 65519, 7 ** 11])
+def test_factors_match_trial_division(n):
+    assert factors(n) == trial_factors(n)
+    assert math.prod(prime_factors(n)) == n
+    if n < 10 ** 4:
+        assert divisors(n).tolist() == [d for d in range(1, n + 1) if n % d == 0]
+
+
+@pytest.mark.parametrize("n, loss_tolerance", [(65536, 0.1), (65521, 0.0), (65521, 0.01), (1920 * 1080, 0.05)])
+def test_fit_candidates_are_every_fit(n, loss_tolerance):
+    side_a, side_b = fit_candidates(n, loss_tolerance)
+    expected = [(a, n // a) for a in range(1, min(n, MAX_SIDE) + 1)
+                if n // a <= MAX_SIDE and (n - a * (n // a)) <= loss_tolerance * n]
+    assert list(zip(side_a.tolist(), side_b.tolist())) == expected
+
+
+def test_prime_counts_only_fit_a_line_without_loss():
+    assert list(zip(*(side.tolist() for side in fit_candidates(65521, 0.0)))) == [(1, 65521), (65521, 1)]
+    with pytest.raises(ValueError):
+        fit_candidates(65537, 0.0)
+
+
+def test_random_fit_and_aspect_fit_stay_within_the_tolerance():
+    import random
+
+    rng = random.Random(0)
+    n = 1920 * 1080 + 7
+    for _ in range(50):
+        side_a, side_b = random_fit(n, 0.05, rng)
+        assert side_a <= MAX_SIDE and side_b <= MAX_SIDE and 0.95 * n <= side_a * side_b <= n
+    rows, cols = aspect_fit(1920 * 1080, 16 / 9, 0.0)
+    assert (rows, cols) == (1080, 1920)
+
+
+@pytest.mark.parametrize("channels", [1, 3, 4])
+def test_padding_round_trips(channels):
+    image = np.random.RandomState(0).randint(1, 256, (7, 11, channels), dtype=np.uint8)
+    padded = reshape_pixels(image, 10, 10, pad=True)
+    assert padded.shape == (10, 10, channels)
+    flat = padded.reshape(-1, channels)
+    assert np.array_equal(flat[:77], image.reshape(-1, channels))
+    assert not flat[77:].any()
+    # Reshaping back, dropping the padding, restores the image.
+    assert np.array_equal(reshape_pixels(padded, 7, 11), image)
+
+
+def test_reshape_without_padding():
+    image = np.arange(6 * 4 * 3, dtype=np.uint8).reshape(6, 4, 3)
+    reshaped = reshape_pixels(image, 3, 8)
+    assert np.shares_memory(reshaped, image)
+    assert np.array_equal(reshape_pixels(reshaped, 6, 4), image)
+    # Pixels which do not fit are dropped.
+    assert np.array_equal(reshape_pixels(image, 5, 4), image[:5])
+    with pytest.raises(ValueError):
+        reshape_pixels(image, 5, 5)
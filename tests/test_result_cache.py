@@ -0,0 +1,111 @@
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+import pytest
+from ImageMutation.result_cache import ResultCache, atomic_copy, result_cache, _can_merge_stats
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write(path, contents):
+    with open(path, "wb") as f:
+        f.write(contents)
+    return path
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def cache_args(cache_dir, cache_size=1024, **options):
+    return SimpleNamespace(cache_dir=cache_dir, cache_size=cache_size, **options)
+
+
+def test_atomic_copy_leaves_the_target_alone_when_the_copy_fails(tmp_path):
+    target = write(tmp_path / "target.png", b"previous")
+    with pytest.raises(FileNotFoundError):
+        atomic_copy(tmp_path / "missing.png", target)
+    assert read(target) == b"previous"
+    assert os.listdir(tmp_path) == ["target.png"]
+
+    atomic_copy(write(tmp_path / "source.png", b"new"), target)
+    assert read(target) == b"new"
+    assert sorted(os.listdir(tmp_path)) == ["source.png", "target.png"]
+
+
+def test_store_then_fetch(tmp_path):
+    source = write(tmp_path / "image.png", b"source")
+    cached = result_cache(cache_args(str(tmp_path / "cache"), mode=0), "sort", source)
+    assert not cached.fetch(tmp_path / "out.png")
+    cached.store(write(tmp_path / "out.png", b"result"))
+
+    cached = result_cache(cache_args(str(tmp_path / "cache"), mode=0), "sort", source)
+    assert cached.fetch(tmp_path / "copy.png")
+    assert read(tmp_path / "copy.png") == b"result"
+    # Other options are another result.
+    assert not result_cache(cache_args(str(tmp_path / "cache"), mode=2), "sort", source).fetch(tmp_path / "copy.png")
+    assert not any(name.startswith(".tmp-") for name in os.listdir(tmp_path / "cache" / "entries"))
+
+
+def test_eviction_drops_the_least_recently_used_entries(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=250)
+    result = write(tmp_path / "result", b"x" * 100)
+    for time, key in enumerate(["a", "b"]):
+        cache.store(key, result)
+        os.utime(cache._path(key), (time, time))
+    # Fetching marks a as recently used, so b is evicted when c is stored.
+    assert cache.fetch("a", tmp_path / "out")
+    cache.store("c", result)
+    assert sorted(os.path.basename(path) for _, _, path in cache.entries()) == ["a", "c"]
+    assert cache.stats()["evictions"] == 1
+
+    cache.max_bytes = 0
+    cache.evict()
+    assert cache.entries() == []
+
+
+def test_a_cache_size_of_zero_turns_the_cache_off(tmp_path):
+    source = write(tmp_path / "image.png", b"source")
+    cached = result_cache(cache_args(str(tmp_path / "cache"), cache_size=0, mode=0), "sort", source)
+    cached.store(write(tmp_path / "out.png", b"result"))
+    assert not cached.fetch(tmp_path / "copy.png")
+    assert not os.path.exists(tmp_path / "cache")
+
+
+WORKER = """
+import os
+import sys
+import time
+from ImageMutation.result_cache import ResultCache
+
+cache = ResultCache(sys.argv[1])
+# Both workers start together, once the test has started them both.
+while not os.path.exists(sys.argv[1] + ".go"):
+    time.sleep(0.001)
+for i in range(int(sys.argv[2])):
+    cache.store(f"{sys.argv[3]}{i}", sys.argv[4])
+    cache.fetch(f"{sys.argv[3]}{i}", sys.argv[5])
+    cache.fetch("missing", sys.argv[5])
+"""
+
+
+def test_counts_of_concurrent_processes_are_merged(tmp_path):
+    directory = str(tmp_path / "cache")
+    result = write(tmp_path / "result", b"result")
+    environment = dict(os.environ, PYTHONPATH=REPOSITORY)
+    workers = [subprocess.Popen([sys.executable, "-c", WORKER, directory, "50", name, result, tmp_path / f"out{name}"],
+                                env=environment) for name in ["a", "b"]]
+    write(directory + ".go", b"")
+    assert [worker.wait() for worker in workers] == [0, 0]
+
+    cache = ResultCache(directory)
+    stats = cache.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"], stats["evictions"]) == (100, 100, 100, 0)
+    if _can_merge_stats():
+        # Both workers have exited, so their counts were merged, and their own files deleted.
+        assert sorted(name for name in os.listdir(directory) if name.endswith(".json")) == ["stats.json"]
+
+    cache.clear_stats()
+    assert ResultCache(directory).stats()["hits"] == 0
@@ -0,0 +1,94 @@
+import asyncio
+import io
+import json
+from functools import partial
+import numpy as np
+import pytest
+from PIL import Image
+from ImageMutation.service import EffectService, handle_connection
+
+
+def png(shape=(24, 32, 3), seed=0):
+    output = io.BytesIO()
+    Image.fromarray(np.random.RandomState(seed).randint(0, 256, shape, dtype=np.uint8)).save(output, "PNG")
+    return output.getvalue()
+
+
+def request(port, method, path, body=None):
+    """ Makes a request with a real HTTP client, and returns the status, headers and body of the response. """
+    import http.client
+
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request(method, path, body)
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+
+def run_service(requests, max_body=2 ** 20, **options):
+    """ Serves on a free port, makes each (method, path, body) request in turn, and returns the responses and the
+    service's metrics. """
+    async def scenario():
+        async with EffectService(**options) as service:
+            server = await asyncio.start_server(partial(handle_connection, service, max_body), "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                responses = [await asyncio.to_thread(request, port, *arguments) for arguments in requests]
+            return responses, service.metrics()
+    return asyncio.run(scenario())
+
+
+def test_processes_images_and_reports_metrics():
+    (sorted_, piped, metrics), _ = run_service([("POST", "/sort?mode=0&row_only", png()),
+                                               ("POST", "/pipeline?pipeline=sort:mode=0|shift:checkerboard=4", png()),
+                                               ("GET", "/metrics", None)])
+    assert sorted_[0] == 200 and piped[0] == 200
+    assert np.asarray(Image.open(io.BytesIO(sorted_[2]))).shape == (24, 32, 3)
+    counters = json.loads(metrics[2])
+    assert (counters["admitted"], counters["completed"], counters["rejected"]) == (2, 2, 0)
+
+
+@pytest.mark.parametrize("path", [
+    "/sort?custom_interval=10%20300",
+    "/sort?custom_interval=1%202%203",
+    "/sort?black_val=-1",
+    "/shift?checkerboard=0",
+    "/shift?checkerboard=-5",
+    "/reshape?reshape=0%2010",
+    "/reshape?reshape=70000%2010&pad",
+    "/reshape?reshape=60000%2060000&pad",
+    "/sort?strip_processes",
+    "/sort?mode=0|shift",
+    "/sort?mod=0",
+    "/sort?unknown",
+    "/pipeline?pipeline=sort:mode=0|shift:checkerboard=0",
+    "/pipeline",
+])
+def test_invalid_options_are_rejected_before_reaching_a_worker(path):
+    # Each is sent several times, so a request which occupied a worker would leave none for the last.
+    responses, metrics = run_service([("POST", path, png())] * 3 + [("POST", "/shift?checkerboard=4", png())],
+                                     workers=1, timeout=10)
+    assert [status for status, _, _ in responses] == [400, 400, 400, 200]
+    assert metrics["admitted"] == 1
+
+
+def test_requests_beyond_max_pending_are_rejected():
+    responses, metrics = run_service([("POST", "/sort", png())] * 2, max_pending=0)
+    assert [status for status, _, _ in responses] == [503, 503]
+    assert responses[0][1]["Retry-After"] == "1"
+    assert (metrics["admitted"], metrics["rejected"]) == (0, 2)
+
+
+def test_requests_which_take_too_long_time_out():
+    responses, metrics = run_service([("POST", "/sort", png())], timeout=0)
+    assert responses[0][0] == 504
+    assert metrics["timed_out"] == 1
+
+
+def test_malformed_and_unknown_requests():
+    responses, _ = run_service([("POST", "/blur", png()), ("GET", "/sort", None), ("PUT", "/metrics", b"")])
+    assert [status for status, _, _ in responses] == [404, 405, 405]
+    responses, _ = run_service([("POST", "/sort", png())], max_body=16)
+    assert responses[0][0] == 413
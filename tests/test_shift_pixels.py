@@ -0,0 +1,21 @@
+import pytest
+from ImageMutation.image_utilities import ranges
+from ImageMutation.shift_pixels import parse_args
+
+
+def test_ranges_skips_every_other_interval():
+    assert list(ranges(2, 7)) == [0, 1, 4, 5]
+    assert list(ranges(3, 3)) == [0, 1, 2]
+
+
+@pytest.mark.parametrize("size", [0, -1])
+def test_ranges_rejects_sizes_that_never_advance(size):
+    with pytest.raises(ValueError):
+        list(ranges(size, 10))
+
+
+@pytest.mark.parametrize("checkerboard", ["0", "-200"])
+def test_checkerboard_must_be_positive(checkerboard):
+    with pytest.raises(SystemExit):
+        parse_args(["--files", "image.png", "--checkerboard", checkerboard])
+    assert parse_args(["--files", "image.png", "--checkerboard", "1"]).checkerboard == 1
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from ImageMutation import mountains, sort_pixels
+from ImageMutation.pipeline import parse_pipeline, run_pipeline
+from ImageMutation.sort_keys import KeyCache
+
+
+def random_image(seed, shape=(32, 48, 3)):
+    return np.random.RandomState(seed).randint(0, 256, shape, dtype=np.uint8)
+
+
+@pytest.mark.parametrize("module, argv", [(sort_pixels, ["--mode", "0"]), (sort_pixels, ["--key", "hue"]),
+                                          (mountains, ["--direction", "up"])])
+def test_reused_buffer_matches_a_fresh_run(module, argv):
+    args = module.parse_args(["--files", "image.png"] + argv)
+    buffer = random_image(0)
+    module.process_pixels(args, buffer)
+
+    # A library caller writes the next image into the same array.
+    buffer[...] = random_image(1)
+    expected = module.process_pixels(args, random_image(1))
+    assert np.array_equal(module.process_pixels(args, buffer), expected)
+
+
+def test_pipeline_stages_share_maps_through_the_given_cache():
+    stages = parse_pipeline("sort:mode=0,row_only | sort:mode=2,col_only")
+    key_cache = KeyCache()
+    pixels, _ = run_pipeline(random_image(2), stages, key_cache)
+    assert (key_cache.misses, key_cache.hits) == (1, 1)
+
+    # A new image in the same array computes its maps again, as each call uses its own cache by default.
+    expected, _ = run_pipeline(random_image(3), stages)
+    pixels[...] = random_image(3)
+    assert np.array_equal(run_pipeline(pixels, stages)[0], expected)
+
+
+def test_invalidate_drops_the_maps_of_overlapping_views():
+    key_cache = KeyCache()
+    image = random_image(4)
+    crop = image[4:20, 8:40]
+    key_cache.get(image, "brightness")
+    key_cache.get(crop, "brightness")
+    key_cache.get(image[4:20, 8:40], "brightness")
+    assert (key_cache.misses, key_cache.hits) == (2, 1)
+
+    key_cache.invalidate(crop)
+    key_cache.get(image, "brightness")
+    assert key_cache.misses == 3